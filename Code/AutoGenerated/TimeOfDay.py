@@ -1,20 +1,65 @@
 
+import struct
+from array import array
+from panda3d.core import PTAFloat, Texture, Filename
+
 from DayProperty import DayProperty
 
 from ..DebugObject import DebugObject
 from direct.stdpy.file import open, isfile
 
+# NumPy is optional, without it the properties are interpolated one by one
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class TimeOfDay(DebugObject):
 
     """ This class manages the time of day settings. It has a list of all
-    available properties and can interpolate between them """
+    available properties and can interpolate between them.
+
+    The curves of the properties are baked into a lookup table with one
+    sample per minute when loading, so update only interpolates linearly
+    between two samples, for all properties at once. The values are written
+    to one packed float array, in the order of getPropertyKeys. The lookup
+    table is also stored in a texture with one row per property, so shaders
+    can sample the properties at any time of the day, see
+    TimeOfDay.include
+
+    The settings are stored in a binary file: A header, one block per
+    property with its id and its 8 control points, and the baked lookup
+    table with one row per property. When loading, the file gets memory
+    mapped if NumPy is available, and the lookup table is used directly, so
+    no curve has to be evaluated. The control points of a property are only
+    read when the property is accessed. The old text format is still loaded
+    and saved for files ending with .ini """
+
+    NumSamples = 1440
+
+    FileMagic = "RPTD"
+    FileVersion = 1
+    FileHeader = struct.Struct("<4sIII")
+    FileBlock = struct.Struct("<32s8d")
 
     def __init__(self):
         """ Creates a new time of day instance. Remember to call load() before
         using this instance """
         DebugObject.__init__(self, "TimeOfDay")
         self._createProperties()
+        self.packedValues = PTAFloat.emptyArray(len(self.propertiesOrdered))
+        self.lookup = None
+        self.lookupTexture = None
+        self.fileData = None
+        self.pendingBlocks = {}
+
+        if numpy is not None:
+            try:
+                self.packedView = numpy.asarray(memoryview(self.packedValues))
+            except TypeError:
+                # Older Panda3D builds don't expose the buffer interface
+                self.packedView = None
 
     def _createProperties(self):
         """ Internal method to populate the property list """
@@ -47,14 +92,61 @@ class TimeOfDay(DebugObject):
 
     def getProperties(self):
         """ Returns all properties """
+        self._materializeAll()
         return self.properties
 
     def bindTo(self, node, uniformName):
-        """ Binds the shader inputs to a node. This only has to be done once """
-
-        for propid, prop in self.properties.items():
-            name = propid.replace(".", "_")
-            node.setShaderInput(name, prop.getPTA())
+        """ Binds the shader inputs to a node. This only has to be done once.
+        The packed values are bound as <uniformName>Values and the lookup
+        texture as <uniformName>Lookup """
+        if self.lookup is None:
+            self.bake()
+
+        node.setShaderInput(uniformName + "Values", self.packedValues)
+        node.setShaderInput(uniformName + "Lookup", self.lookupTexture)
+
+    def bake(self):
+        """ Bakes the curves of all properties into the lookup table and the
+        lookup texture. This gets called by load, call it again after changing
+        the values of a property """
+        self._materializeAll()
+
+        samples = []
+        for propId in self.propertiesOrdered:
+            samples.append(self.properties[propId].bake(self.NumSamples))
+
+        if numpy is not None:
+            self.lookup = numpy.array(samples, dtype=numpy.float32)
+        else:
+            self.lookup = samples
+
+        self._uploadLookup()
+
+    def _uploadLookup(self):
+        """ Internal method to copy the lookup table to the lookup texture """
+        if self.lookupTexture is None:
+            self.lookupTexture = Texture("TimeOfDayLookup")
+            self.lookupTexture.setup2dTexture(
+                self.NumSamples, len(self.propertiesOrdered), Texture.TFloat,
+                Texture.FR32)
+            self.lookupTexture.setWrapU(Texture.WMRepeat)
+            self.lookupTexture.setWrapV(Texture.WMClamp)
+            self.lookupTexture.setMinfilter(Texture.FTLinear)
+            self.lookupTexture.setMagfilter(Texture.FTLinear)
+
+        self.lookupTexture.setRamImage(self._getLookupData())
+
+    def _getLookupData(self):
+        """ Internal method to return the lookup table as float32 string,
+        row by row """
+        if numpy is not None:
+            return numpy.ascontiguousarray(
+                self.lookup, dtype=numpy.float32).tostring()
+
+        data = array("f")
+        for values in self.lookup:
+            data.extend(values)
+        return data.tostring()
 
     def update(self, timestamp):
         """ Updates all shader inputs. timestamp should be between 0 and 1 and
@@ -63,9 +155,30 @@ class TimeOfDay(DebugObject):
         if timestamp < 0.0 or timestamp > 1.0:
             self.warn("Invalid timestamp:",timestamp)
 
-        for prop in self.properties.values():
-            val = prop.getInterpolatedValue(timestamp)
-            prop.getPTA()[0] = val
+        if self.lookup is None:
+            self.bake()
+
+        position = (timestamp % 1.0) * self.NumSamples
+        index = min(int(position), self.NumSamples - 1)
+        nextIndex = (index + 1) % self.NumSamples
+        factor = position - index
+
+        if numpy is not None:
+            values = self.lookup[:, index] * (1.0 - factor) + \
+                self.lookup[:, nextIndex] * factor
+            if self.packedView is not None:
+                self.packedView[:] = values
+                return
+        else:
+            values = [samples[index] * (1.0 - factor) +
+                      samples[nextIndex] * factor for samples in self.lookup]
+
+        for propIndex, value in enumerate(values):
+            self.packedValues[propIndex] = value
+
+    def getValue(self, propId):
+        """ Returns the value of a property at the time of the last update """
+        return self.packedValues[self.propertiesOrdered.index(propId)]
 
     def getPropertyKeys(self):
         """ Returns all property keys, ordered """
@@ -73,10 +186,33 @@ class TimeOfDay(DebugObject):
 
     def getProperty(self, prop):
         """ Returns a property by id """
+        self._materialize(prop)
         return self.properties[prop]
 
+    def _materialize(self, propId):
+        """ Internal method to read the control points of a property from
+        the loaded file, if they were not read yet """
+        offset = self.pendingBlocks.pop(propId, None)
+        if offset is None:
+            return
+
+        prop = self.properties[propId]
+        values = self.FileBlock.unpack_from(self.fileData, offset)[1:]
+        prop.values = [prop.propType.convertString(i) for i in values]
+        prop.recompute()
+
+        if len(self.pendingBlocks) < 1:
+            self.fileData = None
+
+    def _materializeAll(self):
+        """ Internal method to read the control points of all properties
+        which were not accessed yet """
+        for propId in self.pendingBlocks.keys():
+            self._materialize(propId)
+
     def load(self, filename):
-        """ Loads the property values from <filename> """
+        """ Loads the property values from <filename>. Files ending with
+        .ini are parsed as text, all other files as binary """
 
         self.debug("Loading from", filename)
 
@@ -84,6 +220,12 @@ class TimeOfDay(DebugObject):
             self.error("Could not load", filename)
             return False
 
+        if not filename.endswith(".ini"):
+            return self._loadBinary(filename)
+
+        self.pendingBlocks = {}
+        self.fileData = None
+
         with open(filename, "r") as handle:
             content = handle.readlines()
 
@@ -119,8 +261,95 @@ class TimeOfDay(DebugObject):
             prop.values = propData
             prop.recompute()
 
+        self.bake()
+        return True
+
+    def _mapFile(self, filename):
+        """ Internal method to memory map a file, falls back to reading it
+        when NumPy is not available or the file is not on the disk """
+        if numpy is not None:
+            try:
+                return numpy.memmap(Filename(filename).toOsSpecific(),
+                                    dtype=numpy.uint8, mode="r")
+            except (IOError, OSError, ValueError):
+                pass
+
+        with open(filename, "rb") as handle:
+            return handle.read()
+
+    def _loadBinary(self, filename):
+        """ Internal method to load a binary file written by save """
+        data = self._mapFile(filename)
+
+        if len(data) < self.FileHeader.size:
+            self.error("File is too small:", filename)
+            return False
+
+        magic, version, numProperties, numSamples = \
+            self.FileHeader.unpack_from(data, 0)
+
+        if magic != self.FileMagic or version != self.FileVersion:
+            self.error("Invalid file format or version:", filename)
+            return False
+
+        lookupOffset = self.FileHeader.size + \
+            numProperties * self.FileBlock.size
+        if len(data) != lookupOffset + numProperties * numSamples * 4:
+            self.error("File size does not match the header:", filename)
+            return False
+
+        self.fileData = data
+        self.pendingBlocks = {}
+        rows = {}
+
+        for index in xrange(numProperties):
+            offset = self.FileHeader.size + index * self.FileBlock.size
+            propId = self.FileBlock.unpack_from(data, offset)[0].rstrip("\0")
+
+            if propId not in self.properties:
+                self.warn("Invalid ID:", propId)
+                continue
+
+            self.pendingBlocks[propId] = offset
+            rows[propId] = index
+
+        # The stored lookup table can only be used if it contains exactly
+        # the current properties, otherwise the curves get baked again
+        if numSamples != self.NumSamples or \
+                len(rows) != len(self.propertiesOrdered):
+            self.debug("Stored lookup table does not match, baking it")
+            self.bake()
+            return True
+
+        order = [rows[propId] for propId in self.propertiesOrdered]
+
+        if numpy is not None:
+            lookup = numpy.frombuffer(
+                data, dtype=numpy.float32, offset=lookupOffset)
+            lookup = lookup.reshape(numProperties, numSamples)
+            if order != range(numProperties):
+                lookup = lookup[order]
+        else:
+            lookup = []
+            for index in order:
+                offset = lookupOffset + index * numSamples * 4
+                values = array("f")
+                values.fromstring(data[offset:offset + numSamples * 4])
+                lookup.append(values)
+
+        self.lookup = lookup
+        self._uploadLookup()
+        return True
+
     def save(self, dest):
-        """ Writes the default property file to a given location """
+        """ Writes the property file to a given location. Files ending with
+        .ini are written as text, all other files as binary """
+        if not dest.endswith(".ini"):
+            self._saveBinary(dest)
+            return
+
+        self._materializeAll()
+
         output = "# Autogenerated by Time of Day Manager\n"
         output += "# Do not edit! Your changes will be lost.\n"
 
@@ -131,12 +360,43 @@ class TimeOfDay(DebugObject):
         with open(dest, "w") as handle:
             handle.write(output)
 
+    def _saveBinary(self, dest):
+        """ Internal method to write the control points and the lookup table
+        to a binary file """
+
+        # Bake the curves, since the values might have changed since loading
+        self.bake()
+
+        output = self.FileHeader.pack(
+            self.FileMagic, self.FileVersion, len(self.propertiesOrdered),
+            self.NumSamples)
+
+        for propId in self.propertiesOrdered:
+            output += self.FileBlock.pack(
+                propId, *self.properties[propId].values)
+
+        output += self._getLookupData()
+
+        with open(dest, "wb") as handle:
+            handle.write(output)
+
     def saveGlslInclude(self, dest):
         """ Writes the GLSL structure representation to a given location """
         output = "// Autogenerated by Time of Day Manager\n"
         output += "// Do not edit! Your changes will be lost.\n\n\n"
 
-        output += "struct TimeOfDay {\n\n"
+        output += "#define TIME_OF_DAY_NUM_PROPERTIES " + \
+            str(len(self.propertiesOrdered)) + "\n"
+        output += "#define TIME_OF_DAY_NUM_SAMPLES " + \
+            str(self.NumSamples) + "\n\n"
+
+        output += "// Indices of the properties in the packed values and the "
+        output += "lookup texture\n"
+        for index, propid in enumerate(self.propertiesOrdered):
+            name = "TIME_OF_DAY_" + propid.replace(".", "_").upper()
+            output += "#define " + name + " " + str(index) + "\n"
+
+        output += "\n\nstruct TimeOfDay {\n\n"
 
         for propid, prop in self.properties.items():
             name = propid.replace(".", "_")
@@ -146,5 +406,27 @@ class TimeOfDay(DebugObject):
 
         output += "};\n\n\n"
 
+        output += "// Unpacks the values bound by TimeOfDay.bindTo\n"
+        output += "TimeOfDay unpackTimeOfDay("
+        output += "float values[TIME_OF_DAY_NUM_PROPERTIES]) {\n"
+        output += "    TimeOfDay result;\n"
+        for propid in self.propertiesOrdered:
+            name = propid.replace(".", "_")
+            output += "    result." + name + " = values[TIME_OF_DAY_" + \
+                name.upper() + "];\n"
+        output += "    return result;\n"
+        output += "}\n\n"
+
+        output += "// Samples a property from the lookup texture, timestamp is "
+        output += "between 0 and 1\n"
+        output += "float sampleTimeOfDay(sampler2D lookup, int property, "
+        output += "float timestamp) {\n"
+        output += "    vec2 coord = vec2(\n"
+        output += "        timestamp + 0.5 / float(TIME_OF_DAY_NUM_SAMPLES),\n"
+        output += "        (float(property) + 0.5) / "
+        output += "float(TIME_OF_DAY_NUM_PROPERTIES));\n"
+        output += "    return textureLod(lookup, coord, 0).x;\n"
+        output += "}\n\n"
+
         with open(dest, "w") as handle:
             handle.write(output)
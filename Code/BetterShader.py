@@ -1,18 +1,18 @@
+import threading
+
 from direct.stdpy.file import open, isdir, isfile, join, listdir
 from panda3d.core import Shader, Filename
 from Globals import Globals
+from ShaderCache import ShaderCache
+from ShaderPreprocessor import ShaderPreprocessor
 
 
 class BetterShader:
 
     """ Small wrapper arround panda3d.core.Shader which supports
     includes in glsl shaders via #include "filename", and also caches
-    shaders """
-
-    # Include stack, which mentions the already included
-    # files. This prevents recursive inclusion. Stack
-    # gets cleared after creating a shader.
-    _GlobalIncludeStack = []
+    shaders. When a ShaderCache is set, the preprocessed sources are
+    also cached on disk """
 
     # Root directory where all the shaders are stored
     # This is useful so you don't have to change all your
@@ -25,18 +25,35 @@ class BetterShader:
     # handy and should only be disabled in production
     _DumpShaders = False
 
-    _ShaderCache = {}
+    # Persistent cache for the preprocessed sources, see ShaderCache.
+    # Set to None to disable
+    _DiskCache = None
+
+    # Expands the includes, and keeps the include graph to find out which
+    # shaders have to be reloaded
+    _Preprocessor = ShaderPreprocessor(
+        lambda path: BetterShader.getShaderID(path))
+
+    # Maps each shader file to the ID used in its #line directives, and
+    # back. The IDs are assigned sequentially, see getShaderID
     _ShaderIDs = {}
+    _ShaderPaths = {}
     _NextID = 1000
+    _IDLock = threading.Lock()
+
+    _ShaderCache = {}
+
+    # List of the shader files loaded since startRecording was called, or
+    # None when not recording. Used by the ShaderWatcher
+    _LoadRecorder = None
 
     @classmethod
     def loadCompute(self, source):
         """ Loads a compute shader """
 
-        content = self._handleIncludes(source)
+        content = self._loadSource(source)
         result = Shader.makeCompute(Shader.SLGLSL, content)
         self._writeDebugShader("Compute-" + str(source), content)
-        self._clearIncludeStack()
         return result
 
     @classmethod
@@ -51,14 +68,13 @@ class BetterShader:
             if len(arg) < 1:
                 newArgs.append("")
                 continue
-            content = self._handleIncludes(arg)
+            content = self._loadSource(arg)
             newArgs.append(content)
             toHash += content
             self._writeDebugShader("Shader-" + str(arg), content)
-            self._clearIncludeStack()
 
         # Check if we already have the result cached
-        hashed = hash(toHash)
+        hashed = ShaderCache.computeHash(toHash)
         if hashed in self._ShaderCache:
             # Cache entry found
             return self._ShaderCache[hashed]
@@ -70,91 +86,136 @@ class BetterShader:
         return result
 
     @classmethod
-    def _clearIncludeStack(self):
-        """ Internal method to clear the include stack """
-        self._GlobalIncludeStack = []
+    def getShaderID(self, path):
+        """ Returns the ID of a file used in the #line directives. Each file
+        gets a new ID, so two files never share one """
+        with self._IDLock:
+            ID = self._ShaderIDs.get(path, None)
+            if ID is None:
+                ID = self._NextID
+                self._registerShaderID(path, ID)
+            return ID
 
     @classmethod
-    def _writeDebugShader(self, name, content):
-        """ Internal method to dump shader for debugging """
-
-        if not self._DumpShaders:
-            return
+    def getShaderPath(self, ID):
+        """ Returns the file with the given #line ID, or None if the ID is
+        unknown. Use this to find the file a compiler error refers to """
+        with self._IDLock:
+            return self._ShaderPaths.get(ID, None)
 
-        cachePath = "PipelineTemp"
-        if not isdir(cachePath):
-            print "Cache path does not exist!:", cachePath
-            print "Disabling shader dump"
-            self._DumpShaders = False
-            return
+    @classmethod
+    def _getShaderIDs(self, paths):
+        """ Internal method to get the IDs of the given files, as dictionary
+        which maps each file to its ID """
+        return dict((path, self.getShaderID(path)) for path in paths)
 
-        writeName = name.strip().replace("/", "-").replace(".", "_") + ".bin"
+    @classmethod
+    def _adoptShaderIDs(self, fileIDs):
+        """ Internal method to take over the IDs a cached source was
+        preprocessed with. Returns False when one of the files already has
+        another ID, or one of the IDs is used by another file. The cached
+        source can't be used then """
+        with self._IDLock:
+            for path, ID in fileIDs.items():
+                if self._ShaderIDs.get(path, ID) != ID or \
+                        self._ShaderPaths.get(ID, path) != path:
+                    return False
+
+            for path, ID in fileIDs.items():
+                self._registerShaderID(path, ID)
+            return True
 
-        with open(join(cachePath, writeName), "w") as handle:
-            handle.write(str(content))
+    @classmethod
+    def _registerShaderID(self, path, ID):
+        """ Internal method to store the ID of a file, the caller has to
+        hold the ID lock """
+        self._ShaderIDs[path] = ID
+        self._ShaderPaths[ID] = path
+        self._NextID = max(self._NextID, ID + 1)
 
     @classmethod
-    def _handleIncludes(self, source):
-        """ Internal (recursive) method to parse #include's """
+    def reloadChangedFiles(self):
+        """ Checks which shader files changed on disk since they were read,
+        and removes all shaders depending on them from the caches, so the
+        next load preprocesses them again. Unchanged shaders are returned
+        from the cache when loading them again. Returns the list of
+        affected shader files """
+        return self._Preprocessor.invalidateChangedFiles()
 
-        with open(source, "r") as handle:
-            content = handle.readlines()
+    @classmethod
+    def preprocessFiles(self, sources, numThreads=4):
+        """ Preprocesses the given shader files in parallel, so loading
+        them afterwards only has to compile them """
+        missing = [source for source in sources
+                   if self._Preprocessor.getDependencies(source) is None]
+        for source, (content, dependencies) in \
+                self._Preprocessor.preprocessMany(missing, numThreads).items():
+            if self._DiskCache is not None:
+                self._DiskCache.store(source, content, dependencies,
+                                      self._getShaderIDs(dependencies))
 
-        newContent = ""
-        includeIdentifier = "#include "
+    @classmethod
+    def startRecording(self):
+        """ Starts recording which shader files get loaded """
+        self._LoadRecorder = []
 
-        ID = self._ShaderIDs.get(source, None)
-        if ID is None:
-            ID = self._NextID
-            self._ShaderIDs[source] = ID
-            # print ID, source
-            self._NextID += 1
+    @classmethod
+    def stopRecording(self):
+        """ Stops recording, and returns the list of shader files loaded
+        since startRecording was called """
+        recorded = self._LoadRecorder or []
+        self._LoadRecorder = None
+        return recorded
 
-        newContent += "#line 1 %d\n" % (ID)
+    @classmethod
+    def _loadSource(self, source):
+        """ Internal method to load a shader file with all includes
+        expanded. Uses the disk cache if possible """
+        self._Preprocessor.shaderPath = self._GlobalShaderPath
 
-        # Iterate through lines
-        for line_idx, line in enumerate(content):
-            lineStrip = line.strip()
-            if lineStrip.startswith(includeIdentifier):
-                includePart = lineStrip[len(includeIdentifier):].strip()
+        if self._LoadRecorder is not None:
+            self._LoadRecorder.append(source)
 
-                # Filename is surrounded by braces
-                if includePart.startswith('"') and includePart.endswith('"'):
+        # Already expanded in this session
+        if self._Preprocessor.getDependencies(source) is not None:
+            return self._Preprocessor.preprocess(source)[0]
 
-                    # Special case
-                    if includePart == '"%ShaderAutoConfig%"':
-                        properIncludePart = "PipelineTemp/ShaderAutoConfig.include"
-                    else:
-                        # Extract include part
-                        properIncludePart = Filename.fromOsSpecific(join(
-                            self._GlobalShaderPath, includePart[1:-1])).toOsGeneric()
+        if self._DiskCache is not None:
+            cached = self._DiskCache.lookup(source)
+            if cached is not None:
+                content, dependencies, fileIDs = cached
 
-                    # And check if file exists
-                    if isfile(properIncludePart):
+                # The #line IDs of the cached source have to match the ones
+                # of this session, otherwise errors would point to the
+                # wrong files
+                if self._adoptShaderIDs(fileIDs):
+                    self._Preprocessor.addExpanded(
+                        source, content, dependencies)
+                    return content
 
-                        # Check for recursive includes
-                        if properIncludePart in self._GlobalIncludeStack:
-                            # print "BetterShader: Ignoring recursive
-                            # include:",properIncludePart
-                            pass
+        content, dependencies = self._Preprocessor.preprocess(source)
 
-                        else:
-                            self._GlobalIncludeStack.append(properIncludePart)
-                            newContent += "\n// FILE: '" + \
-                                str(properIncludePart) + "' \n"
+        if self._DiskCache is not None:
+            self._DiskCache.store(source, content, dependencies,
+                                  self._getShaderIDs(dependencies))
 
-                            newContent += self._handleIncludes(
-                                properIncludePart).strip() + "\n"
+        return content
 
-                            newContent += "#line %d %d\n" % (line_idx + 3, ID)
+    @classmethod
+    def _writeDebugShader(self, name, content):
+        """ Internal method to dump shader for debugging """
 
-                    else:
-                        print "BetterShader: Failed to load '" + str(properIncludePart) + "'!"
-                else:
-                    print "BetterShader: Invalid include:", includePart
+        if not self._DumpShaders:
+            return
 
-                continue
+        cachePath = "PipelineTemp"
+        if not isdir(cachePath):
+            print "Cache path does not exist!:", cachePath
+            print "Disabling shader dump"
+            self._DumpShaders = False
+            return
 
-            newContent += line.rstrip() + "\n"
+        writeName = name.strip().replace("/", "-").replace(".", "_") + ".bin"
 
-        return newContent
+        with open(join(cachePath, writeName), "w") as handle:
+            handle.write(str(content))
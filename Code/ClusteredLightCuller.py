@@ -0,0 +1,145 @@
+
+
+from TiledLightCuller import TiledLightCuller, numpy
+
+
+class ClusteredLightCuller(TiledLightCuller):
+
+    """ This class assigns the lights to clusters instead of screen tiles,
+    used by the LightManager when lightCullingTechnique is set to
+    "Clustered". Each screen tile is split along the view depth into
+    slices, which are distributed exponentially between the near and far
+    plane, so the clusters close to the camera are small and the far away
+    clusters get big. Lights are assigned to all clusters their bounding
+    sphere overlaps, which does not need a depth buffer and therefore can
+    be done on the CPU, for all clusters and lights at once with NumPy.
+
+    The result has the same format as the one of TiledLightCuller, with
+    (numSlices * tilesY) rows of tiles: The tiles of slice 0 come first,
+    then the tiles of slice 1 and so on. So buildStorage produces the same
+    8x8 block per cluster as the tiled culling writes per tile, and the
+    lighting shader only has to offset the tile by the slice of the
+    pixel. """
+
+    def __init__(self, patchSizeX=32, patchSizeY=32, numSlices=16,
+                 near=0.1, far=50000.0):
+        """ Creates a new culler. The patch size is the size of a tile in
+        pixels, like in TiledLightCuller """
+        TiledLightCuller.__init__(
+            self, patchSizeX=patchSizeX, patchSizeY=patchSizeY,
+            near=near, far=far)
+        self._rename("ClusteredLightCuller")
+        self.numSlices = numSlices
+
+        # Preallocated result storage of each light list, see _getBuffer
+        self.buffers = {}
+
+    def getSliceBounds(self):
+        """ Returns the view depth where each slice starts, plus the end of
+        the last slice, so numSlices + 1 values in total """
+        exponents = numpy.arange(self.numSlices + 1) / float(self.numSlices)
+        return self.near * (self.far / self.near) ** exponents
+
+    def getStorageSize(self, width, height):
+        """ Returns the size of the per cluster storage texture for the given
+        screen size, in pixels """
+        tilesX, tilesY = self.getTileCount(width, height)
+        return tilesX * 8, tilesY * self.numSlices * 8
+
+    def cull(self, width, height, lightPositions, lightRadii, lightLists):
+        """ Assigns the lights to the clusters, for a screen of the given
+        size. The light parameters are the same as for
+        TiledLightCuller.cull. Lights with an infinite radius are assigned to
+        all clusters. The projection matrix has to be a perspective one
+        which stores the view depth in w. The returned arrays are reused, so
+        they are only valid until the next call """
+
+        if self.viewMat is None:
+            self.error("Call setMatrices before culling!")
+            return None
+
+        tilesX, tilesY = self.getTileCount(width, height)
+        positions = numpy.asarray(lightPositions, dtype=numpy.float64)
+        radii = numpy.asarray(lightRadii, dtype=numpy.float64)
+
+        result = {}
+        for listName, baseRow in self.LightLists:
+            indices = numpy.asarray(
+                lightLists.get(listName, []), dtype=numpy.int32)
+
+            visible = self._getBuffer(
+                listName, (self.numSlices, tilesY, tilesX, len(indices)))
+
+            if len(indices) > 0:
+                self._assignToClusters(
+                    positions[indices], radii[indices], width, height,
+                    visible)
+
+            result[listName] = (indices, visible.reshape(
+                self.numSlices * tilesY, tilesX, len(indices)))
+
+        return result
+
+    def _getBuffer(self, listName, shape):
+        """ Internal method to return the result array of a light list with
+        the given shape. The storage of each list only grows, so once it
+        fits the maximum amount of lights, no memory gets allocated per
+        frame """
+        size = int(numpy.prod(shape))
+        storage = self.buffers.get(listName)
+
+        if storage is None or len(storage) < size:
+            storage = numpy.empty(size, dtype=bool)
+            self.buffers[listName] = storage
+
+        return storage[:size].reshape(shape)
+
+    def _assignToClusters(self, positions, radii, width, height, out):
+        """ Internal method to check the lights against all clusters. Writes
+        the result to out, an array of the shape
+        (numSlices, tilesY, tilesX, numLights) """
+
+        tilesX, tilesY = self.getTileCount(width, height)
+        numLights = len(radii)
+        homogenous = numpy.ones((numLights, 4))
+        homogenous[:, 0:3] = numpy.where(
+            numpy.isfinite(positions), positions, 0.0)
+        viewPos = homogenous.dot(self.viewMat.T)
+        infinite = ~numpy.isfinite(radii)
+
+        # The tile borders in NDC space. The last tile might reach over the
+        # screen border when the screen size is not a multiple of the patch
+        # size. The clusters are bounded by the planes through the camera on
+        # which clip.x = ndc * clip.w
+        borderX = numpy.arange(tilesX + 1) * (2.0 * self.patchSizeX / width)
+        borderY = numpy.arange(tilesY + 1) * (2.0 * self.patchSizeY / height)
+        horizontal = self._checkBorders(borderX - 1.0, 0, viewPos, radii)
+        vertical = self._checkBorders(borderY - 1.0, 1, viewPos, radii)
+
+        # Check the view depth against the slices
+        depth = viewPos.dot(self.projMat[3])
+        bounds = self.getSliceBounds()
+        slices = (depth + radii >= bounds[:-1, None]) & \
+            (depth - radii <= bounds[1:, None])
+
+        horizontal |= infinite
+        vertical |= infinite
+        slices |= infinite
+
+        numpy.logical_and(slices[:, None, None, :],
+                          vertical[None, :, None, :], out=out)
+        out &= horizontal[None, None, :, :]
+
+    def _checkBorders(self, borders, axis, viewPos, radii):
+        """ Internal method to check the lights against the planes of the
+        tile borders along one axis. Returns an array of the shape
+        (numTiles, numLights) """
+
+        # Plane of each border, with the normal pointing to the tiles after
+        # the border
+        planes = self.projMat[axis][None, :] - \
+            borders[:, None] * self.projMat[3][None, :]
+        lengths = numpy.sqrt((planes[:, 0:3] ** 2).sum(axis=1))
+        distances = planes.dot(viewPos.T) / lengths[:, None]
+
+        return (distances[:-1] >= -radii) & (distances[1:] <= radii)
@@ -1,6 +1,6 @@
 
 from panda3d.core import OmniBoundingVolume, Vec3, Vec2, Point3, Point2, Mat4
-from panda3d.core import Point4, Vec4
+from panda3d.core import Point4, Vec4, Quat, lookAt
 
 import math
 
@@ -9,6 +9,7 @@ from DebugObject import DebugObject
 from LightType import LightType
 from NoSenseException import NoSenseException
 from ShadowSource import ShadowSource
+from PSSMCascadeSolver import PSSMCascadeSolver, numpy
 from Globals import Globals
 
 from panda3d.core import PStatCollector
@@ -38,8 +39,15 @@ class DirectionalLight(Light, DebugObject):
         self.pssmTargetLens = None
         self.pssmFarPlane = 100.0
         self.pssmSplitPow = 2.0
+        self.pssmTexelSnapping = True
         self.updateIndex = 0
 
+        # Computes all splits at once, if NumPy is available
+        self.cascadeSolver = None
+        self.lastCameraState = None
+        self.lastQuat = None
+        self.pssmViewProjections = None
+
         # A directional light is always visible
         self.bounds = OmniBoundingVolume()
 
@@ -54,6 +62,14 @@ class DirectionalLight(Light, DebugObject):
         uniform distributed. Using a value of 1 will make the distribution 
         uniform """
         self.pssmSplitPow = split_pow
+        self.lastCameraState = None
+
+    def setPssmTexelSnapping(self, snap):
+        """ Sets wheter the splits should be snapped to the texels of the
+        shadow map, which prevents shimmering shadow edges when the camera
+        moves. Enabled by default """
+        self.pssmTexelSnapping = snap
+        self.lastCameraState = None
 
     def setPssmTarget(self, pssm_cam, pssm_lens):
         """ Sets the camera and its lens which are used for the pssm. This is
@@ -61,6 +77,13 @@ class DirectionalLight(Light, DebugObject):
         self.pssmTargetCam = pssm_cam
         self.pssmTargetLens = pssm_lens
 
+    def getPssmViewProjections(self):
+        """ Returns the view projection matrix of each split as NumPy array
+        of the shape (splitCount, 4, 4), applied to column vectors. Returns
+        None when NumPy is not available or the splits were not computed
+        yet """
+        return self.pssmViewProjections
+
     def _computeLightMat(self):
         """ Todo """
 
@@ -77,6 +100,10 @@ class DirectionalLight(Light, DebugObject):
         """ This makes no sense, as a directional light has no radius """
         raise NoSenseException("DirectionalLight has no radius")
 
+    # Directional lights have to get updated every frame to reposition the
+    # PSSM frustum
+    UpdatedEachFrame = True
+
     def needsUpdate(self):
         """ Directional lights have to get updated every frame to reposition
         the PSSM frustum """
@@ -104,8 +131,92 @@ class DirectionalLight(Light, DebugObject):
             source.setResolution(self.shadowResolution)
             self._addShadowSource(source)
 
+        if numpy is not None:
+            self.cascadeSolver = PSSMCascadeSolver(self.splitCount, 5.0, 1000.0)
+
     def _updateShadowSources(self):
         """ Updates the PSSM Frustum and all PSSM Splits """
+        if self.cascadeSolver is None:
+            self._updateShadowSourcesUnvectorized()
+            return
+
+        pstats_PCSM.start()
+
+        # Fetch camera data
+        camMat = self.pssmTargetCam.getMat(Globals.base.render)
+        projMatInv = self.pssmTargetLens.getProjectionMatInv()
+        camPos = self.pssmTargetCam.getPos()
+
+        # When neither the camera nor the light changed, the splits are the
+        # same as before. Only invalidate the sources then
+        cameraState = (tuple(camMat), tuple(projMatInv), tuple(camPos),
+                       tuple(self.direction), self.pssmFarPlane)
+
+        moved = None
+        if cameraState != self.lastCameraState:
+            self.lastCameraState = cameraState
+            moved = self._solveCascades(camMat, projMatInv, camPos)
+
+        # Splits which did not move keep their cached static shadow casters
+        for i, source in enumerate(self.shadowSources):
+            if moved is not None and moved[i]:
+                source.invalidate()
+            else:
+                source.invalidateDynamic()
+
+        pstats_PCSM.stop()
+
+    def _solveCascades(self, camMat, projMatInv, camPos):
+        """ Internal method to compute all splits with the cascade solver,
+        and to move the shadow sources which changed. Returns a boolean array
+        which stores for each split wheter it moved """
+        solver = self.cascadeSolver
+
+        frustumPoints = solver.computeFrustumPoints(
+            solver.fromPandaMatrix(camMat), solver.fromPandaMatrix(projMatInv))
+        relativeSplitSize = self.pssmFarPlane / self.pssmTargetLens.getFar()
+
+        centers, positions, filmSizes = solver.solve(
+            frustumPoints, camPos, self.direction, self.pssmSplitPow,
+            relativeSplitSize)
+        filmSizes = solver.stabilizeFilmSizes(filmSizes)
+
+        # All sources look along the light direction, so they share the
+        # same rotation
+        quat = Quat()
+        lookAt(quat, -self.direction, Vec3.up())
+        basis = numpy.array([tuple(quat.getRight()),
+                             tuple(quat.getForward()),
+                             tuple(quat.getUp())])
+
+        resolution = self.shadowSources[0].getResolution()
+        if self.pssmTexelSnapping:
+            positions = solver.snapToTexels(
+                positions, filmSizes, basis, resolution)
+
+        # A new rotation requires to update all sources
+        rotated = self.lastQuat is None or quat != self.lastQuat
+        self.lastQuat = quat
+        if rotated:
+            solver.reset()
+
+        self.pssmViewProjections = solver.computeViewProjections(
+            positions, filmSizes, basis)
+
+        moved = solver.findMovedSplits(positions, filmSizes, resolution)
+
+        for i in numpy.flatnonzero(moved):
+            source = self.shadowSources[i]
+            source.setPos(Vec3(*positions[i]))
+            if rotated:
+                source.setQuat(quat)
+            if source.getFilmSize() != filmSizes[i]:
+                source.setFilmSize(filmSizes[i], filmSizes[i])
+
+        return moved
+
+    def _updateShadowSourcesUnvectorized(self):
+        """ Internal fallback method which updates the splits one by one """
 
         mixVector = lambda p1, p2, a: ((p2*a) + (p1*(1.0-a)))
 
@@ -53,6 +53,10 @@ class GIHelperLight(Light, DebugObject):
         """ This makes no sense, as a directional light has no radius """
         raise NoSenseException("GIHelperLight has no radius")
 
+    # The helper light should get updated each frame to reposition the
+    # shadow sources
+    UpdatedEachFrame = True
+
     def needsUpdate(self):
         """ The helper light should get updated each frame to reposition the
         shadow sources """
@@ -14,6 +14,11 @@ class Light(ShaderStructElement):
     of this class. This class handles all generic properties
     of a light. """
 
+    # Lights which have to get updated each frame, like directional lights
+    # repositioning their PSSM splits, set this to True. All other lights
+    # only get updated after they changed
+    UpdatedEachFrame = False
+
     def __init__(self):
         """ Constructs a new Light, subclasses have to call this """
 
@@ -22,6 +27,7 @@ class Light(ShaderStructElement):
         self.debugNode = NodePath("LightDebug")
         self.visualizationNumSteps = 16
         self.dataNeedsUpdate = False
+        self.updateListener = None
         self.castShadows = False
         self.debugEnabled = False
         self.bounds = OmniBoundingVolume()
@@ -37,6 +43,7 @@ class Light(ShaderStructElement):
         self.attached = False
         self.shadowResolution = 512
         self.ambient = Vec3(0.2, 0.5, 0.8)
+        self.movedSinceShadowUpdate = True
 
         for i in range(6):
             self.sourceIndexes[i] = -1
@@ -84,6 +91,7 @@ class Light(ShaderStructElement):
         copied = Vec3(direction)
         copied.normalize()
         self.direction = copied
+        self.movedSinceShadowUpdate = True
         self.queueUpdate()
         self.queueShadowUpdate()
 
@@ -112,9 +120,7 @@ class Light(ShaderStructElement):
             self._initShadowSources()
             self.shadowNeedsUpdate = True
         else:
-            for source in self.shadowSources:
-                del source
-            self.shadowSources = []
+            self._releaseShadowSources()
             self.shadowNeedsUpdate = False
 
     def setPos(self, pos):
@@ -124,6 +130,7 @@ class Light(ShaderStructElement):
         # If the position is very similar, don't update
         if (pos - self.position).length() > 0.001:
             self.position = pos
+            self.movedSinceShadowUpdate = True
             self.queueUpdate()
             self.queueShadowUpdate()
 
@@ -140,6 +147,11 @@ class Light(ShaderStructElement):
         """ Wheter the light data is up-to-date or needs an update """
         return self.dataNeedsUpdate
 
+    def hasMovedSinceShadowUpdate(self):
+        """ Returns wheter the light moved since the last time its shadow
+        sources were queued for an update """
+        return self.movedSinceShadowUpdate
+
     def needsShadowUpdate(self):
         """ Wheter the light shadow map is up-to-date or needs an update """
 
@@ -155,9 +167,26 @@ class Light(ShaderStructElement):
 
     def queueUpdate(self):
         """ Queues a light update, means in the next frame the light
-        data will update """
+        data will update. The update listener gets notified once until the
+        light got updated """
+        if not self.dataNeedsUpdate and self.updateListener is not None:
+            self.updateListener(self)
         self.dataNeedsUpdate = True
 
+    def setUpdateListener(self, listener):
+        """ Sets the function which gets called with the light when an
+        update got queued, used by the LightManager to collect the changed
+        lights. When an update is already queued, the listener gets called
+        immediately """
+        self.updateListener = listener
+        if self.dataNeedsUpdate and listener is not None:
+            listener(self)
+
+    def cancelUpdate(self):
+        """ Discards a queued update, called by the LightManager for lights
+        which are not rendered """
+        self.dataNeedsUpdate = False
+
     def queueShadowUpdate(self):
         """ Queues a shadow update, means invalidating all shadow sources and
         adding to the shadow-map update queue, beeing processed as fast as
@@ -167,6 +196,15 @@ class Light(ShaderStructElement):
         for source in self.shadowSources:
             source.invalidate()
 
+    def queueDynamicShadowUpdate(self):
+        """ Queues a shadow update for the dynamic shadow casters only. The
+        cached static shadow casters stay valid, see
+        ShadowSource.invalidateDynamic """
+        self.shadowNeedsUpdate = True
+
+        for source in self.shadowSources:
+            source.invalidateDynamic()
+
     def performUpdate(self):
         """ Recomputes the light data """
         self.dataNeedsUpdate = False
@@ -181,14 +219,19 @@ class Light(ShaderStructElement):
 
         self.onPropertyChanged()
 
-    def performShadowUpdate(self):
-        """ Computes which shadow sources need an update and returns these """
+    def performShadowUpdate(self, cullBounds=None):
+        """ Computes which shadow sources need an update and returns these.
+        Sources which can't be seen inside of the given camera bounds can be
+        skipped by the light, see _isShadowSourceVisible. They stay invalid,
+        and get returned as soon as they are visible """
         self._updateShadowSources()
         queued = []
-        for source in self.shadowSources:
-            if not source.isValid():
+        for index, source in enumerate(self.shadowSources):
+            if not source.isValid() and \
+                    self._isShadowSourceVisible(index, cullBounds):
                 queued.append(source)
         self.shadowNeedsUpdate = not len(queued) < 1
+        self.movedSinceShadowUpdate = False
         return queued
 
     def attachDebugNode(self, parent):
@@ -211,6 +254,20 @@ class Light(ShaderStructElement):
         self.shadowSources.append(source)
         self.queueShadowUpdate()
 
+    def _releaseShadowSources(self):
+        """ Internal method to remove all shadow sources and detach their
+        cameras from the scene. Atlas space is only reserved while the light
+        is attached, LightManager.removeLight frees it """
+        for source in self.shadowSources:
+            source.detach()
+        self.shadowSources = []
+
+    def _isShadowSourceVisible(self, index, cullBounds):
+        """ Child classes can return False here for shadow sources which
+        don't have to be rendered, as they can't be seen inside of the camera
+        bounds. cullBounds might be None """
+        return True
+
     def _computeLightBounds(self):
         """ Child classes should compute the light bounds here """
         raise NotImplementedError()
@@ -0,0 +1,175 @@
+
+from panda3d.core import BoundingSphere, BoundingHexahedron
+from panda3d.core import PStatCollector
+
+from DebugObject import DebugObject
+from LightType import LightType
+
+# NumPy is optional, without it the lights are culled one by one
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+pstats_VectorizedCulling = PStatCollector(
+    "App:LightManager:CullLights:Vectorized")
+
+
+class LightCuller(DebugObject):
+
+    """ This class is used by the LightManager to cull the lights against
+    the camera frustum. It stores the position and radius of each light in
+    NumPy arrays, so all light spheres can be tested against the frustum
+    planes at once, instead of calling BoundingVolume.contains per light.
+
+    Lights are identified by their index in the lights list of the
+    LightManager. Lights which have no bounding sphere (like directional
+    lights) get an infinite radius, so they are always visible.
+
+    When NumPy is not available, or the camera bounds are not a
+    BoundingHexahedron, each light is checked separately. """
+
+    def __init__(self, capacity=64):
+        """ Creates a new culler, with an initial capacity. The capacity
+        grows when more lights are added """
+        DebugObject.__init__(self, "LightCuller")
+        self.lights = {}
+        self.typeNames = []
+        self.numLights = 0
+
+        if numpy is not None:
+            self.positions = numpy.zeros((capacity, 4), dtype=numpy.float32)
+            self.positions[:, 3] = 1.0
+            self.radii = numpy.zeros(capacity, dtype=numpy.float32)
+            self.typeIds = numpy.zeros(capacity, dtype=numpy.int32)
+            self.active = numpy.zeros(capacity, dtype=bool)
+        else:
+            self.debug("NumPy not found, using unvectorized light culling")
+
+    def _getTypeId(self, typeName):
+        """ Internal method to convert a light type name to an integer """
+        if typeName not in self.typeNames:
+            self.typeNames.append(typeName)
+        return self.typeNames.index(typeName)
+
+    def _ensureCapacity(self, size):
+        """ Internal method to grow the arrays so they can store at least
+        size lights """
+        capacity = len(self.radii)
+        if size <= capacity:
+            return
+
+        newCapacity = max(size, capacity * 2)
+        positions = numpy.zeros((newCapacity, 4), dtype=numpy.float32)
+        positions[:, 3] = 1.0
+        positions[:capacity] = self.positions
+        self.positions = positions
+        self.radii = numpy.resize(self.radii, newCapacity)
+        self.typeIds = numpy.resize(self.typeIds, newCapacity)
+        self.active = numpy.resize(self.active, newCapacity)
+        self.active[capacity:] = False
+
+    def setLight(self, index, light, typeName):
+        """ Stores the bounds of a light at the given index. This has to be
+        called whenever the bounds or the type name of the light changed """
+        self.lights[index] = (light, typeName)
+        self.numLights = max(self.numLights, index + 1)
+        typeId = self._getTypeId(typeName)
+
+        if numpy is None:
+            return
+
+        self._ensureCapacity(index + 1)
+        bounds = light.getBounds()
+
+        if isinstance(bounds, BoundingSphere):
+            center = bounds.getCenter()
+            self.positions[index, 0:3] = (center.x, center.y, center.z)
+            self.radii[index] = bounds.getRadius()
+        else:
+            self.radii[index] = numpy.inf
+
+        self.typeIds[index] = typeId
+        self.active[index] = True
+
+    def setLights(self, indices, lights, typeNames):
+        """ Stores the bounds of many lights at once, like setLight. The
+        bounds are computed from the position and radius of point lights,
+        all other lights get an infinite radius """
+        if numpy is None or len(indices) < 1:
+            for index, light, typeName in zip(indices, lights, typeNames):
+                self.setLight(index, light, typeName)
+            return
+
+        for index, light, typeName in zip(indices, lights, typeNames):
+            self.lights[index] = (light, typeName)
+
+        self.numLights = max(self.numLights, max(indices) + 1)
+        self._ensureCapacity(self.numLights)
+
+        isPoint = numpy.array(
+            [light.lightType == LightType.Point for light in lights])
+        positions = numpy.array(
+            [tuple(light.position) for light in lights], dtype=numpy.float32)
+        radii = numpy.array(
+            [light.radius for light in lights], dtype=numpy.float32)
+
+        indices = numpy.asarray(indices)
+        self.positions[indices, 0:3] = positions
+        self.radii[indices] = numpy.where(isPoint, radii, numpy.inf)
+        self.typeIds[indices] = [self._getTypeId(name) for name in typeNames]
+        self.active[indices] = True
+
+    def removeLight(self, index):
+        """ Removes the light at the given index, it won't be visible
+        anymore """
+        if index in self.lights:
+            del self.lights[index]
+
+        if numpy is not None and index < len(self.active):
+            self.active[index] = False
+
+    def cull(self, cullBounds):
+        """ Culls all lights against the given camera bounds. Returns a
+        dictionary which maps each light type name to the ordered list of
+        visible light indices """
+
+        if numpy is None or not isinstance(cullBounds, BoundingHexahedron):
+            return self._cullUnvectorized(cullBounds)
+
+        pstats_VectorizedCulling.start()
+
+        # Panda's frustum planes point outwards, a sphere is outside if it
+        # is further in front of any plane than its radius
+        planes = numpy.array(
+            [tuple(cullBounds.getPlane(i))
+             for i in xrange(cullBounds.getNumPlanes())],
+            dtype=numpy.float32)
+
+        count = self.numLights
+        distances = self.positions[:count].dot(planes.T)
+        visible = (distances <= self.radii[:count, None]).all(axis=1)
+        visible &= self.active[:count]
+
+        visibleIndices = numpy.flatnonzero(visible)
+        visibleTypes = self.typeIds[visibleIndices]
+
+        result = {}
+        for typeId, typeName in enumerate(self.typeNames):
+            result[typeName] = visibleIndices[visibleTypes == typeId]
+
+        pstats_VectorizedCulling.stop()
+        return result
+
+    def _cullUnvectorized(self, cullBounds):
+        """ Internal fallback method which checks each light separately """
+        result = {}
+        for typeName in self.typeNames:
+            result[typeName] = []
+
+        for index in sorted(self.lights):
+            light, typeName = self.lights[index]
+            if cullBounds.contains(light.getBounds()):
+                result.setdefault(typeName, []).append(index)
+
+        return result
@@ -4,6 +4,9 @@ from panda3d.core import CullFaceAttrib, ColorWriteAttrib, DepthWriteAttrib
 from panda3d.core import OmniBoundingVolume, PTAInt, Vec4, PTAVecBase4f
 from panda3d.core import LVecBase2i, ShaderAttrib, UnalignedLVecBase4f
 from panda3d.core import ComputeNode, LVecBase4i, GraphicsOutput, SamplerState
+from panda3d.core import BitMask32, CardMaker, OrthographicLens, RenderAttrib
+from panda3d.core import DepthTestAttrib
+from direct.stdpy.file import open
 
 
 from Light import Light
@@ -12,7 +15,14 @@ from BetterShader import BetterShader
 from RenderTarget import RenderTarget
 from ShadowSource import ShadowSource
 from ShadowAtlas import ShadowAtlas
+from ShadowUpdateQueue import ShadowUpdateQueue
+from LightType import LightType
 from ShaderStructArray import ShaderStructArray
+from LightCuller import LightCuller
+from LightSpatialIndex import LightSpatialIndex
+from SystemAnalyzer import SystemAnalyzer
+from ShadowCasterCuller import ShadowCasterCuller
+from ShadowLODSelector import ShadowLODSelector
 from Globals import Globals
 
 from panda3d.core import PStatCollector
@@ -22,6 +32,7 @@ pstats_CullLights = PStatCollector("App:LightManager:CullLights")
 pstats_PerLightUpdates = PStatCollector("App:LightManager:PerLightUpdates")
 pstats_FetchShadowUpdates = PStatCollector(
     "App:LightManager:FetchShadowUpdates")
+pstats_BuildClusters = PStatCollector("App:LightManager:BuildClusters")
 
 
 class LightManager(DebugObject):
@@ -46,45 +57,88 @@ class LightManager(DebugObject):
     This shouldn't be an issue, as you usually always know before if a
     light will cast shadows or not.
 
+    When cacheStaticShadows is enabled, the static shadow casters of each
+    shadow map are rendered to a second atlas, the shadow cache, which has
+    the same layout as the shadow atlas. Updating a shadow map then copies
+    the cached depth to the atlas and renders only the dynamic shadow
+    casters on top of it. Nodes are static by default, use
+    setShadowCasterDynamic to mark moving nodes. The cache of a shadow
+    source is only rendered again when the source moved or got a new atlas
+    position, or when invalidateStaticShadows is called after changing
+    static geometry.
+
     """
 
+    # Camera mask of the shadow camera. Culled shadow casters are hidden
+    # for it
+    ShadowCasterMask = BitMask32.bit(28)
+
+    # Camera masks used for caching the static shadow casters. Dynamic
+    # casters are hidden from the cache, and only the dynamic casters are
+    # shown to the shadow atlas camera
+    StaticShadowMask = BitMask32.bit(29)
+    DynamicShadowMask = BitMask32.bit(30)
+
     def __init__(self, pipeline):
         """ Creates a new LightManager. It expects a RenderPipeline as parameter. """
         DebugObject.__init__(self, "LightManager")
 
-        self._initArrays()
-
         self.pipeline = pipeline
         self.settings = pipeline.getSettings()
 
+        self._initArrays()
+
         # Create arrays to store lights & shadow sources
         self.lights = []
         self.shadowSources = []
-        self.queuedShadowUpdates = []
-        self.allLightsArray = ShaderStructArray(Light, self.maxTotalLights)
+        self.queuedShadowUpdates = ShadowUpdateQueue()
+        self.allLightsArray = ShaderStructArray(
+            Light, self.maxTotalLights, packed=self.settings.packLightData)
         self.updateCallbacks = []
 
+        # Indices of removed lights and shadow sources, reused by addLight
+        self.freeLightIndices = []
+        self.freeSourceIndices = []
+        self.disabledLights = set()
+
+        # Lights only get processed after they changed. Changed lights
+        # register themselves in the list of their type, so all lights of a
+        # type can be processed at once. Lights which have to get updated
+        # each frame are stored separately
+        self.lightIndices = {}
+        self.dirtyLights = {}
+        self.alwaysUpdatedLights = []
+
         self.cullBounds = None
+        self.cameraPos = Vec3(0)
+        self.frustumCuller = LightCuller()
+        self.spatialIndex = LightSpatialIndex()
         self.shadowScene = Globals.render
+        self.cacheStaticShadows = self.settings.cacheStaticShadows
 
         # Create atlas
         self.shadowAtlas = ShadowAtlas()
         self.shadowAtlas.setSize(self.settings.shadowAtlasSize)
         self.shadowAtlas.create()
-
-        self.maxShadowMaps = 24
+        self.atlasIsCompact = True
+        self.atlasMovesLeft = 0
         self.maxShadowUpdatesPerFrame = self.settings.maxShadowUpdatesPerFrame
         self.numShadowUpdatesPTA = PTAInt.emptyArray(1)
 
         self.updateShadowsArray = ShaderStructArray(
             ShadowSource, self.maxShadowUpdatesPerFrame)
         self.allShadowsArray = ShaderStructArray(
-            ShadowSource, self.maxShadowMaps)
-
+            ShadowSource, self.maxShadowMaps,
+            packed=self.settings.packLightData)
+        self._writeArrayAccessors()
+        self._checkArrayLimits()
 
         # Create shadow compute buffer
         self._createShadowComputationBuffer()
 
+        if self.cacheStaticShadows:
+            self._createShadowCacheBuffer()
+
         # Create the initial shadow state
         self.shadowComputeCamera.setTagStateKey("ShadowPassShader")
         self._createTagStates()
@@ -101,12 +155,42 @@ class LightManager(DebugObject):
         self.updateShadowsArray.bindTo(
             self.shadowComputeTarget, "updateSources")
 
-        # Set initial inputs
+        # Set initial inputs. The geometry shader only emits the updates
+        # whose bit is set in both masks. The caster mask is overridden per
+        # node by the ShadowCasterCuller
+        self.activeUpdateMaskPTA = PTAInt.emptyArray(1)
+        self.activeUpdateMaskPTA[0] = -1
+        self.shadowCasterMaskPTA = PTAInt.emptyArray(1)
+        self.shadowCasterMaskPTA[0] = -1
         for target in [self.shadowComputeTarget, self.shadowScene]:
             target.setShaderInput("numUpdates", self.numShadowUpdatesPTA)
+            target.setShaderInput("activeUpdateMask", self.activeUpdateMaskPTA)
+            target.setShaderInput(
+                "shadowCasterMask", self.shadowCasterMaskPTA)
+
+        self.shadowLOD = None
+        if self.settings.shadowLOD:
+            self.shadowLOD = ShadowLODSelector(
+                self.settings.shadowLODTiers,
+                self.settings.shadowLODFullCoverage,
+                self.settings.shadowLODHysteresis)
+
+        self.shadowCasterCuller = None
+        if self.settings.cullShadowCasters:
+            if self.cacheStaticShadows:
+                self.shadowCasterCuller = ShadowCasterCuller(
+                    self.shadowScene,
+                    self.StaticShadowMask | self.DynamicShadowMask,
+                    self.DynamicShadowMask)
+            else:
+                self.shadowCasterCuller = ShadowCasterCuller(
+                    self.shadowScene, self.ShadowCasterMask)
 
         self.lightingComputator = None
         self.lightCuller = None
+        self.clusterCuller = None
+        self.clusterStorage = None
+        self.screenSize = None
         self.skip = 0
         self.skipRate = 0
 
@@ -125,6 +209,16 @@ class LightManager(DebugObject):
         self.shadowComputeCamera.setTagState(
             "Default", initialState.getState())
 
+        if self.cacheStaticShadows:
+            self.shadowCacheState.setShader(self.shadowCasterShader, 30)
+            self.shadowCacheState.setAttrib(
+                ColorWriteAttrib.make(ColorWriteAttrib.COff))
+            self._updateCacheTagState()
+
+            self.cacheRestoreQuad.setShader(BetterShader.load(
+                "Shader/DefaultPostProcess.vertex",
+                "Shader/RestoreShadowCache.fragment"))
+
     def _createShadowComputationBuffer(self):
         """ This creates the internal shadow buffer which also is the
         shadow atlas. Shadow maps are rendered to this using Viewports
@@ -140,46 +234,80 @@ class LightManager(DebugObject):
         self.shadowComputeCamera.getLens().setNearFar(1.0, 2.0)
 
         # Disable culling
-        self.shadowComputeCamera.setBounds(OmniBoundingVolume())
-        self.shadowComputeCamera.setCullBounds(OmniBoundingVolume())
-        self.shadowComputeCamera.setFinal(True)
+        self._disableCulling(self.shadowComputeCamera)
         self.shadowComputeCameraNode.setPos(0, 0, 1500)
         self.shadowComputeCameraNode.lookAt(0, 0, 0)
 
-        self.shadowComputeTarget = RenderTarget("ShadowAtlas")
-        self.shadowComputeTarget.setSize(self.shadowAtlas.getSize())
-        self.shadowComputeTarget.addDepthTexture()
-        self.shadowComputeTarget.setDepthBits(32)
+        # When caching the static casters, the atlas only renders the
+        # dynamic casters
+        if self.cacheStaticShadows:
+            self.shadowComputeCamera.setCameraMask(self.DynamicShadowMask)
+            self.shadowScene.hide(self.DynamicShadowMask)
+        else:
+            self.shadowComputeCamera.setCameraMask(self.ShadowCasterMask)
+
+        self.shadowComputeTarget = self._makeShadowTarget(
+            "ShadowAtlas", self.shadowComputeCameraNode, -300)
+        self.depthClearer = self._makeDepthClearers(self.shadowComputeTarget)
+
+        # When using hardware pcf, set the correct filter types
         
-        self.shadowComputeTarget.setSource(
-            self.shadowComputeCameraNode, Globals.base.win)
+        if self.settings.useHardwarePCF:
+            self.pcfSampleState = SamplerState()
+            self.pcfSampleState.setMinfilter(SamplerState.FTShadow)
+            self.pcfSampleState.setMagfilter(SamplerState.FTShadow)
+            self.pcfSampleState.setWrapU(SamplerState.WMClamp)
+            self.pcfSampleState.setWrapV(SamplerState.WMClamp)
 
-        self.shadowComputeTarget.prepareSceneRender()
+
+        dTex = self.getAtlasTex()
+        dTex.setWrapU(Texture.WMClamp)
+        dTex.setWrapV(Texture.WMClamp)
+
+    def _disableCulling(self, camera):
+        """ Internal method to disable the culling of a shadow camera, the
+        shadow sources are selected in the geometry shader """
+        camera.setBounds(OmniBoundingVolume())
+        camera.setCullBounds(OmniBoundingVolume())
+        camera.setFinal(True)
+
+    def _makeShadowTarget(self, name, cameraNode, sort):
+        """ Internal method to create a depth target of the size of the
+        atlas, with one viewport per shadow update """
+        target = RenderTarget(name)
+        target.setSize(self.shadowAtlas.getSize())
+        target.addDepthTexture()
+        target.setDepthBits(32)
+        target.setSource(cameraNode, Globals.base.win)
+        target.prepareSceneRender()
 
         # This took me a long time to figure out. If not removing the quad
         # children, the color and aux buffers will be overridden each frame.
         # Quite annoying!
-        self.shadowComputeTarget.getQuad().node().removeAllChildren()
-        self.shadowComputeTarget.getInternalRegion().setSort(-200)
+        target.getQuad().node().removeAllChildren()
+        target.getInternalRegion().setSort(-200)
 
-        self.shadowComputeTarget.getInternalRegion().setNumRegions(
+        target.getInternalRegion().setNumRegions(
             self.maxShadowUpdatesPerFrame + 1)
-        self.shadowComputeTarget.getInternalRegion().setDimensions(0,
-             (0, 0, 0, 0))
+        target.getInternalRegion().setDimensions(0, (0, 0, 0, 0))
+
+        target.getInternalRegion().disableClears()
+        target.getInternalBuffer().disableClears()
+        target.getInternalBuffer().setSort(sort)
+        return target
 
-        self.shadowComputeTarget.getInternalRegion().disableClears()
-        self.shadowComputeTarget.getInternalBuffer().disableClears()
-        self.shadowComputeTarget.getInternalBuffer().setSort(-300)
+    def _makeDepthClearers(self, target):
+        """ Internal method to create the depth clearers of a target """
 
         # We can't clear the depth per viewport.
         # But we need to clear it in any way, as we still want
         # z-testing in the buffers. So well, we create a
         # display region *below* (smaller sort value) each viewport
         # which has a depth-clear assigned. This is hacky, I know.
-        self.depthClearer = []
+        clearers = []
 
         for i in range(self.maxShadowUpdatesPerFrame):
-            buff = self.shadowComputeTarget.getInternalBuffer()
+            buff = target.getInternalBuffer()
             dr = buff.makeDisplayRegion()
             dr.setSort(-250)
             for k in xrange(16):
@@ -190,27 +318,141 @@ class LightManager(DebugObject):
             dr.setClearDepth(1.0)
             dr.setDimensions(0,0,0,0)
             dr.setActive(False)
-            self.depthClearer.append(dr)
-
-        # When using hardware pcf, set the correct filter types
-        
-        if self.settings.useHardwarePCF:
-            self.pcfSampleState = SamplerState()
-            self.pcfSampleState.setMinfilter(SamplerState.FTShadow)
-            self.pcfSampleState.setMagfilter(SamplerState.FTShadow)
-            self.pcfSampleState.setWrapU(SamplerState.WMClamp)
-            self.pcfSampleState.setWrapV(SamplerState.WMClamp)
-
-
-        dTex = self.getAtlasTex()
-        dTex.setWrapU(Texture.WMClamp)
-        dTex.setWrapV(Texture.WMClamp)
+            clearers.append(dr)
+
+        return clearers
+
+    def _createShadowCacheBuffer(self):
+        """ This creates the shadow cache, which stores the depth of the
+        static shadow casters, with the same layout as the shadow atlas. It
+        is rendered before the atlas, with its own list of updates """
+
+        self.shadowCacheCamera = Camera("ShadowCacheCamera")
+        self.shadowCacheCameraNode = self.shadowScene.attachNewNode(
+            self.shadowCacheCamera)
+        self.shadowCacheCamera.getLens().setFov(30, 30)
+        self.shadowCacheCamera.getLens().setNearFar(1.0, 2.0)
+        self._disableCulling(self.shadowCacheCamera)
+        self.shadowCacheCamera.setCameraMask(self.StaticShadowMask)
+        self.shadowCacheCamera.setTagStateKey("ShadowPassShader")
+        self.shadowCacheCameraNode.setPos(0, 0, 1500)
+        self.shadowCacheCameraNode.lookAt(0, 0, 0)
+
+        self.shadowCacheTarget = self._makeShadowTarget(
+            "ShadowCache", self.shadowCacheCameraNode, -350)
+        self.cacheDepthClearer = self._makeDepthClearers(
+            self.shadowCacheTarget)
+        self.shadowCacheTarget.setActive(False)
+
+        # The cache uses the same update slots as the atlas, but only
+        # renders the slots whose cache is outdated. The scene is shared with
+        # the atlas camera, so the mask of these slots is passed with the
+        # tag state, which overrides the inputs of the scene
+        self.staticUpdateMaskPTA = PTAInt.emptyArray(1)
+        self.shadowCacheState = NodePath("ShadowCacheState")
+        self.shadowCacheState.setShaderInput(
+            "activeUpdateMask", self.staticUpdateMaskPTA)
+
+        # Instead of clearing the depth of the updated shadow maps, the
+        # cached depth gets copied to the atlas. This works like the depth
+        # clearers, with a quad which writes the depth of the cache
+        cm = CardMaker("ShadowCacheRestoreQuad")
+        cm.setFrameFullscreenQuad()
+        self.cacheRestoreQuad = NodePath(cm.generate())
+        self.cacheRestoreQuad.setAttrib(
+            DepthTestAttrib.make(RenderAttrib.MAlways))
+        self.cacheRestoreQuad.setDepthWrite(True)
+        self.cacheRestoreQuad.setAttrib(
+            ColorWriteAttrib.make(ColorWriteAttrib.COff))
+        self.cacheRestoreQuad.setShaderInput(
+            "cacheAtlas", self.shadowCacheTarget.getDepthTexture())
+        self.cacheRestoreQuad.setShaderInput("bufferSize", Vec4(
+            self.shadowAtlas.getSize(), self.shadowAtlas.getSize(),
+            1.0 / self.shadowAtlas.getSize(),
+            1.0 / self.shadowAtlas.getSize()))
+        self.cacheRestoreQuad.node().setFinal(True)
+        self.cacheRestoreQuad.node().setBounds(OmniBoundingVolume())
+
+        restoreLens = OrthographicLens()
+        restoreLens.setFilmSize(2, 2)
+        restoreLens.setNearFar(-1000, 1000)
+        restoreCamera = Camera("ShadowCacheRestoreCamera")
+        restoreCamera.setLens(restoreLens)
+        restoreCameraNode = self.cacheRestoreQuad.attachNewNode(restoreCamera)
+
+        self.cacheRestorers = []
+        for i in range(self.maxShadowUpdatesPerFrame):
+            dr = self.shadowComputeTarget.getInternalBuffer().makeDisplayRegion()
+            dr.setSort(-250)
+            dr.disableClears()
+            dr.setCamera(restoreCameraNode)
+            dr.setDimensions(0, 0, 0, 0)
+            dr.setActive(False)
+            self.cacheRestorers.append(dr)
+
+    def _updateCacheTagState(self):
+        """ Internal method to pass the current state of the cache inputs
+        to the cache camera """
+        self.shadowCacheCamera.setTagState(
+            "Default", self.shadowCacheState.getState())
+
+    def setShadowCasterDynamic(self, nodePath):
+        """ Marks a node as dynamic shadow caster. Dynamic casters are not
+        stored in the shadow cache, but rendered each time a shadow map gets
+        updated, and their bounds are updated each frame when culling the
+        shadow casters """
+        if self.shadowCasterCuller is not None:
+            self.shadowCasterCuller.addDynamicRoot(nodePath)
+
+        if self.cacheStaticShadows:
+            nodePath.hide(self.StaticShadowMask)
+            nodePath.showThrough(self.DynamicShadowMask)
+
+    def setShadowCasterStatic(self, nodePath):
+        """ Marks a node as static shadow caster again, after it was marked
+        dynamic with setShadowCasterDynamic """
+        if self.shadowCasterCuller is not None:
+            self.shadowCasterCuller.removeDynamicRoot(nodePath)
+
+        if self.cacheStaticShadows:
+            nodePath.show(self.StaticShadowMask)
+            nodePath.show(self.DynamicShadowMask)
+            self.invalidateStaticShadows(nodePath.getBounds())
+
+    def refreshShadowCasters(self):
+        """ Collects the shadow casters of the scene again, call this after
+        adding or removing geometry when cullShadowCasters is enabled. Casters
+        which were not collected yet get rendered to all shadow maps """
+        if self.shadowCasterCuller is not None:
+            self.shadowCasterCuller.collectCasters()
+
+    def invalidateStaticShadows(self, bounds=None):
+        """ Call this after static geometry changed. Rerenders the cached
+        static casters of all shadow sources whose lens intersects the given
+        world space bounds, or of all sources if no bounds are given """
+        for source in self.shadowSources:
+            if source is None:
+                continue
+            if bounds is None or source.getBounds().contains(bounds):
+                source.invalidate()
 
 
 
     def getAllLights(self):
         """ Returns all attached lights """
-        return self.lights
+        return [light for light in self.lights if light is not None]
+
+    def getSpatialIndex(self):
+        """ Returns the LightSpatialIndex, which can be used to find the
+        lights affecting a region without checking every light """
+        return self.spatialIndex
+
+    def getLightsNear(self, point, radius=0.0):
+        """ Returns all attached lights which affect the sphere around point
+        with the given radius. With a radius of 0 this returns the lights
+        affecting the point. The index is updated in updateLights, so lights
+        changed in the current frame are reported at their old position """
+        return self.spatialIndex.querySphere(point, radius)
 
     def getPCFSampleState(self):
         """ Returns the pcf sample state used to sample the shadow map """
@@ -243,21 +485,22 @@ class LightManager(DebugObject):
     def _initArrays(self):
         """ Inits the light arrays which are passed to the shaders """
 
-        # If you change this, don't forget to change it also in
-        # Shader/Includes/Configuration.include!
+        # The limits are set in pipeline.ini, and passed to the shaders by
+        # RenderingPipeline._generateShaderConfiguration
         self.maxLights = {
-            "PointLight": 16,
-            "DirectionalLight": 1
+            "PointLight": self.settings.maxPointLights,
+            "DirectionalLight": self.settings.maxDirectionalLights
         }
 
         # Max shadow casting lights
         self.maxShadowLights = {
-            "PointLight": 16,
-            "DirectionalLight": 1,
-            "GIHelperLight": 10
+            "PointLight": self.settings.maxShadowPointLights,
+            "DirectionalLight": self.settings.maxShadowDirectionalLights,
+            "GIHelperLight": self.settings.maxShadowGIHelperLights
         }
 
-        self.maxTotalLights = 8
+        self.maxTotalLights = self.settings.maxTotalLights
+        self.maxShadowMaps = self.settings.maxShadowMaps
 
         for lightType, maxCount in self.maxShadowLights.items():
             self.maxLights[lightType + "Shadow"] = maxCount
@@ -278,6 +521,46 @@ class LightManager(DebugObject):
                 lightType + "Shadow"] = PTAInt.emptyArray(maxCount)
             self.numRenderedLights[lightType + "Shadow"] = PTAInt.emptyArray(1)
 
+    def _writeArrayAccessors(self):
+        """ Internal method to write the glsl accessors of the light and
+        shadow source arrays, which are included by the lighting shaders as
+        %LightArray% and %ShadowSourceArray% """
+        accessors = [
+            ("LightArray", self.allLightsArray, "lights", "getLight"),
+            ("ShadowSourceArray", self.allShadowsArray, "shadowSources",
+             "getShadowSource")]
+
+        for name, structArray, uniformName, functionName in accessors:
+            output = "// Autogenerated by LightManager.py\n"
+            output += "// Do not edit! Your changes will be lost.\n\n"
+            output += structArray.generateAccessor(uniformName, functionName)
+
+            try:
+                with open("PipelineTemp/" + name + ".include", "w") as handle:
+                    handle.write(output)
+            except Exception, msg:
+                self.error("Error writing the accessor", name, ":", msg)
+
+    def _checkArrayLimits(self):
+        """ Internal method to check the light limits from pipeline.ini
+        against the limits of the gpu, see SystemAnalyzer """
+        uniformComponents = self.allLightsArray.getUniformComponents() + \
+            self.allShadowsArray.getUniformComponents()
+        for maxCount in self.maxLights.values():
+            uniformComponents += maxCount * 4
+
+        bufferTexels = max(self.allLightsArray.getBufferTexels(),
+                           self.allShadowsArray.getBufferTexels())
+
+        problems = SystemAnalyzer.checkLightLimits(
+            Globals.base.win.getGsg(), uniformComponents, bufferTexels)
+        for problem in problems:
+            self.warn(problem)
+
+        if len(problems) > 0 and not self.settings.packLightData:
+            self.warn("Enable packLightData or reduce the light limits in "
+                      "pipeline.ini")
+
     def setLightingComputator(self, shaderNode):
         """ Sets the render target which recieves the shaderinputs necessary to 
         compute the final lighting result """
@@ -311,10 +594,123 @@ class LightManager(DebugObject):
         """ Returns the shadow map atlas texture"""
         return self.shadowComputeTarget.getDepthTexture()
 
-    def _queueShadowUpdate(self, source):
-        """ Internal method to add a shadowSource to the list of queued updates """
-        if source not in self.queuedShadowUpdates:
-            self.queuedShadowUpdates.append(source)
+    def _queueShadowUpdate(self, source, importance=None):
+        """ Internal method to add a shadowSource to the list of queued
+        updates. When no importance is given, the last importance of the
+        source is used """
+        self.queuedShadowUpdates.push(source, importance)
+
+    def _computeScreenCoverage(self, light):
+        """ Internal method to estimate how much of the screen a light
+        covers, from 0 to 1. Lights without a position (like directional
+        lights) always cover the whole screen. """
+        if light.lightType != LightType.Point:
+            return 1.0
+
+        distance = max(0.01, (light.position - self.cameraPos).length())
+        return min(1.0, light.radius / distance)
+
+    def _computeShadowImportance(self, light, moved):
+        """ Internal method to compute how important it is to update the
+        shadow maps of a light. Lights which cover a big part of the screen
+        and lights which moved are more important. """
+        importance = self._computeScreenCoverage(light) * 10.0
+        if moved:
+            importance += 5.0
+        return importance
+
+    def _updateShadowLOD(self, light):
+        """ Internal method to select the shadow map resolution of a light
+        based on its screen coverage. When the tier changed, the shadow
+        sources are invalidated, and get a new atlas position when they are
+        updated. The resolution is only set on tier changes, so sources
+        which got reduced because the atlas is full keep their size """
+        if not self.shadowLOD.updateTier(
+                light, self._computeScreenCoverage(light)):
+            return
+
+        resolution = self.shadowLOD.getResolution(
+            light, self.shadowAtlas.getTileSize())
+
+        for source in light.getShadowSources():
+            if source.getResolution() != resolution:
+                source.setResolution(resolution)
+                source.invalidate()
+
+    def _reserveAtlasSpace(self, source):
+        """ Internal method to find a position in the shadow atlas for a
+        shadow source. If there is no space, the atlas gets compacted, and
+        when that does not help either, the resolution of the source gets
+        halved until it fits as a last resort. Returns the position in the
+        atlas, or None if no space could be found this frame """
+
+        updateSize = source.getResolution()
+        storePos = self.shadowAtlas.reserveTiles(
+            updateSize, updateSize, source.getUid())
+
+        if storePos:
+            return storePos
+
+        # No space found, try to move other shadow maps to gain space. Only a
+        # limited amount of maps is moved per frame, because each moved map
+        # has to get re-rendered. We retry in the next frame then.
+        if not self.atlasIsCompact:
+            if self._compactAtlas() < 1 and not self.atlasIsCompact:
+                return None
+
+            storePos = self.shadowAtlas.reserveTiles(
+                updateSize, updateSize, source.getUid())
+
+            if storePos or not self.atlasIsCompact:
+                return storePos
+
+        # Still no space found, try to reduce resolution
+        self.warn(
+            "Could not find space for the shadow map of size", updateSize)
+
+        tileSize = self.shadowAtlas.getTileSize()
+        while updateSize > tileSize:
+            updateSize = max(tileSize, updateSize // 2 // tileSize * tileSize)
+            storePos = self.shadowAtlas.reserveTiles(
+                updateSize, updateSize, source.getUid())
+            if storePos:
+                break
+
+        self.warn("The size will be reduced to", updateSize)
+        source.setResolution(updateSize)
+        return storePos
+
+    def _releaseAtlasSpace(self, source):
+        """ Internal method to free the atlas space of a shadow source """
+        if self.shadowAtlas.releaseTiles(source.getUid()):
+            self.atlasIsCompact = False
+        source.removeFromAtlas()
+
+    def _compactAtlas(self):
+        """ Internal method to compact the shadow atlas, moving at most as
+        many shadow maps as are left for this frame. Shadow sources which got
+        moved get their new position assigned and are queued for an update,
+        as their shadow map has to get re-rendered. Returns the number of
+        moved shadow maps """
+
+        if self.atlasMovesLeft < 1:
+            return 0
+
+        moved = self.shadowAtlas.compact(self.atlasMovesLeft)
+        self.atlasMovesLeft -= len(moved)
+
+        if len(moved) < 1:
+            self.atlasIsCompact = True
+            return 0
+
+        for source in self.shadowSources:
+            if source is not None and source.getUid() in moved:
+                source.assignAtlasPos(
+                    *self.shadowAtlas.getAtlasPos(source.getUid()))
+                source.invalidate()
+                self._queueShadowUpdate(source)
+
+        return len(moved)
 
     def addLight(self, light):
         """ Adds a light to the list of rendered lights.
@@ -328,8 +724,27 @@ class LightManager(DebugObject):
             self.warn("Light is already attached!")
             return
 
+        if len(self.freeLightIndices) < 1 and \
+                len(self.lights) >= self.maxTotalLights:
+            self.warn("Can't add light, the maximum of", self.maxTotalLights,
+                      "lights is reached. See maxTotalLights in pipeline.ini")
+            return
+
+        numSources = len(light.getShadowSources()) if light.hasShadows() else 0
+        if len(self.shadowSources) - len(self.freeSourceIndices) + \
+                numSources > self.maxShadowMaps:
+            self.warn("Can't add light, the maximum of", self.maxShadowMaps,
+                      "shadow maps is reached. See maxShadowMaps in "
+                      "pipeline.ini")
+            return
+
         light.attached = True
-        self.lights.append(light)
+
+        # Reuse the index of a removed light if possible
+        if len(self.freeLightIndices) > 0:
+            self.lights[self.freeLightIndices.pop()] = light
+        else:
+            self.lights.append(light)
 
         if light.hasShadows() and not self.settings.renderShadows:
             self.warn("Attached shadow light but shadowing is disabled in pipeline.ini")
@@ -356,20 +771,106 @@ class LightManager(DebugObject):
                 source.resolution = tileSize
 
             if source not in self.shadowSources:
-                self.shadowSources.append(source)
+                if len(self.freeSourceIndices) > 0:
+                    self.shadowSources[self.freeSourceIndices.pop()] = source
+                else:
+                    self.shadowSources.append(source)
 
+            source.attach()
             source.setSourceIndex(self.shadowSources.index(source))
             light.setSourceIndex(index, source.getSourceIndex())
 
         index = self.lights.index(light)
         self.allLightsArray[index] = light
+        self.lightIndices[light] = index
+
+        if light.UpdatedEachFrame:
+            self.alwaysUpdatedLights.append(light)
+        light.setUpdateListener(self._onLightChanged)
 
         light.queueUpdate()
         light.queueShadowUpdate()
 
-    def removeLight(self):
-        """ Removes a light. TODO """
-        raise NotImplementedError()
+    def _onLightChanged(self, light):
+        """ Internal method which gets called by a light when its data
+        changed, adds it to the dirty list of its type """
+        if light.UpdatedEachFrame:
+            return
+        self.dirtyLights.setdefault(light.lightType, []).append(light)
+
+    def removeLight(self, light):
+        """ Removes a light. This frees the atlas space of its shadow
+        sources and detaches their cameras. The array indices of the light
+        and its sources are reused by the next lights added. The light can
+        be added again later """
+
+        if not light.attached or light not in self.lights:
+            self.warn("Light is not attached!")
+            return
+
+        index = self.lights.index(light)
+        self._disableLight(index, light)
+        self.disabledLights.discard(light)
+
+        for sourceIndex, source in enumerate(light.getShadowSources()):
+            self.queuedShadowUpdates.forget(source)
+            if source in self.updateCallbacks:
+                self.updateCallbacks.remove(source)
+
+            globalIndex = source.getSourceIndex()
+            self.shadowSources[globalIndex] = None
+            self.freeSourceIndices.append(globalIndex)
+            del self.allShadowsArray[globalIndex]
+
+            source.detach()
+            source.setSourceIndex(-1)
+            light.setSourceIndex(sourceIndex, -1)
+
+        self.lights[index] = None
+        self.freeLightIndices.append(index)
+        del self.allLightsArray[index]
+
+        del self.lightIndices[light]
+        light.setUpdateListener(None)
+        if light in self.alwaysUpdatedLights:
+            self.alwaysUpdatedLights.remove(light)
+
+        if self.shadowLOD is not None:
+            self.shadowLOD.removeLight(light)
+
+        light.attached = False
+
+    def setLightEnabled(self, light, enabled):
+        """ Enables or disables an attached light. Disabled lights keep
+        their array indices and shader inputs, but are not rendered and free
+        their atlas space. This is cheaper than removing and adding the
+        light again, see LightPool """
+        if enabled == self.isLightEnabled(light):
+            return
+
+        if enabled:
+            self.disabledLights.discard(light)
+            light.queueUpdate()
+            light.queueShadowUpdate()
+        else:
+            self.disabledLights.add(light)
+            self._disableLight(self.lights.index(light), light)
+
+    def isLightEnabled(self, light):
+        """ Returns wheter an attached light is enabled """
+        return light not in self.disabledLights
+
+    def _disableLight(self, index, light):
+        """ Internal method to stop rendering a light and to free the atlas
+        space of its shadow sources """
+        self.frustumCuller.removeLight(index)
+        self.spatialIndex.removeLight(light)
+
+        for source in light.getShadowSources():
+            self.queuedShadowUpdates.remove(source)
+            if source.hasAtlasPos():
+                self._releaseAtlasSpace(source)
+            source.invalidate()
 
     def debugReloadShader(self):
         """ Reloads all shaders. This also updates the camera state """
@@ -379,6 +880,38 @@ class LightManager(DebugObject):
         """ Sets the current camera bounds used for light culling """
         self.cullBounds = bounds
 
+    def setClusteredCulling(self, culler, storage, screenSize):
+        """ Enables the clustered light culling. The lights get assigned to
+        the clusters with the given ClusteredLightCuller each frame, and the
+        result is written to the storage texture, which replaces the tiled
+        culling pass """
+        self.debug("Using clustered light culling with",
+                   culler.numSlices, "depth slices")
+        self.clusterCuller = culler
+        self.clusterStorage = storage
+        self.screenSize = screenSize
+
+    def setCameraMatrices(self, viewMat, projMat):
+        """ Sets the current view and projection matrix of the camera as
+        Panda3D matrices, used for the clustered light culling """
+        if self.clusterCuller is not None:
+            self.clusterCuller.setMatrices(
+                self.clusterCuller.fromPandaMatrix(viewMat),
+                self.clusterCuller.fromPandaMatrix(projMat))
+
+    def _getRenderedTypeName(self, light):
+        """ Internal method to get the name of the list the light gets
+        rendered in, e.g. "PointLightShadow" """
+        lightTypeName = light.getTypeName()
+        if light.hasShadows():
+            lightTypeName += "Shadow"
+        return lightTypeName
+
+    def setCameraPos(self, pos):
+        """ Sets the current camera position, used to prioritize the
+        shadow updates """
+        self.cameraPos = Vec3(pos)
+
     def updateLights(self):
         """ This is one of the two per-frame-tasks. See class description
         to see what it does """
@@ -390,48 +923,80 @@ class LightManager(DebugObject):
         for key in self.numRenderedLights:
             self.numRenderedLights[key][0] = 0
 
-        # Process each light
-        for index, light in enumerate(self.lights):
-
-            # When shadow maps should be always updated
-            if self.settings.alwaysUpdateAllShadows:
-                light.queueShadowUpdate()
+        pstats_PerLightUpdates.start()
+
+        # When shadow maps should be always updated. With the shadow cache,
+        # only the dynamic casters have to be rendered again
+        if self.settings.alwaysUpdateAllShadows:
+            for light in self.lights:
+                if light is None or light in self.disabledLights:
+                    continue
+                if self.cacheStaticShadows:
+                    light.queueDynamicShadowUpdate()
+                else:
+                    light.queueShadowUpdate()
+
+        # Update the lights which have to get updated each frame, and pass
+        # the new bounds to the culler and the spatial index
+        for light in self.alwaysUpdatedLights:
+            if light in self.disabledLights or not light.needsUpdate():
+                continue
+            light.performUpdate()
+            self.frustumCuller.setLight(
+                self.lightIndices[light], light,
+                self._getRenderedTypeName(light))
+            self.spatialIndex.updateLight(light)
 
-            # Update light if required
-            pstats_PerLightUpdates.start()
-            if light.needsUpdate():
-                light.performUpdate()
-            pstats_PerLightUpdates.stop()
+        # Update the changed lights, lights which did not change cost
+        # nothing here
+        dirtyLights = self.dirtyLights
+        self.dirtyLights = {}
+        for lightType in sorted(dirtyLights):
+            self._updateDirtyLights(dirtyLights[lightType])
 
-            # Perform culling
+        pstats_PerLightUpdates.stop()
 
-            pstats_CullLights.start()
-            if not self.cullBounds.contains(light.getBounds()):
-                continue
-            pstats_CullLights.stop()
+        # Perform culling, this checks all lights at once
+        pstats_CullLights.start()
+        visibleLights = self.frustumCuller.cull(self.cullBounds)
+        pstats_CullLights.stop()
 
-            # Queue shadow updates if necessary
-            if light.hasShadows() and light.needsShadowUpdate():
-                neededUpdates = light.performShadowUpdate()
-                for update in neededUpdates:
-                    self._queueShadowUpdate(update)
+        renderedLights = {}
 
-            # Add light to the correct list now
-            lightTypeName = light.getTypeName()
-            if light.hasShadows():
-                lightTypeName += "Shadow"
+        for lightTypeName, visibleIndices in visibleLights.items():
 
-            # Add to array and increment counter
-            oldCount = self.numRenderedLights[lightTypeName][0]
+            if lightTypeName not in self.renderedLightsArrays:
+                continue
 
-            if oldCount >= self.maxLights[lightTypeName]:
+            # Queue shadow updates if necessary
+            if lightTypeName.endswith("Shadow"):
+                for index in visibleIndices:
+                    light = self.lights[index]
+                    if self.shadowLOD is not None:
+                        self._updateShadowLOD(light)
+                    if light.needsShadowUpdate():
+                        importance = self._computeShadowImportance(
+                            light, light.hasMovedSinceShadowUpdate())
+                        neededUpdates = light.performShadowUpdate(
+                            self.cullBounds)
+                        for update in neededUpdates:
+                            self._queueShadowUpdate(update, importance)
+
+            # Add the visible lights to the correct list now
+            maxCount = self.maxLights[lightTypeName]
+            if len(visibleIndices) > maxCount:
                 self.warn("Too many lights of type", lightTypeName,
-                          "-> max is", self.maxLights[lightTypeName])
-                continue
+                          "-> max is", maxCount)
+                visibleIndices = visibleIndices[:maxCount]
 
-            arrayIndex = self.numRenderedLights[lightTypeName][0]
-            self.numRenderedLights[lightTypeName][0] = oldCount + 1
-            self.renderedLightsArrays[lightTypeName][arrayIndex] = index
+            renderedArray = self.renderedLightsArrays[lightTypeName]
+            for arrayIndex, lightIndex in enumerate(visibleIndices):
+                renderedArray[arrayIndex] = int(lightIndex)
+            self.numRenderedLights[lightTypeName][0] = len(visibleIndices)
+            renderedLights[lightTypeName] = visibleIndices
+
+        if self.clusterCuller is not None:
+            self._updateClusters(renderedLights)
 
         pstats_ProcessLights.stop()
 
@@ -451,6 +1016,50 @@ class LightManager(DebugObject):
                 'Lights: ' + renderedPL + " / " + renderedDL + " Shadowed: " + renderedPL_S + " / " + renderedDL_S)
 
 
+    def _updateDirtyLights(self, lights):
+        """ Internal method to update the changed lights of a type, and to
+        pass their bounds to the culler at once """
+        indices = []
+        updatedLights = []
+        typeNames = []
+
+        for light in lights:
+
+            # Light got updated already, e.g. when it was queued twice
+            if not light.dataNeedsUpdate:
+                continue
+
+            # Removed and disabled lights are not updated. Their update gets
+            # discarded, enabling or adding them queues a new one
+            index = self.lightIndices.get(light, None)
+            if index is None or light in self.disabledLights:
+                light.cancelUpdate()
+                continue
+
+            light.performUpdate()
+            self.spatialIndex.updateLight(light)
+            indices.append(index)
+            updatedLights.append(light)
+            typeNames.append(self._getRenderedTypeName(light))
+
+        self.frustumCuller.setLights(indices, updatedLights, typeNames)
+
+    def _updateClusters(self, renderedLights):
+        """ Internal method to assign the rendered lights to the clusters and
+        upload the per cluster light lists """
+        if self.clusterCuller.viewMat is None:
+            return
+
+        pstats_BuildClusters.start()
+        numLights = self.frustumCuller.numLights
+        result = self.clusterCuller.cull(
+            self.screenSize.x, self.screenSize.y,
+            self.frustumCuller.positions[:numLights, 0:3],
+            self.frustumCuller.radii[:numLights], renderedLights)
+        storage = self.clusterCuller.buildStorage(result)
+        self.clusterStorage.setRamImage(storage.tostring())
+        pstats_BuildClusters.stop()
+
     def updateShadows(self):
         """ This is one of the two per-frame-tasks. See class description
         to see what it does """
@@ -459,10 +1068,18 @@ class LightManager(DebugObject):
         for clearer in self.depthClearer:
             clearer.setActive(False)
 
+        staticUpdateMask = 0
+        if self.cacheStaticShadows:
+            for clearer in self.cacheDepthClearer + self.cacheRestorers:
+                clearer.setActive(False)
+            self.shadowCacheTarget.setActive(False)
+            self.staticUpdateMaskPTA[0] = 0
+
         if self.skip > 0:
             self.shadowComputeTarget.setActive(False)
             self.numShadowUpdatesPTA[0] = 0
             self.skip -= 1
+            self._flushArrays()
             return
 
         self.skip = self.skipRate
@@ -485,50 +1102,56 @@ class LightManager(DebugObject):
             # Otherwise enable the buffer
             self.shadowComputeTarget.setActive(True)
 
-            # Check each update in the queue
-            for index, update in enumerate(self.queuedShadowUpdates):
+            # Limit how many shadow maps may get moved in the atlas
+            self.atlasMovesLeft = self.settings.shadowAtlasMaxMovesPerFrame
+            skippedUpdates = []
+            updatedSources = []
 
-                # We only process a limited number of shadow maps
-                if numUpdates >= self.maxShadowUpdatesPerFrame:
-                    break
+            # The updates are limited by the amount of atlas pixels rendered,
+            # so big maps take more of the budget than small maps
+            pixelsLeft = self.settings.shadowUpdatePixelBudget
+            frame = Globals.clock.getFrameCount()
+
+            # Process the most important updates in the queue. We only
+            # process a limited number of shadow maps
+            while len(self.queuedShadowUpdates) > 0 and \
+                    numUpdates < self.maxShadowUpdatesPerFrame:
 
+                update = self.queuedShadowUpdates.peek()
                 updateSize = update.getResolution()
 
+                # Always process at least one update, even if the map is
+                # bigger than the whole budget
+                if numUpdates > 0 and updateSize ** 2 > pixelsLeft:
+                    break
+
+                self.queuedShadowUpdates.pop()
+
+                # Release the atlas space if the resolution changed since
+                # the space got reserved
+                if update.hasAtlasPos() and self.shadowAtlas.getReservedSize(
+                        update.getUid()) != updateSize:
+                    self._releaseAtlasSpace(update)
+
                 # assign position in atlas if not done yet
                 if not update.hasAtlasPos():
 
-                    storePos = self.shadowAtlas.reserveTiles(
-                        updateSize, updateSize, update.getUid())
+                    storePos = self._reserveAtlasSpace(update)
 
                     if not storePos:
-
-                        # No space found, try to reduce resolution
-                        self.warn(
-                            "Could not find space for the shadow map of size", updateSize)
                         self.warn(
-                            "The size will be reduced to", self.shadowAtlas.getTileSize())
-
-                        updateSize = self.shadowAtlas.getTileSize()
-                        update.setResolution(updateSize)
-                        storePos = self.shadowAtlas.reserveTiles(
-                            updateSize, updateSize, update.getUid())
-
-                        if not storePos:
-                            self.fatal(
-                                "Still could not find a shadow atlas position, "
-                                "the shadow atlas is completely full. "
-                                "Either we reduce the resolution of existing shadow maps, "
-                                "increase the shadow atlas resolution, "
-                                "or crash the app. Guess what I decided to do :-P")
+                            "Could not find a shadow atlas position for",
+                            update, "- retrying in the next frame")
+                        skippedUpdates.append(update)
+                        continue
 
                     update.assignAtlasPos(*storePos)
 
+                pixelsLeft -= update.getResolution() ** 2
                 update.update()
 
-                # Store update in array
-                indexInArray = self.shadowSources.index(update)
-                self.allShadowsArray[indexInArray] = update
-                self.updateShadowsArray[index] = update
+                # Stored in the arrays after the loop, all at once
+                updatedSources.append(update)
 
                 # Compute viewport & set depth clearer
                 texScale = float(update.getResolution()) / \
@@ -537,9 +1160,27 @@ class LightManager(DebugObject):
                 atlasPos = update.getAtlasPos()
                 left, right = atlasPos.x, (atlasPos.x + texScale)
                 bottom, top = atlasPos.y, (atlasPos.y + texScale)
-                self.depthClearer[numUpdates].setDimensions(
-                    left, right, bottom, top)
-                self.depthClearer[numUpdates].setActive(True)
+
+                if self.cacheStaticShadows:
+                    # Render the static casters to the cache if required,
+                    # and start with the cached depth instead of clearing
+                    if not update.hasValidStaticCache():
+                        self.cacheDepthClearer[numUpdates].setDimensions(
+                            left, right, bottom, top)
+                        self.cacheDepthClearer[numUpdates].setActive(True)
+                        self.shadowCacheTarget.getInternalRegion()\
+                            .setDimensions(numUpdates + 1,
+                                           (left, right, bottom, top))
+                        staticUpdateMask |= 1 << numUpdates
+                        update.setStaticCacheValid()
+
+                    self.cacheRestorers[numUpdates].setDimensions(
+                        left, right, bottom, top)
+                    self.cacheRestorers[numUpdates].setActive(True)
+                else:
+                    self.depthClearer[numUpdates].setDimensions(
+                        left, right, bottom, top)
+                    self.depthClearer[numUpdates].setActive(True)
 
                 self.shadowComputeTarget.getInternalRegion().setDimensions(
                     numUpdates+1, (atlasPos.x, atlasPos.x + texScale,
@@ -548,6 +1189,7 @@ class LightManager(DebugObject):
 
                 # Finally, we can tell the update it's valid now.
                 update.setValid()
+                self.queuedShadowUpdates.markUpdated(update, frame)
 
                 # In the next frame the update is processed, so call it later
                 self.updateCallbacks.append(update)
@@ -557,19 +1199,44 @@ class LightManager(DebugObject):
                 if self.maxShadowUpdatesPerFrame <= 8:
                     last += str(update.getUid()) + " "
 
-            # Remove all updates which got processed from the list
-            for i in range(numUpdates):
-                self.queuedShadowUpdates.remove(self.queuedShadowUpdates[0])
+            # Store the updates in the arrays
+            self.allShadowsArray.setMany(
+                [source.getSourceIndex() for source in updatedSources],
+                updatedSources)
+            self.updateShadowsArray.setMany(
+                range(len(updatedSources)), updatedSources)
+
+            # Skipped updates stay queued and are retried in the next frame
+            for update in skippedUpdates:
+                self._queueShadowUpdate(update)
 
             self.numShadowUpdatesPTA[0] = numUpdates
 
+            if staticUpdateMask != 0:
+                self.shadowCacheTarget.setActive(True)
+                self.staticUpdateMaskPTA[0] = staticUpdateMask
+
+            # Only submit the casters which are visible in an update
+            if self.shadowCasterCuller is not None and numUpdates > 0:
+                self.shadowCasterCuller.cull(updatedSources)
+
         last += "]"
 
+        self._flushArrays()
+
         # Generate debug text
         if self.lightsUpdatedDebugText is not None:
             self.lightsUpdatedDebugText.setText(
                 'Queued Updates: ' + str(numUpdates) + "/" + str(queuedUpdateLen) + "/" + str(len(self.shadowSources)) + ", Last: " + last + ", Free Tiles: " + str(self.shadowAtlas.getFreeTileCount()) + "/" + str(self.shadowAtlas.getTotalTileCount()))
 
+    def _flushArrays(self):
+        """ Writes the changes of this frame to the struct arrays. The
+        arrays defer all writes until they get flushed, so this has to be
+        called once per frame """
+        self.allLightsArray.flush()
+        self.allShadowsArray.flush()
+        self.updateShadowsArray.flush()
+
     # Main update
     def update(self):
         self.updateLights()
@@ -0,0 +1,78 @@
+
+from DebugObject import DebugObject
+from PointLight import PointLight
+
+
+class LightPool(DebugObject):
+
+    """ This class hands out preconfigured lights for short-lived effects,
+    like muzzle flashes or explosions. All lights of the pool are created
+    and attached to the LightManager once, and then only get enabled and
+    disabled, so acquiring a light needs no allocation and does not rebind
+    the shader inputs.
+
+    Example:
+
+        def setupFlash(light):
+            light.setRadius(15.0)
+            light.setColor(Vec3(1, 0.8, 0.5))
+
+        pool = LightPool(pipeline.getLightManager(), 8, setupFlash)
+
+        light = pool.acquire()
+        light.setPos(muzzlePos)
+        ...
+        pool.release(light)
+
+    A released light keeps its last position and color, so acquire should
+    always be followed by setting the properties which differ per use. """
+
+    def __init__(self, lightManager, size, setupFunc=None,
+                 lightClass=PointLight):
+        """ Creates size lights of the type lightClass, passes each to
+        setupFunc to configure it, and attaches it to the lightManager """
+        DebugObject.__init__(self, "LightPool")
+        self.lightManager = lightManager
+        self.freeLights = []
+        self.usedLights = set()
+
+        for i in xrange(size):
+            light = lightClass()
+            if setupFunc is not None:
+                setupFunc(light)
+            lightManager.addLight(light)
+            lightManager.setLightEnabled(light, False)
+            self.freeLights.append(light)
+
+    def acquire(self):
+        """ Returns a free light of the pool and enables it, or None if all
+        lights are in use """
+        if len(self.freeLights) < 1:
+            self.warn("All", len(self.usedLights), "lights are in use!")
+            return None
+
+        light = self.freeLights.pop()
+        self.usedLights.add(light)
+        self.lightManager.setLightEnabled(light, True)
+        return light
+
+    def release(self, light):
+        """ Returns a light to the pool and disables it """
+        if light not in self.usedLights:
+            self.warn("Light does not belong to the pool or is not in use")
+            return
+
+        self.usedLights.remove(light)
+        self.lightManager.setLightEnabled(light, False)
+        self.freeLights.append(light)
+
+    def getNumFree(self):
+        """ Returns the amount of lights which can be acquired """
+        return len(self.freeLights)
+
+    def destroy(self):
+        """ Removes all lights of the pool from the LightManager """
+        for light in self.freeLights + list(self.usedLights):
+            self.lightManager.removeLight(light)
+        self.freeLights = []
+        self.usedLights = set()
@@ -0,0 +1,186 @@
+
+import math
+
+from panda3d.core import Vec3, BoundingSphere, Point3
+
+from DebugObject import DebugObject
+from LightType import LightType
+
+
+class LightSpatialIndex(DebugObject):
+
+    """ This class stores the lights in a uniform grid, so questions like
+    "which lights affect this region" can be answered without checking
+    every light. The LightManager keeps the index up to date, each time a
+    light got updated (e.g. after setPos or setRadius) it is moved to the
+    cells it now overlaps. When the light still overlaps the same cells,
+    nothing has to be done.
+
+    Each point light is stored in every cell its bounding box overlaps.
+    Lights which would span more than maxCellsPerLight cells are stored
+    in a separate list which is checked on each query, the same goes for
+    lights without position, like directional lights, which affect
+    everything. """
+
+    def __init__(self, cellSize=16.0, maxCellsPerLight=512):
+        """ Creates a new index. cellSize is the size of a grid cell in
+        world space units """
+        DebugObject.__init__(self, "LightSpatialIndex")
+        self.cellSize = float(cellSize)
+        self.maxCellsPerLight = maxCellsPerLight
+        self.cells = {}
+        self.lightCells = {}
+        self.oversized = set()
+        self.unbounded = set()
+
+    def addLight(self, light):
+        """ Adds a light to the index """
+        self.updateLight(light)
+
+    def removeLight(self, light):
+        """ Removes a light from the index """
+        self._unlink(light)
+        self.lightCells.pop(light, None)
+
+    def updateLight(self, light):
+        """ Moves the light to the cells it currently overlaps. Call this
+        after the position or radius of the light changed """
+
+        if light.lightType != LightType.Point:
+            cellRange = "unbounded"
+        else:
+            radius = Vec3(light.radius)
+            cellRange = self._getCellRange(
+                light.position - radius, light.position + radius)
+
+            if self._countCells(cellRange) > self.maxCellsPerLight:
+                cellRange = "oversized"
+
+        # Light still overlaps the same cells, nothing to do
+        if self.lightCells.get(light, None) == cellRange:
+            return
+
+        self._unlink(light)
+        self.lightCells[light] = cellRange
+
+        if cellRange == "unbounded":
+            self.unbounded.add(light)
+        elif cellRange == "oversized":
+            self.oversized.add(light)
+        else:
+            for cell in self._iterateCells(cellRange):
+                self.cells.setdefault(cell, set()).add(light)
+
+    def getNumLights(self):
+        """ Returns the amount of lights stored in the index """
+        return len(self.lightCells)
+
+    def queryPoint(self, point):
+        """ Returns all lights which affect the given point """
+        return self.querySphere(point, 0.0)
+
+    def querySphere(self, center, radius):
+        """ Returns all lights which intersect the sphere with the given
+        center and radius, e.g. all lights near a point """
+        center = Vec3(center)
+        radius = Vec3(radius)
+        candidates = self._collectCandidates(center - radius, center + radius)
+
+        result = list(self.unbounded)
+        for light in candidates:
+            maxDist = light.radius + radius.x
+            if (light.position - center).lengthSquared() <= maxDist * maxDist:
+                result.append(light)
+        return result
+
+    def queryAABB(self, minPoint, maxPoint):
+        """ Returns all lights which intersect the axis aligned box given by
+        minPoint and maxPoint """
+        candidates = self._collectCandidates(Vec3(minPoint), Vec3(maxPoint))
+
+        result = list(self.unbounded)
+        for light in candidates:
+            # Find the closest point of the box to the light
+            distSq = 0.0
+            for axis in xrange(3):
+                coord = light.position[axis]
+                if coord < minPoint[axis]:
+                    distSq += (minPoint[axis] - coord) ** 2
+                elif coord > maxPoint[axis]:
+                    distSq += (coord - maxPoint[axis]) ** 2
+
+            if distSq <= light.radius * light.radius:
+                result.append(light)
+        return result
+
+    def queryFrustum(self, bounds):
+        """ Returns all lights which intersect the given bounding volume,
+        usually the BoundingHexahedron of a camera """
+        candidates = self._collectCandidates(
+            Vec3(bounds.getMin()), Vec3(bounds.getMax()))
+
+        result = list(self.unbounded)
+        for light in candidates:
+            if bounds.contains(
+                    BoundingSphere(Point3(light.position), light.radius)):
+                result.append(light)
+        return result
+
+    def _collectCandidates(self, minPoint, maxPoint):
+        """ Internal method to collect all lights in the cells overlapped by
+        the given box, plus the oversized lights """
+        cellRange = self._getCellRange(minPoint, maxPoint)
+        candidates = set(self.oversized)
+
+        # When the box is bigger than the occupied part of the grid, it is
+        # faster to check the occupied cells instead
+        if self._countCells(cellRange) > len(self.cells):
+            (minX, minY, minZ), (maxX, maxY, maxZ) = cellRange
+            for (x, y, z), lights in self.cells.iteritems():
+                if minX <= x <= maxX and minY <= y <= maxY and \
+                        minZ <= z <= maxZ:
+                    candidates.update(lights)
+        else:
+            for cell in self._iterateCells(cellRange):
+                if cell in self.cells:
+                    candidates.update(self.cells[cell])
+
+        return candidates
+
+    def _unlink(self, light):
+        """ Internal method to remove a light from all cells """
+        cellRange = self.lightCells.get(light, None)
+
+        if cellRange is None:
+            return
+        elif cellRange == "unbounded":
+            self.unbounded.discard(light)
+        elif cellRange == "oversized":
+            self.oversized.discard(light)
+        else:
+            for cell in self._iterateCells(cellRange):
+                lights = self.cells[cell]
+                lights.discard(light)
+                if len(lights) < 1:
+                    del self.cells[cell]
+
+    def _getCellRange(self, minPoint, maxPoint):
+        """ Internal method to compute the range of cells overlapped by
+        a box """
+        toCell = lambda v: int(math.floor(v / self.cellSize))
+        return (
+            (toCell(minPoint.x), toCell(minPoint.y), toCell(minPoint.z)),
+            (toCell(maxPoint.x), toCell(maxPoint.y), toCell(maxPoint.z)))
+
+    def _countCells(self, cellRange):
+        """ Internal method to compute the number of cells in a range """
+        (minX, minY, minZ), (maxX, maxY, maxZ) = cellRange
+        return (maxX - minX + 1) * (maxY - minY + 1) * (maxZ - minZ + 1)
+
+    def _iterateCells(self, cellRange):
+        """ Internal method to iterate over all cells in a range """
+        (minX, minY, minZ), (maxX, maxY, maxZ) = cellRange
+        for x in xrange(minX, maxX + 1):
+            for y in xrange(minY, maxY + 1):
+                for z in xrange(minZ, maxZ + 1):
+                    yield (x, y, z)
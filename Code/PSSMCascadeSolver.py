@@ -0,0 +1,190 @@
+
+from DebugObject import DebugObject
+
+# NumPy is optional, without it the DirectionalLight computes the splits
+# one by one
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PSSMCascadeSolver(DebugObject):
+
+    """ This class computes the PSSM splits of a DirectionalLight. All splits
+    are computed at once with NumPy: The split distances, the position and
+    film size of the shadow camera of each split, and the view projection
+    matrix of each split.
+
+    The shadow cameras of all splits share the same orientation, only their
+    position and film size differ. To prevent shimmering shadow edges, the
+    camera positions can be snapped to the texel grid of the shadow map in
+    light space. Then the position only changes when the camera moved at
+    least one texel, and findMovedSplits tells which splits have to be
+    repositioned.
+
+    Conventions:
+        - Points are arrays of the shape (..., 3) in world space
+        - Panda3D matrices are converted with fromPandaMatrix, and applied
+          to row vectors like in Panda3D
+        - The light basis is a 3x3 array with the right, forward and up
+          vector of the shadow cameras as rows
+        - The view projection matrices are 4x4 arrays applied to column
+          vectors, like in GLSL, mapping to the OpenGL clip space """
+
+    # Distance of the shadow cameras from the center of their split, along
+    # the light direction
+    SourceDistance = 300.0
+
+    # Film size of a split, relative to the radius of the split
+    FilmSizeFactor = 1.41
+
+    # Relative change of the film size which is ignored by
+    # stabilizeFilmSizes
+    FilmSizeTolerance = 0.001
+
+    def __init__(self, splitCount=4, near=5.0, far=1000.0):
+        """ Creates a new solver. near and far are the near and far plane of
+        the orthographic lenses of the shadow cameras """
+        DebugObject.__init__(self, "PSSMCascadeSolver")
+
+        if numpy is None:
+            self.error("NumPy is required for the PSSMCascadeSolver!")
+
+        self.splitCount = splitCount
+        self.near = near
+        self.far = far
+        self.lastPositions = None
+        self.lastFilmSizes = None
+        self.stableFilmSizes = None
+
+    @staticmethod
+    def fromPandaMatrix(mat):
+        """ Converts a Panda3D LMatrix4 to a NumPy array, which is applied to
+        row vectors like the Panda3D matrix """
+        return numpy.array(
+            [[mat.getCell(row, col) for col in xrange(4)]
+             for row in xrange(4)], dtype=numpy.float64)
+
+    @staticmethod
+    def computeFrustumPoints(camMat, projMatInv):
+        """ Computes the world space points of the camera frustum which are
+        used to compute the splits, equivalent to Lens.extrude on the film
+        center and the top right film corner. camMat is the transform of the
+        camera relative to render, projMatInv the inverse projection matrix
+        of its lens, both converted with fromPandaMatrix. Returns an array
+        with the near and far center point and the near and far corner
+        point """
+        filmPoints = numpy.array([
+            [0.0, 0.0, -1.0, 1.0],
+            [0.0, 0.0, 1.0, 1.0],
+            [1.0, 1.0, -1.0, 1.0],
+            [1.0, 1.0, 1.0, 1.0]])
+        points = filmPoints.dot(projMatInv)
+        points = points / points[:, 3:4]
+        return points.dot(camMat)[:, 0:3]
+
+    def computeSplitParameters(self, splitPow, relativeSplitSize):
+        """ Computes where each split starts and ends, relative to the far
+        plane of the camera. Returns two arrays of the size splitCount """
+        exponents = (numpy.arange(self.splitCount + 1) + 0.5) / \
+            (self.splitCount + 0.5)
+        params = (exponents ** splitPow) * relativeSplitSize
+        return params[:-1], params[1:]
+
+    def solve(self, frustumPoints, cameraPos, direction, splitPow,
+              relativeSplitSize):
+        """ Computes the center of each split and the film size of its shadow
+        camera. frustumPoints is the result of computeFrustumPoints,
+        cameraPos is added to the split centers. Returns the split centers,
+        the positions of the shadow cameras and the film sizes """
+        nearPoint, farPoint, cornerNear, cornerFar = frustumPoints
+        starts, ends = self.computeSplitParameters(
+            splitPow, relativeSplitSize)
+
+        centerParams = (starts + ends) * 0.5
+        centers = nearPoint + centerParams[:, None] * (farPoint - nearPoint)
+        corners = cornerNear + ends[:, None] * (cornerFar - cornerNear)
+
+        filmSizes = numpy.sqrt(((corners - centers) ** 2).sum(axis=1)) * \
+            self.FilmSizeFactor
+
+        centers = centers + numpy.asarray(cameraPos, dtype=numpy.float64)
+        positions = centers + \
+            numpy.asarray(direction, dtype=numpy.float64) * \
+            self.SourceDistance
+
+        return centers, positions, filmSizes
+
+    def stabilizeFilmSizes(self, filmSizes):
+        """ The film sizes only depend on the camera lens, but rounding
+        errors make them differ slightly each frame. This returns the
+        previous film size for each split whose film size changed less than
+        FilmSizeTolerance, so the texel size stays the same """
+        if self.stableFilmSizes is None or \
+                len(self.stableFilmSizes) != len(filmSizes):
+            self.stableFilmSizes = filmSizes.copy()
+            return filmSizes
+
+        changed = numpy.abs(filmSizes - self.stableFilmSizes) > \
+            filmSizes * self.FilmSizeTolerance
+        self.stableFilmSizes[changed] = filmSizes[changed]
+        return self.stableFilmSizes.copy()
+
+    def snapToTexels(self, positions, filmSizes, basis, resolution):
+        """ Moves the shadow cameras so the world origin is always on a texel
+        corner of each shadow map, by rounding the position along the right
+        and up vector of the light to multiples of the texel size in world
+        space. Returns the new positions """
+        texelSizes = filmSizes / float(resolution)
+        lateral = basis[[0, 2]]
+        coords = positions.dot(lateral.T)
+        snapped = numpy.floor(coords / texelSizes[:, None] + 0.5) * \
+            texelSizes[:, None]
+        return positions + (snapped - coords).dot(lateral)
+
+    def computeViewProjections(self, positions, filmSizes, basis):
+        """ Computes the view projection matrix of each shadow camera. Returns
+        an array of the shape (splitCount, 4, 4) """
+        right, forward, up = basis
+        depthRange = self.far - self.near
+        scale = 2.0 / filmSizes
+
+        result = numpy.zeros((len(positions), 4, 4))
+        result[:, 0, 0:3] = right * scale[:, None]
+        result[:, 0, 3] = -positions.dot(right) * scale
+        result[:, 1, 0:3] = up * scale[:, None]
+        result[:, 1, 3] = -positions.dot(up) * scale
+        result[:, 2, 0:3] = forward * (2.0 / depthRange)
+        result[:, 2, 3] = -(positions.dot(forward) + self.near) * \
+            (2.0 / depthRange) - 1.0
+        result[:, 3, 3] = 1.0
+        return result
+
+    def findMovedSplits(self, positions, filmSizes, resolution):
+        """ Returns a boolean array which stores for each split wheter its
+        shadow camera moved by at least half a texel or its film size
+        changed since the last call. Snapped positions change by whole
+        texels, so this only skips updates which would not change the
+        shadow map """
+        if self.lastPositions is None or \
+                len(self.lastPositions) != len(positions):
+            self.lastPositions = positions.copy()
+            self.lastFilmSizes = filmSizes.copy()
+            return numpy.ones(len(positions), dtype=bool)
+
+        threshold = filmSizes / float(resolution) * 0.5
+        distances = numpy.abs(positions - self.lastPositions).max(axis=1)
+        moved = (distances >= threshold) | (filmSizes != self.lastFilmSizes)
+
+        # Only remember the positions which are actually used, so slow
+        # movements still add up to a texel
+        self.lastPositions[moved] = positions[moved]
+        self.lastFilmSizes[moved] = filmSizes[moved]
+        return moved
+
+    def reset(self):
+        """ Forgets the last positions, so all splits are reported as moved
+        in the next call to findMovedSplits """
+        self.lastPositions = None
+        self.lastFilmSizes = None
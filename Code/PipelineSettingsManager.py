@@ -27,6 +27,15 @@ class PipelineSettingsManager(SettingsManager):
         self._addSetting("useSimpleLighting", bool, False)
         self._addSetting("anyLightBoundCheck", bool, True)
         self._addSetting("accurateLightBoundCheck", bool, True)
+        self._addSetting("lightCullingTechnique", str, "Tiled")
+        self._addSetting("clusterDepthSlices", int, 16)
+        self._addSetting("packLightData", bool, False)
+        self._addSetting("maxTotalLights", int, 8)
+        self._addSetting("maxPointLights", int, 16)
+        self._addSetting("maxShadowPointLights", int, 16)
+        self._addSetting("maxDirectionalLights", int, 1)
+        self._addSetting("maxShadowDirectionalLights", int, 1)
+        self._addSetting("maxShadowGIHelperLights", int, 10)
         self._addSetting("defaultReflectionCubemap", str, "Default-0/#.png")
         self._addSetting("ambientCubemapSamples", int, 16)
 
@@ -40,13 +49,22 @@ class PipelineSettingsManager(SettingsManager):
         # [Shadows]
         self._addSetting("renderShadows", bool, True)
         self._addSetting("shadowAtlasSize", int, 8192)
+        self._addSetting("maxShadowMaps", int, 24)
         self._addSetting("shadowCascadeBorderPercentage", float, 0.1)       
         self._addSetting("maxShadowUpdatesPerFrame", int, 2)
+        self._addSetting("shadowUpdatePixelBudget", int, 2048 * 2048 * 2)
+        self._addSetting("shadowAtlasMaxMovesPerFrame", int, 1)
         self._addSetting("numPCFSamples", int, 64)
         self._addSetting("numPCSSSearchSamples", int, 32)
         self._addSetting("numPCSSFilterSamples", int, 64)
         self._addSetting("useHardwarePCF", bool, False)
         self._addSetting("alwaysUpdateAllShadows", bool, False)
+        self._addSetting("cacheStaticShadows", bool, False)
+        self._addSetting("cullShadowCasters", bool, False)
+        self._addSetting("shadowLOD", bool, False)
+        self._addSetting("shadowLODTiers", int, 4)
+        self._addSetting("shadowLODFullCoverage", float, 0.5)
+        self._addSetting("shadowLODHysteresis", float, 0.25)
 
         # [Motion blur]
         self._addSetting("motionBlurEnabled", bool, True)
@@ -60,6 +78,9 @@ class PipelineSettingsManager(SettingsManager):
         self._addSetting("displayOnscreenDebugger", bool, False)
         self._addSetting("displayDebugStats", bool, True)
         self._addSetting("dumpGeneratedShaders", bool, False)
+        self._addSetting("useShaderCache", bool, True)
+        self._addSetting("hotReloadShaders", bool, False)
+        self._addSetting("shaderReloadInterval", float, 0.5)
 
         self._addSetting("enableTemporalReprojection", bool, False)
         self._addSetting("enableScattering", bool, False)
@@ -6,6 +6,7 @@ from panda3d.core import OmniBoundingVolume
 from Light import Light
 from DebugObject import DebugObject
 from LightType import LightType
+from PointShadowMode import PointShadowMode
 from ShadowSource import ShadowSource
 from Globals import Globals
 
@@ -16,27 +17,33 @@ class PointLight(Light, DebugObject):
     and a radius. The attenuation is computed based on a quadratic
     function.
 
-    Shadows are simulated using 2 Parabolic maps. So this light has
-    2 Shadow maps, and when calling setShadowMapResolution() you are
-    actually setting the resolution for both maps. This is still
-    cheaper than a cubemap, though, while mainting almost the same
-    quality.
-
-    Both shadow cameras are a bit displaced (by self.spacing),
-    as a parabolic map does not cover a full 180 degree view. Also,
-    the farPlane of both sources is shifted by self.bufferRadius,
-    because the precision is really bad near the outer radius.
+    Shadows are simulated using a cubemap with 6 shadow maps by default.
+    The projection can be changed with setShadowMode, see PointShadowMode:
+    With 2 paraboloid maps, the light needs only a third of the atlas space
+    and shadow updates, and with visible faces only the faces which can be
+    seen from the camera get rendered. When calling setShadowMapResolution()
+    you are setting the resolution of each of the maps.
 
     TODO: Add impostor support. """
 
+    # Directions of the shadow sources of the cube modes, in the order of
+    # the faces of the direction lookup cubemap
+    CubeDirections = [
+        Vec3(-1, 0, 0),
+        Vec3(1, 0, 0),
+        Vec3(0, -1, 0),
+        Vec3(0, 1, 0),
+        Vec3(0, 0, -1),
+        Vec3(0, 0, 1),
+    ]
+
     def __init__(self):
         """ Creates a new point light. Remember to set a position
         and a radius """
         Light.__init__(self)
         DebugObject.__init__(self, "PointLight")
-        self.spacing = 0.5
-        self.bufferRadius = 0.0
         self.typeName = "PointLight"
+        self.shadowMode = PointShadowMode.Cube
 
     def _getLightType(self):
         """ Internal method to fetch the type of this light, used by Light """
@@ -44,12 +51,50 @@ class PointLight(Light, DebugObject):
 
     def _computeLightBounds(self):
         """ Recomputes the bounds of this light. For a PointLight, this
-        is simple, as it's only a BoundingSphere """
-        self.bounds = BoundingSphere(Point3(self.position), self.radius)
+        is simple, as it's only a BoundingSphere. The LightManager only needs
+        the position and radius, so the sphere is created when requested """
+        self.bounds = None
+
+    def getBounds(self):
+        """ Returns the bounds of this light for culling """
+        if self.bounds is None:
+            self.bounds = BoundingSphere(Point3(self.position), self.radius)
+        return self.bounds
 
     def _computeAdditionalData(self):
         """ PointLight does not need to store additional data """
 
+    def setShadowMode(self, mode):
+        """ Sets the shadow projection, one of the PointShadowMode values.
+        Like the resolution, this cannot be changed after the light got
+        attached, as the number of shadow sources changes """
+        if self.attached:
+            raise Exception(
+                "You cannot change the shadow mode after the light got attached")
+        self.shadowMode = mode
+
+        if self.castShadows:
+            self._releaseShadowSources()
+            self._initShadowSources()
+
+    def getShadowMode(self):
+        """ Returns the shadow projection, see setShadowMode """
+        return self.shadowMode
+
+    def _isShadowSourceVisible(self, index, cullBounds):
+        """ With visible faces only, skips the faces which can not be seen
+        from the camera. The face is tested with the bounding sphere of the
+        part of the light sphere it covers """
+        if self.shadowMode != PointShadowMode.VisibleFaces or \
+                cullBounds is None:
+            return True
+
+        halfRadius = self.radius * 0.866
+        faceBounds = BoundingSphere(
+            Point3(self.position) + self.CubeDirections[index] * halfRadius,
+            halfRadius)
+        return bool(cullBounds.contains(faceBounds))
+
     def _updateDebugNode(self):
         """ Internal method to generate new debug geometry. """
         mainNode = NodePath("DebugNodeInner")
@@ -83,12 +128,13 @@ class PointLight(Light, DebugObject):
 
     def _initShadowSources(self):
         """ Internal method to init the shadow sources """
-        # for i in range(2):
-        #     source = ShadowSource()
-        #     source.setupPerspectiveLens(
-        #         self.spacing, self.radius + self.spacing + self.bufferRadius, (160, 160))
-        #     source.setResolution(self.shadowResolution)
-        #     self._addShadowSource(source)
+        if self.shadowMode == PointShadowMode.DualParaboloid:
+            for i in range(2):
+                source = ShadowSource()
+                source.setupParaboloidLens(1.0, self.radius)
+                source.setResolution(self.shadowResolution)
+                self._addShadowSource(source)
+            return
 
         for i in range(6):
             source = ShadowSource()
@@ -98,31 +144,22 @@ class PointLight(Light, DebugObject):
             self._addShadowSource(source)
 
     def _updateShadowSources(self):
-        """ Recomputes the position of the shadow sources. One
-        Source is facing to +x, and the other one to -x. This
-        gives a 360 degree view. """
-
-        cubemapDirections = [
-            Vec3(-1, 0, 0),
-            Vec3(1, 0, 0),
-            Vec3(0, -1, 0),
-            Vec3(0, 1, 0),
-            Vec3(0, 0, -1),
-            Vec3(0, 0, 1),
-        ]
-
-        for index, direction in enumerate(cubemapDirections):
+        """ Recomputes the position of the shadow sources. In the cube
+        modes, each source faces along one of the CubeDirections. With dual
+        paraboloid maps, one source is facing to +y, and the other one to
+        -y. This gives a 360 degree view. """
+
+        if self.shadowMode == PointShadowMode.DualParaboloid:
+            self.shadowSources[0].setPos(self.position)
+            self.shadowSources[0].setHpr(Vec3(0, 0, 0))
+            self.shadowSources[1].setPos(self.position)
+            self.shadowSources[1].setHpr(Vec3(180, 0, 0))
+            return
+
+        for index, direction in enumerate(self.CubeDirections):
             self.shadowSources[index].setPos(self.position)
             self.shadowSources[index].lookAt(self.position + direction)
 
-        # self.shadowSources[0].setPos(
-        #     self.position + Vec3(0, self.spacing * 2.0, 0))
-        # self.shadowSources[0].setHpr(Vec3(180, 0, 0))
-
-        # self.shadowSources[1].setPos(
-        #     self.position - Vec3(0, self.spacing * 2.0, 0))
-        # self.shadowSources[1].setHpr(Vec3(0, 0, 0))
-
     def __repr__(self):
         """ Generates a string representation of this instance """
         # return "PointLight[pos=" + str(self.position) + ", radius=" +
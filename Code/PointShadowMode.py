@@ -0,0 +1,21 @@
+class PointShadowMode:
+
+    """ This stores the possible shadow projections of a PointLight, see
+    PointLight.setShadowMode. Python does not support enums (yet), so this
+    is a class.
+
+    Cube: 6 perspective shadow maps, one for each cubemap face.
+
+    DualParaboloid: 2 shadow maps with a paraboloid projection, each covering
+    a hemisphere. This needs only a third of the atlas space and shadow
+    updates of a cube, but the projection is done per vertex, so big
+    triangles get distorted.
+
+    VisibleFaces: Like Cube, but only the faces which can be seen from the
+    camera get rendered. Faces which were never visible use no atlas space.
+    Faces which leave the view keep their atlas space and shadow map, so
+    they don't have to be rendered again when they come back into view. """
+
+    Cube = 0
+    DualParaboloid = 1
+    VisibleFaces = 2
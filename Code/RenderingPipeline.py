@@ -23,6 +23,9 @@ from Globals import Globals
 from SystemAnalyzer import SystemAnalyzer
 from MountManager import MountManager
 from Scattering import Scattering
+from ClusteredLightCuller import ClusteredLightCuller, numpy
+from ShaderCache import ShaderCache
+from ShaderWatcher import ShaderWatcher
 
 class RenderingPipeline(DebugObject):
 
@@ -83,6 +86,7 @@ class RenderingPipeline(DebugObject):
         self.showbase = showbase
         self.settings = None
         self.mountManager = MountManager()
+        self.shaderWatcher = None
 
     def getMountManager(self):
         """ Returns the mount manager. You can use this to set the
@@ -126,6 +130,9 @@ class RenderingPipeline(DebugObject):
         # Setting up shader loading
         BetterShader._DumpShaders = self.settings.dumpGeneratedShaders
 
+        if self.settings.useShaderCache:
+            BetterShader._DiskCache = ShaderCache()
+
         # We use PTA's for shader inputs, because that's faster than
         # using setShaderInput
         self.temporalProjXOffs = PTAInt.emptyArray(1)
@@ -169,6 +176,18 @@ class RenderingPipeline(DebugObject):
         # Not as good as I want it, so disabled. I'll work on it.
         self.blurEnabled = False
 
+        # Check which technique is used to assign the lights to the screen
+        self.useClusteredCulling = False
+        technique = self.settings.lightCullingTechnique
+        if technique == "Clustered":
+            if numpy is None:
+                self.error("Clustered light culling requires NumPy!")
+                self.error("Falling back to tiled light culling")
+            else:
+                self.useClusteredCulling = True
+        elif technique != "Tiled":
+            self.error("Unknown light culling technique:", technique)
+
         self.debug("Window size is", self.size.x, "x", self.size.y)
 
         self.showbase.camLens.setNearFar(0.1, 50000)
@@ -255,8 +274,17 @@ class RenderingPipeline(DebugObject):
         self.lastPixelShift = PTAVecBase2f.emptyArray(1)
 
         self._setupFinalPass()
+
+        # The watcher has to know the stages before the shaders get loaded,
+        # so it can record the files they use
+        if self.settings.hotReloadShaders:
+            self._setupShaderWatcher()
+
         self._setShaderInputs()
 
+        if self.shaderWatcher is not None:
+            self.shaderWatcher.start()
+
         # Give the gui a hint when the pipeline is done loading
         if self.settings.displayOnscreenDebugger:
             self.guiManager.onPipelineLoaded()
@@ -359,9 +387,16 @@ class RenderingPipeline(DebugObject):
 
     def _makeLightPerTileStorage(self):
         """ Creates a texture to store the lights per tile into. Should
-        get replaced with ssbos later """
+        get replaced with ssbos later. When using clustered culling, the
+        texture stores the lights per cluster, and gets filled by the
+        LightManager """
         storageSizeX = self.precomputeSize.x * 8
         storageSizeY = self.precomputeSize.y * 8
+        componentType = Texture.TUnsignedShort
+
+        if self.useClusteredCulling:
+            storageSizeY *= self.settings.clusterDepthSlices
+            componentType = Texture.TInt
 
         self.debug(
             "Creating per tile storage of size",
@@ -369,7 +404,7 @@ class RenderingPipeline(DebugObject):
 
         self.lightPerTileStorage = Texture("LightsPerTile")
         self.lightPerTileStorage.setup2dTexture(
-            storageSizeX, storageSizeY, Texture.TUnsignedShort, Texture.FR32i)
+            storageSizeX, storageSizeY, componentType, Texture.FR32i)
         self.lightPerTileStorage.setMinfilter(Texture.FTNearest)
         self.lightPerTileStorage.setMagfilter(Texture.FTNearest)
 
@@ -417,6 +452,18 @@ class RenderingPipeline(DebugObject):
         self.lightManager.setLightingComputator(self.lightingComputeContainer)
         self.lightManager.setLightingCuller(self.lightBoundsComputeBuff)
 
+        # With clustered culling, the light manager fills the storage, so
+        # the tiled culling pass is not required
+        if self.useClusteredCulling:
+            clusterCuller = ClusteredLightCuller(
+                patchSizeX=self.patchSize.x, patchSizeY=self.patchSize.y,
+                numSlices=self.settings.clusterDepthSlices,
+                near=self.showbase.camLens.getNear(),
+                far=self.showbase.camLens.getFar())
+            self.lightManager.setClusteredCulling(
+                clusterCuller, self.lightPerTileStorage, self.size)
+            self.lightBoundsComputeBuff.setActive(False)
+
         self._loadFallbackCubemap()
         self._loadLookupCubemap()
 
@@ -790,33 +837,79 @@ class RenderingPipeline(DebugObject):
             self.showbase.win.getYSize())
 
     def reloadShaders(self):
-        """ Reloads all shaders """
+        """ Reloads all shaders. Only the shaders which depend on a changed
+        file get preprocessed again """
+
+        changedShaders = BetterShader.reloadChangedFiles()
+        if len(changedShaders) > 0:
+            self.debug("Reloading", len(changedShaders), "changed shaders")
+            BetterShader.preprocessFiles(changedShaders)
+
+        for name, reloadFunc in self._getShaderStages():
+            if self.shaderWatcher is not None:
+                self.shaderWatcher.loadStage(name)
+            else:
+                reloadFunc()
+
+    def _getShaderStages(self):
+        """ Returns a list of (name, function) for each part of the pipeline
+        which loads shaders. Calling the function (re)loads and sets the
+        shaders of that part """
+        stages = []
 
         if self.haveLightingPass:
-            self.lightManager.debugReloadShader()
-            self._setPositionComputationShader()
-            self._setLightingShader()
+            stages += [
+                ("LightManager", self.lightManager.debugReloadShader),
+                ("PositionComputation", self._setPositionComputationShader),
+                ("Lighting", self._setLightingShader)
+            ]
 
         if self.haveCombiner and self.settings.enableTemporalReprojection:
-            self._setCombinerShader()
+            stages.append(("Combiner", self._setCombinerShader))
 
-        self._setFinalPassShader()
+        stages.append(("FinalPass", self._setFinalPassShader))
 
         if self.settings.enableGlobalIllumination:
-            self._setGIComputeShader()
+            stages.append(("GIPrecompute", self._setGIComputeShader))
 
         if self.occlusion.requiresBlurring():
-            self._setOcclusionBlurShader()
+            stages.append(("OcclusionBlur", self._setOcclusionBlurShader))
 
         if self.blurEnabled:
-            self._setBlurShader()
+            stages.append(("Blur", self._setBlurShader))
 
         if self.occlusion.requiresViewSpacePosNrm():
-            self._setNormalExtractShader()
+            stages.append(("NormalExtract", self._setNormalExtractShader))
+
+        stages.append(("Antialiasing", self.antialias.reloadShader))
 
-        self.antialias.reloadShader()
         if self.settings.enableGlobalIllumination:
-            self.globalIllum.reloadShader()
+            stages.append(("GlobalIllumination", self.globalIllum.reloadShader))
+
+        return stages
+
+    def _setupShaderWatcher(self):
+        """ Creates the watcher which reloads the stages using a shader file
+        as soon as the file changed. The stages get loaded by
+        reloadShaders """
+        self.debug("Watching shaders for changes")
+        self.shaderWatcher = ShaderWatcher(self.settings.shaderReloadInterval)
+
+        for name, reloadFunc in self._getShaderStages():
+            self.shaderWatcher.addStage(name, reloadFunc)
+
+    def getShaderWatcher(self):
+        """ Returns the ShaderWatcher, or None if hotReloadShaders is
+        disabled """
+        return self.shaderWatcher
+
+    def addShaderStage(self, name, reloadFunc, sources):
+        """ Registers a custom stage, e.g. WaterManager.reloadShader, so
+        its shaders get reloaded when the shader files change. sources is
+        the list of shader files reloadFunc loads, which have to be loaded
+        already. Does nothing when hotReloadShaders is disabled """
+        if self.shaderWatcher is not None:
+            self.shaderWatcher.addStage(name, reloadFunc, sources)
 
     def _setNormalExtractShader(self):
         """ Sets the shader which constructs the normals from position """
@@ -828,6 +921,10 @@ class RenderingPipeline(DebugObject):
     def _attachUpdateTask(self):
         """ Attaches the update tasks to the showbase """
 
+        if self.shaderWatcher is not None:
+            self.showbase.addTask(
+                self._reloadChangedStages, "RP_ReloadShaders", sort=-6000)
+
         self.showbase.addTask(
             self._preRenderCallback, "RP_BeforeRender", sort=-5000)
 
@@ -851,6 +948,14 @@ class RenderingPipeline(DebugObject):
         self.showbase.addTask(
             self._postRenderCallback, "RP_AfterRender", sort=5000)
 
+    def _reloadChangedStages(self, task=None):
+        """ Reloads the stages which use changed shader files, before
+        anything else is done this frame """
+        self.shaderWatcher.applyChanges()
+
+        if task is not None:
+            return task.cont
+
     def _preRenderCallback(self, task=None):
         """ Called before rendering """
 
@@ -916,6 +1021,12 @@ class RenderingPipeline(DebugObject):
 
         if self.haveLightingPass:
             self.lightManager.setCullBounds(self.cullBounds)
+            self.lightManager.setCameraPos(self.cameraPosition[0])
+
+            if self.useClusteredCulling:
+                self.lightManager.setCameraMatrices(
+                    self.showbase.render.getMat(self.showbase.cam),
+                    self.showbase.camLens.getProjectionMat())
 
         self.lastMVP[0] = self.currentMVP[0]
         self.currentMVP[0] = self._computeMVP()
@@ -978,6 +1089,13 @@ class RenderingPipeline(DebugObject):
         else:
             self.warn("Lighting is disabled, so addLight has no effect")
 
+    def removeLight(self, light):
+        """ Removes a light which was added with addLight """
+        if self.haveLightingPass:
+            self.lightManager.removeLight(light)
+        else:
+            self.warn("Lighting is disabled, so removeLight has no effect")
+
     def setScattering(self, scatteringModel):
         """ Sets a scattering model to use. Only has an effect if enableScattering
         is enabled """
@@ -1053,11 +1171,28 @@ class RenderingPipeline(DebugObject):
         if self.settings.accurateLightBoundCheck:
             defines.append(("LIGHTING_ACCURATE_BOUND_CHECK", 1))
 
+        if self.useClusteredCulling:
+            defines.append(("LIGHTING_CLUSTERED", 1))
+            defines.append(
+                ("LIGHTING_CLUSTER_SLICES", self.settings.clusterDepthSlices))
+
         if self.settings.renderShadows:
             defines.append(("USE_SHADOWS", 1))
 
         defines.append(("AMBIENT_CUBEMAP_SAMPLES", self.settings.ambientCubemapSamples))
 
+        # Light limits, the LightManager sizes its arrays from the same
+        # settings
+        defines.append(("MAX_VISIBLE_LIGHTS", self.settings.maxTotalLights))
+        defines.append(("MAX_POINT_LIGHTS", self.settings.maxPointLights))
+        defines.append(
+            ("MAX_SHADOW_POINT_LIGHTS", self.settings.maxShadowPointLights))
+        defines.append(
+            ("MAX_DIRECTIONAL_LIGHTS", self.settings.maxDirectionalLights))
+        defines.append(("MAX_DIRECTIONAL_SHADOW_LIGHTS",
+                        self.settings.maxShadowDirectionalLights))
+        defines.append(("SHADOW_MAX_TOTAL_MAPS", self.settings.maxShadowMaps))
+
         defines.append(
             ("SHADOW_MAP_ATLAS_SIZE", self.settings.shadowAtlasSize))
         defines.append(
@@ -1135,6 +1270,8 @@ class RenderingPipeline(DebugObject):
 
     def destroy(self):
         """ Call this when you want to shut down the pipeline """
+        if self.shaderWatcher is not None:
+            self.shaderWatcher.stop()
         self.mountManager.unmount()
         raise NotImplementedError()
 
@@ -0,0 +1,155 @@
+
+import json
+import hashlib
+
+from panda3d.core import VirtualFileSystem, Filename
+from direct.stdpy.file import open, join
+
+from DebugObject import DebugObject
+
+
+class ShaderCache(DebugObject):
+
+    """ This class stores the preprocessed shader sources of BetterShader on
+    disk, so they don't have to get preprocessed again on the next start.
+    The cache is stored in the PipelineTemp/ mount.
+
+    For each shader file, an entry stores the source with all includes
+    expanded, and the files it depends on (the file itself plus all files it
+    includes, transitively), each with the timestamp and content hash of the
+    file, and the #line ID the file had in the expanded source. When looking
+    up an entry, only the timestamps get compared. When a
+    timestamp changed, the content hash is compared, so files which get
+    rewritten with the same content (like the ShaderAutoConfig) don't
+    invalidate the cache. When nothing changed, the shader file and its
+    includes are not read at all.
+
+    Panda3D gives no access to the compiled program binaries, so only the
+    preprocessed sources are cached. """
+
+    def __init__(self, cachePath="PipelineTemp/ShaderCache"):
+        """ Creates a new cache, storing the entries in cachePath """
+        DebugObject.__init__(self, "ShaderCache")
+        self.cachePath = cachePath
+        self.vfs = VirtualFileSystem.getGlobalPtr()
+        self.enabled = True
+
+        # Stores (timestamp, hash) for each file hashed in this session
+        self.fileHashes = {}
+
+        if not self.vfs.isDirectory(Filename(cachePath)):
+            if not self.vfs.makeDirectory(Filename(cachePath)):
+                self.warn("Could not create", cachePath,
+                          "- disabling shader cache")
+                self.enabled = False
+
+    @staticmethod
+    def computeHash(content):
+        """ Returns a hash of the given string, which is stable across runs,
+        unlike the builtin hash() """
+        return hashlib.sha1(content).hexdigest()
+
+    def getTimestamp(self, path):
+        """ Returns the modification timestamp of a file, or None if the file
+        does not exist """
+        virtualFile = self.vfs.getFile(Filename(path), True)
+        if virtualFile is None:
+            return None
+        return virtualFile.getTimestamp()
+
+    def getFileHash(self, path):
+        """ Returns the content hash of a file. Each file is hashed at most
+        once per timestamp """
+        timestamp = self.getTimestamp(path)
+        if path in self.fileHashes and self.fileHashes[path][0] == timestamp:
+            return self.fileHashes[path][1]
+
+        with open(path, "rb") as handle:
+            fileHash = self.computeHash(handle.read())
+
+        self.fileHashes[path] = (timestamp, fileHash)
+        return fileHash
+
+    def lookup(self, source):
+        """ Returns the cached preprocessed source of the given shader file,
+        the list of files it depends on and a dictionary with the #line ID of
+        each of these files, or None if there is no entry or the entry is
+        outdated """
+        if not self.enabled:
+            return None
+
+        entry = self._readEntry(source)
+        if entry is None or "fileIDs" not in entry:
+            return None
+
+        timestampsChanged = False
+
+        for dependency in entry["dependencies"]:
+            path, timestamp, fileHash = dependency
+            currentTimestamp = self.getTimestamp(path)
+
+            if currentTimestamp is None:
+                return None
+
+            if currentTimestamp != timestamp:
+                if self.getFileHash(path) != fileHash:
+                    return None
+
+                # Same content, only remember the new timestamp
+                dependency[1] = currentTimestamp
+                timestampsChanged = True
+
+        if timestampsChanged:
+            self._writeEntry(source, entry)
+
+        return (str(entry["content"]),
+                [str(dependency[0]) for dependency in entry["dependencies"]],
+                dict((str(path), ID) for path, ID in entry["fileIDs"].items()))
+
+    def store(self, source, content, dependencies, fileIDs):
+        """ Stores the preprocessed source of a shader file. dependencies is
+        the list of all files used to generate the content, fileIDs maps
+        these files to the IDs used in the #line directives """
+        if not self.enabled:
+            return
+
+        entry = {
+            "source": source,
+            "content": content,
+            "dependencies": [
+                [path, self.getTimestamp(path), self.getFileHash(path)]
+                for path in dependencies],
+            "fileIDs": fileIDs
+        }
+        self._writeEntry(source, entry)
+
+    def _getEntryPath(self, source):
+        """ Internal method to get the path of the cache entry of a shader
+        file """
+        return join(self.cachePath, self.computeHash(source) + ".cache")
+
+    def _readEntry(self, source):
+        """ Internal method to read the cache entry of a shader file, returns
+        None if there is no valid entry """
+        entryPath = self._getEntryPath(source)
+        if not self.vfs.exists(Filename(entryPath)):
+            return None
+
+        try:
+            with open(entryPath, "r") as handle:
+                entry = json.loads(handle.read())
+        except Exception, msg:
+            self.warn("Invalid cache entry for", source, ":", msg)
+            return None
+
+        if entry.get("source", None) != source:
+            return None
+        return entry
+
+    def _writeEntry(self, source, entry):
+        """ Internal method to write the cache entry of a shader file """
+        try:
+            with open(self._getEntryPath(source), "w") as handle:
+                handle.write(json.dumps(entry))
+        except Exception, msg:
+            self.warn("Could not write cache entry for", source, ":", msg)
@@ -0,0 +1,256 @@
+
+import threading
+
+from panda3d.core import Filename, VirtualFileSystem
+from direct.stdpy.file import open, isfile, join
+
+from DebugObject import DebugObject
+
+
+class ShaderPreprocessor(DebugObject):
+
+    """ This class expands the #include directives of glsl shaders, used by
+    BetterShader. Each file is read and parsed only once: The parsed file
+    is stored as a list of text blocks, which already contain the #line
+    directives, and the includes between them. Together, the includes of
+    all parsed files form the include graph, which is used to find the
+    shaders which have to get expanded again when a file changed.
+
+    Like before, each file is included at most once per shader, so the
+    include graph is walked with a list of the already included files per
+    shader. As this list is not shared, and the caches are protected by a
+    lock, independent shaders can be preprocessed in parallel, see
+    preprocessMany. """
+
+    # Prefix of the include directive
+    IncludeIdentifier = "#include "
+
+    def __init__(self, fileIDFunc, shaderPath="Shader"):
+        """ Creates a new preprocessor. fileIDFunc returns the ID of a file
+        used in the #line directives, see BetterShader.getShaderID.
+        shaderPath is the directory the include paths are relative to """
+        DebugObject.__init__(self, "ShaderPreprocessor")
+        self.fileIDFunc = fileIDFunc
+        self.shaderPath = shaderPath
+        self.vfs = VirtualFileSystem.getGlobalPtr()
+        self.lock = threading.RLock()
+
+        # Parsed files, stores the text blocks and includes of each file
+        self.parsedFiles = {}
+
+        # Include graph, maps each file to the files it includes directly
+        self.includes = {}
+
+        # Expanded shaders, maps each file which was preprocessed to its
+        # content and the list of files it depends on
+        self.expanded = {}
+
+        # Timestamp of each file at the time it was read
+        self.timestamps = {}
+
+    def preprocess(self, source):
+        """ Returns the content of the given shader file with all includes
+        expanded, and the list of files the content depends on """
+        with self.lock:
+            if source in self.expanded:
+                return self.expanded[source]
+
+        included = []
+        content = self._expand(source, included)
+        result = (content, [source] + included)
+
+        with self.lock:
+            self.expanded[source] = result
+        return result
+
+    def preprocessMany(self, sources, numThreads=4):
+        """ Preprocesses the given shader files with multiple threads, and
+        returns a dictionary which maps each file to the result of
+        preprocess """
+        sources = list(set(sources))
+        results = {}
+
+        def worker():
+            while True:
+                with self.lock:
+                    if len(sources) < 1:
+                        return
+                    source = sources.pop()
+                result = self.preprocess(source)
+                with self.lock:
+                    results[source] = result
+
+        threads = [threading.Thread(target=worker)
+                   for i in xrange(min(numThreads, len(sources)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def addExpanded(self, source, content, dependencies):
+        """ Registers the content of a shader file which was expanded
+        somewhere else, e.g. loaded from the ShaderCache. The dependencies
+        are watched for changes like the ones of preprocessed files """
+        with self.lock:
+            self.expanded[source] = (content, list(dependencies))
+            for path in dependencies:
+                if path not in self.timestamps:
+                    self.timestamps[path] = self._getTimestamp(path)
+
+    def getDependencies(self, source):
+        """ Returns the list of files the expanded shader file depends on, or
+        None if the file was not preprocessed yet """
+        with self.lock:
+            if source not in self.expanded:
+                return None
+            return list(self.expanded[source][1])
+
+    def getDependents(self, path):
+        """ Returns all files which include the given file, directly or
+        through other includes, using the include graph """
+        with self.lock:
+            result = set()
+            pending = [path]
+            while len(pending) > 0:
+                current = pending.pop()
+                for parent, children in self.includes.items():
+                    if current in children and parent not in result:
+                        result.add(parent)
+                        pending.append(parent)
+            return result
+
+    def findChangedFiles(self):
+        """ Returns all known files which changed since they were read """
+        with self.lock:
+            return [path for path, timestamp in self.timestamps.items()
+                    if self._getTimestamp(path) != timestamp]
+
+    def invalidate(self, paths):
+        """ Removes the given files from the caches. Returns the list of
+        expanded shader files which depend on any of the files and therefore
+        have to get preprocessed again """
+        paths = set(paths)
+        with self.lock:
+            for path in paths:
+                self.parsedFiles.pop(path, None)
+                self.includes.pop(path, None)
+                self.timestamps.pop(path, None)
+
+            affected = [source for source, (content, dependencies)
+                        in self.expanded.items()
+                        if not paths.isdisjoint(dependencies)]
+
+            for source in affected:
+                del self.expanded[source]
+
+            return affected
+
+    def invalidateChangedFiles(self):
+        """ Invalidates all files which changed since they were read, and
+        returns the list of expanded shader files which were affected """
+        return self.invalidate(self.findChangedFiles())
+
+    def _getTimestamp(self, path):
+        """ Internal method to get the modification timestamp of a file """
+        virtualFile = self.vfs.getFile(Filename(path), True)
+        if virtualFile is None:
+            return None
+        return virtualFile.getTimestamp()
+
+    def _resolveInclude(self, includePart):
+        """ Internal method to convert the argument of an include directive
+        to a path """
+
+        # Special case, generated files like "%ShaderAutoConfig%" are
+        # stored in the PipelineTemp/ mount
+        if includePart.startswith('"%') and includePart.endswith('%"'):
+            return "PipelineTemp/" + includePart[2:-2] + ".include"
+
+        return Filename.fromOsSpecific(join(
+            self.shaderPath, includePart[1:-1])).toOsGeneric()
+
+    def _getParsed(self, path):
+        """ Internal method to get the parsed version of a file, parsing it
+        if required """
+        with self.lock:
+            if path in self.parsedFiles:
+                return self.parsedFiles[path]
+
+        timestamp = self._getTimestamp(path)
+        blocks, includes = self._parse(path)
+
+        with self.lock:
+            self.parsedFiles[path] = blocks
+            self.includes[path] = includes
+            self.timestamps[path] = timestamp
+        return blocks
+
+    def _parse(self, path):
+        """ Internal method to parse a file. Returns a list of blocks, which
+        are either text or a tuple of an included path and the index of the
+        line of the include, and the list of included files """
+
+        with open(path, "r") as handle:
+            content = handle.readlines()
+
+        blocks = []
+        includes = []
+        text = ""
+
+        for lineIndex, line in enumerate(content):
+            lineStrip = line.strip()
+            if not lineStrip.startswith(self.IncludeIdentifier):
+                text += line.rstrip() + "\n"
+                continue
+
+            includePart = lineStrip[len(self.IncludeIdentifier):].strip()
+
+            # Filename is surrounded by braces
+            if not (includePart.startswith('"') and
+                    includePart.endswith('"')):
+                print "BetterShader: Invalid include:", includePart
+                continue
+
+            includePath = self._resolveInclude(includePart)
+
+            # And check if file exists
+            if not isfile(includePath):
+                print "BetterShader: Failed to load '" + \
+                    str(includePath) + "'!"
+                continue
+
+            blocks.append(text)
+            blocks.append((includePath, lineIndex))
+            includes.append(includePath)
+            text = ""
+
+        blocks.append(text)
+        return blocks, includes
+
+    def _expand(self, path, included):
+        """ Internal (recursive) method to expand the includes of a file.
+        included is the list of files which were already included in the
+        current shader, to prevent recursive and repeated inclusion """
+
+        ID = self.fileIDFunc(path)
+        parts = ["#line 1 %d\n" % (ID)]
+
+        for block in self._getParsed(path):
+            if not isinstance(block, tuple):
+                parts.append(block)
+                continue
+
+            includePath, lineIndex = block
+
+            # Check for recursive includes
+            if includePath in included:
+                continue
+
+            included.append(includePath)
+            parts.append("\n// FILE: '" + str(includePath) + "' \n")
+            parts.append(self._expand(includePath, included).strip() + "\n")
+            parts.append("#line %d %d\n" % (lineIndex + 3, ID))
+
+        return "".join(parts)
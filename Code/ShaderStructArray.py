@@ -1,15 +1,30 @@
 
+import weakref
+import itertools
+
 from DebugObject import DebugObject
 from panda3d.core import PTAInt, PTAFloat, PTAMat4
 from panda3d.core import PTALVecBase2f, PTALVecBase3f
+from panda3d.core import Texture, GeomEnums
 from panda3d.core import PStatCollector
 
+# NumPy is optional, it is only required for the packed mode
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 pstats_SetShaderInputs = PStatCollector("App:ShaderStructArray:SetShaderInputs")
+pstats_FlushStructArrays = PStatCollector("App:ShaderStructArray:Flush")
 
 
 
-ShaderStructElementInstances = []
-ShaderStructArrays = []
+# Registries of the living elements and arrays, by their id. Only weak
+# references are stored, so elements and arrays which are not used anymore
+# get freed
+ShaderStructElementInstances = weakref.WeakValueDictionary()
+ShaderStructArrays = weakref.WeakValueDictionary()
+_ShaderStructIds = itertools.count()
 
 class ShaderStructElement:
 
@@ -40,18 +55,20 @@ class ShaderStructElement:
 
     def __init__(self):
         """ Constructor, creates the list of referenced lists """
-        global ShaderStructElementInstances
-        self.structElementID = len(ShaderStructElementInstances)
-        ShaderStructElementInstances.append(self)
+        self.structElementID = next(_ShaderStructIds)
+        ShaderStructElementInstances[self.structElementID] = self
         self.referencedListsIndices = {}
 
     def onPropertyChanged(self):
         """ This method should be called by the class instance itself
-        whenever it modifyed an exposed value """
-        global ShaderStructArrays
+        whenever it modifyed an exposed value. The arrays only mark the
+        object as changed, and write it once when they are flushed, so this
+        can be called multiple times per frame """
 
         for structArrayIndex, elementIndex in self.referencedListsIndices.items():
-            ShaderStructArrays[structArrayIndex].objectChanged(self, elementIndex)
+            structArray = ShaderStructArrays.get(structArrayIndex, None)
+            if structArray is not None:
+                structArray.objectChanged(self, elementIndex)
 
     def assignListIndex(self, structArrayIndex, index):
         """ A struct array calls this when this object is contained
@@ -79,27 +96,53 @@ class ShaderStructArray(DebugObject):
     of an object, you have to call myShaderStructArray[index] = Object,
     regardless wheter the object is already in the list or not.
     EDIT: The object itself can also call onPropertyChanged() to force
-    an update. Notice, that everytime this function is called, the
-    shader-inputs are refeshed for that object. You should probably only
-    call this once per frame.
+    an update.
+
+    Changes are not written immediately. The array collects the indices of
+    the changed objects, and writes each of them once when flush() is
+    called, which has to happen once per frame. So an object which changes
+    multiple times per frame is only written once.
 
     For further information about accessing the data in your shaders, see
     bindTo().
 
+    When constructed with packed=True, all objects are serialized into one
+    float buffer texture, which is bound as a single shader input. Each
+    object uses the same number of texels, and the size of the array is
+    only limited by the maximum buffer texture size. The shaders read the
+    objects with an accessor function, see generateAccessor(). The data
+    is kept in one NumPy array, so setMany() and flush() write each
+    attribute of all changed objects with one vectorized assignment. This
+    mode also requires NumPy.
+
     Todo: Make the exposed types more generic. See getExposedAttributes in
     ShaderStructElement.
     """
 
-    def __init__(self, classType, numElements):
+    # Maps the exposed attribute types to the PTA type and the amount
+    # of components per element
+    _AttributeTypes = {
+        "float": (PTAFloat, 1),
+        "int": (PTAInt, 1),
+        "vec2": (PTALVecBase2f, 2),
+        "vec3": (PTALVecBase3f, 3),
+        "mat4": (PTAMat4, 16),
+        "array<int>(6)": (PTAInt, 6),
+    }
+
+    def __init__(self, classType, numElements, packed=False):
         """ Constructs a new array, containing elements of classType and
         with the size of numElements. classType and numElements can't be
-        changed after initialization """
-        global ShaderStructArrays
-
+        changed after initialization. When packed is set, the buffer texture
+        mode (see class description) is used """
         DebugObject.__init__(self, "ShaderStructArray")
 
-        self.arrayIndex = len(ShaderStructArrays)
-        ShaderStructArrays.append(self)
+        if packed and numpy is None:
+            self.warn("NumPy is not available, can't use packed mode")
+            packed = False
+
+        self.arrayIndex = next(_ShaderStructIds)
+        ShaderStructArrays[self.arrayIndex] = self
 
         self.debug("Init array, size =", numElements)
         self.classType = classType
@@ -109,6 +152,15 @@ class ShaderStructArray(DebugObject):
         self.parents = {}
         self.ptaWrappers = {}
         self.assignedObjects = [None for i in range(numElements)]
+        self.packed = packed
+        self.dirtyIndices = set()
+
+        # Wheter the packed data changed since the last upload, see setMany
+        self.packedChanged = False
+
+        if self.packed:
+            self._createPackedTexture()
+            return
 
         for name, attrType in self.attributes.items():
             arrayType = PTAFloat
@@ -138,6 +190,115 @@ class ShaderStructArray(DebugObject):
                 arrayType.emptyArray(numElements) for i in range(self.size)]
 
 
+    def _createPackedTexture(self):
+        """ Internal method to compute the layout of the objects in the
+        buffer texture for the packed mode, and to create the texture. The
+        attributes are stored in sorted order, as floats. Attributes with up
+        to four components never cross a texel, bigger attributes start at a
+        texel. packedLayout stores the name, type and offset in floats of each
+        attribute """
+        self.packedLayout = []
+        offset = 0
+
+        for name in sorted(self.attributes):
+            attrType = self.attributes[name]
+            components = self._AttributeTypes[attrType][1]
+
+            if offset % 4 > 0 and (components > 4 or
+                                   offset % 4 + components > 4):
+                offset += 4 - offset % 4
+
+            self.packedLayout.append((name, attrType, offset))
+            offset += components
+
+        # Amount of texels per object
+        self.packedStride = (offset + 3) // 4
+        self.packedData = numpy.zeros(
+            (self.size, self.packedStride * 4), dtype=numpy.float32)
+
+        self.packedTexture = Texture(
+            "ShaderStructArray-" + self.classType.__name__)
+        self.packedTexture.setupBufferTexture(
+            self.size * self.packedStride, Texture.TFloat, Texture.FRgba32,
+            GeomEnums.UHDynamic)
+        self.packedTexture.setRamImage(self.packedData.tostring())
+
+    def generateAccessor(self, uniformName, functionName):
+        """ Returns the glsl code which declares the shader input created
+        by bindTo(object, uniformName), and a function with the name
+        functionName, which takes an index and returns the object at that
+        index, e.g. Light getLight(int index). This works in both modes, so
+        shaders using the function don't depend on the mode. The struct has
+        to be defined before the code, with the name of the class """
+        structName = self.classType.__name__
+        lines = []
+
+        if not self.packed:
+            lines.append("uniform %s %s[%d];" % (
+                structName, uniformName, self.size))
+            lines.append("%s %s(int index) {" % (structName, functionName))
+            lines.append("    return %s[index];" % uniformName)
+            lines.append("}")
+            return "\n".join(lines) + "\n"
+
+        lines.append("uniform samplerBuffer %s;" % uniformName)
+        lines.append("%s %s(int index) {" % (structName, functionName))
+        lines.append("    %s result;" % structName)
+        lines.append("    int base = index * %d;" % self.packedStride)
+        for name, attrType, offset in self.packedLayout:
+            lines += self._generatePackedRead(
+                uniformName, name, attrType, offset)
+        lines.append("    return result;")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def _generatePackedRead(self, uniformName, name, attrType, offset):
+        """ Internal method to generate the glsl code which reads an
+        attribute from the buffer texture in packed mode """
+        fetch = lambda texel: "texelFetch(%s, base + %d)" % (
+            uniformName, texel)
+
+        if attrType == "mat4":
+            return ["    result.%s = mat4(%s);" % (name, ", ".join(
+                fetch(offset // 4 + i) for i in range(4)))]
+
+        if attrType == "array<int>(6)":
+            return ["    result.%s[%d] = int(%s.%s);" % (
+                name, i, fetch((offset + i) // 4), "xyzw"[(offset + i) % 4])
+                for i in range(6)]
+
+        components = self._AttributeTypes[attrType][1]
+        swizzle = "xyzw"[offset % 4:offset % 4 + components]
+        value = "%s.%s" % (fetch(offset // 4), swizzle)
+        if attrType == "int":
+            value = "int(%s)" % value
+        return ["    result.%s = %s;" % (name, value)]
+
+    def getUniformComponents(self):
+        """ Returns the amount of uniform components the array uses when it
+        is bound to a shader. Drivers store each scalar and vector of an array
+        in a vec4 slot, so this counts 4 components per scalar and vector.
+        The buffer texture of the packed mode uses no uniform components """
+        if self.packed:
+            return 0
+
+        components = 0
+        for attrType in self.attributes.values():
+            if attrType == "mat4":
+                components += 16
+            elif attrType == "array<int>(6)":
+                components += 6 * 4
+            else:
+                components += 4
+        return components * self.size
+
+    def getBufferTexels(self):
+        """ Returns the size of the buffer texture in texels in packed mode,
+        and 0 otherwise """
+        if not self.packed:
+            return 0
+        return self.size * self.packedStride
+
     def getUID(self):
         """ Returns the unique index of this array """
         return self.arrayIndex
@@ -173,11 +334,18 @@ class ShaderStructArray(DebugObject):
 
 
         You can then access the data as with any other uniform input.
+
+        In packed mode, the buffer texture is passed as uniformName. Use
+        generateAccessor to read the objects in the shader.
         """
 
         
         self.parents[parent] = uniformName
 
+        if self.packed:
+            parent.setShaderInput(uniformName, self.packedTexture)
+            return
+
         for index in range(min(32, self.size) ):
             for attrName, attrType in self.attributes.items():
                 inputName = uniformName + \
@@ -188,9 +356,82 @@ class ShaderStructArray(DebugObject):
 
     def objectChanged(self, obj, index):
         """ A list object calls this when it changed. Do not call this
-        directly """
+        directly. The object gets written with the next flush() """
+        self.dirtyIndices.add(index)
+
+    def setMany(self, indices, objects):
+        """ Sets the objects at the given indices at once. In packed mode,
+        the data of all objects is written with one vectorized assignment per
+        attribute, and the texture gets uploaded with the next flush().
+        Otherwise the objects get written with the next flush(), like when
+        using the [] operator """
+        indices = list(indices)
+        objects = list(objects)
+
+        for index, value in zip(indices, objects):
+            self._assign(index, value)
+
+        if not self.packed:
+            self.dirtyIndices.update(indices)
+            return
+
+        if len(indices) > 0:
+            self._writePacked(indices, objects)
+            self.dirtyIndices.difference_update(indices)
+            self.packedChanged = True
+
+    def flush(self):
+        """ Writes the data of all changed objects, and should be called once
+        per frame. In packed mode, each attribute is written with one
+        vectorized assignment """
+
+        if self.packed:
+            self._flushPacked()
+            return
+
+        if len(self.dirtyIndices) < 1:
+            return
+
+        for index in self.dirtyIndices:
+            self._rebindInputs(index, self.assignedObjects[index])
+        self.dirtyIndices = set()
+
+    def _flushPacked(self):
+        """ Internal method to write the changed objects to the buffer
+        texture in packed mode, and to upload the texture once """
+        if len(self.dirtyIndices) < 1 and not self.packedChanged:
+            return
+
+        pstats_FlushStructArrays.start()
+
+        indices = sorted(self.dirtyIndices)
+        self.dirtyIndices = set()
+        if len(indices) > 0:
+            self._writePacked(
+                indices, [self.assignedObjects[i] for i in indices])
+
+        self.packedTexture.setRamImage(self.packedData.tostring())
+        self.packedChanged = False
+        pstats_FlushStructArrays.stop()
+
+    def _writePacked(self, indices, objects):
+        """ Internal method to write the data of the given objects to the
+        packed data, with one vectorized assignment per attribute """
+        for attrName, attrType, offset in self.packedLayout:
+            components = self._AttributeTypes[attrType][1]
+            values = [getattr(obj, attrName) for obj in objects]
+
+            if attrType == "mat4":
+                values = [[tuple(m.getRow(i)) for i in range(4)]
+                          for m in values]
+            elif attrType in ["vec2", "vec3"]:
+                values = [tuple(v) for v in values]
+            elif attrType == "array<int>(6)":
+                values = [[v[i] for i in range(6)] for v in values]
 
-        self._rebindInputs(index, obj)
+            values = numpy.array(values, dtype=numpy.float32)
+            self.packedData[indices, offset:offset + components] = \
+                values.reshape(len(indices), components)
 
     def _rebindInputs(self, index, value):
         """ Rebinds the shader inputs for an index """
@@ -215,9 +456,29 @@ class ShaderStructArray(DebugObject):
         pstats_SetShaderInputs.stop()
 
 
+    def __delitem__(self, index):
+        """ Removes the object at index. The data of the object stays in
+        the shader inputs until another object is set at that index, so the
+        shaders should not access that index anymore """
+
+        if index < 0 or index >= self.size:
+            raise Exception("Out of bounds!")
+
+        oldObject = self.assignedObjects[index]
+        if oldObject is not None:
+            oldObject.removeListReference(self.arrayIndex)
+        self.assignedObjects[index] = None
+        self.dirtyIndices.discard(index)
+
     def __setitem__(self, index, value):
-        """ Sets the object at index to value. This directly updates the
-        shader inputs. """
+        """ Sets the object at index to value. The shader inputs get
+        updated with the next flush() """
+        self._assign(index, value)
+        self.dirtyIndices.add(index)
+
+    def _assign(self, index, value):
+        """ Internal method to store the object at index, and to update the
+        list references of the old and new object """
 
         if index < 0 or index >= self.size:
             raise Exception("Out of bounds!")
@@ -232,4 +493,3 @@ class ShaderStructArray(DebugObject):
         # Set new reference
         value.assignListIndex(self.arrayIndex, index)
         self.assignedObjects[index] = value
-        self._rebindInputs(index, value)
@@ -0,0 +1,157 @@
+
+import time
+import threading
+
+from DebugObject import DebugObject
+from BetterShader import BetterShader
+
+
+class ShaderWatcher(DebugObject):
+
+    """ This class watches the shader files for changes, and reloads only the
+    parts of the pipeline which use a changed file. Each part is registered
+    as a stage, with a function which loads its shaders and sets them, like
+    RenderingPipeline._setLightingShader or Antialiasing.reloadShader.
+    When a stage gets loaded with loadStage, the shader files the function
+    loads are recorded, and together with the include graph of the
+    ShaderPreprocessor this gives the files each stage depends on.
+
+    The files are polled in a background thread, as the virtual file system
+    offers no change notifications. The thread only detects the changed
+    files. They are invalidated and preprocessed again in applyChanges,
+    which reloads the affected stages and should be called once per frame
+    from the main thread before rendering, so the shader caches are only
+    modified by the main thread and all changed stages are swapped in at
+    the same frame boundary. """
+
+    def __init__(self, pollInterval=0.5):
+        """ Creates a new watcher which checks the shader files every
+        pollInterval seconds """
+        DebugObject.__init__(self, "ShaderWatcher")
+        self.pollInterval = pollInterval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+        # Maps each stage name to the reload function and the set of files
+        # the stage depends on
+        self.stages = {}
+
+        # Files which changed since the last call to applyChanges
+        self.changedFiles = set()
+
+    def addStage(self, name, reloadFunc, sources=None):
+        """ Registers a stage without loading it. sources is the list of
+        shader files reloadFunc loads, if they are already loaded. Otherwise
+        load the stage with loadStage, which records the files """
+        files = self._getFiles(sources or [])
+        with self.lock:
+            self.stages[name] = (reloadFunc, files)
+
+    def loadStage(self, name):
+        """ Calls the reload function of a registered stage, and records the
+        shader files it loads. This has to be called from the main thread """
+        with self.lock:
+            reloadFunc = self.stages[name][0]
+
+        files = self._recordFiles(reloadFunc)
+
+        # The includes might have changed, so update the files of the stage
+        with self.lock:
+            if name in self.stages:
+                self.stages[name] = (reloadFunc, files)
+        self.debug("Stage", name, "depends on", len(files), "files")
+
+    def removeStage(self, name):
+        """ Stops watching the files of a stage """
+        with self.lock:
+            self.stages.pop(name, None)
+
+    def getStageFiles(self, name):
+        """ Returns the set of files the given stage depends on """
+        with self.lock:
+            return set(self.stages[name][1])
+
+    def start(self):
+        """ Starts the background thread which polls the files """
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stops the background thread """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def checkForChanges(self):
+        """ Checks the files for changes. This only reads the timestamps,
+        the changed files are handled in the next call to applyChanges.
+        Returns the list of changed files """
+        changedFiles = BetterShader._Preprocessor.findChangedFiles()
+        if len(changedFiles) > 0:
+            with self.lock:
+                self.changedFiles.update(changedFiles)
+        return changedFiles
+
+    def applyChanges(self):
+        """ Preprocesses the shaders which depend on changed files, and
+        reloads all stages using them. This has to be called from the main
+        thread """
+        with self.lock:
+            changedFiles = self.changedFiles
+            self.changedFiles = set()
+            stages = [name for name, (reloadFunc, files) in self.stages.items()
+                      if not files.isdisjoint(changedFiles)]
+
+        if len(changedFiles) < 1:
+            return
+
+        self.debug("Changed:", ", ".join(sorted(changedFiles)))
+        affectedSources = BetterShader._Preprocessor.invalidate(changedFiles)
+
+        try:
+            BetterShader.preprocessFiles(affectedSources)
+        except Exception, msg:
+            # The file might be written at the moment, it will be
+            # preprocessed again when the stage gets reloaded
+            self.warn("Failed to preprocess changed shaders:", msg)
+
+        for name in stages:
+            self.debug("Reloading stage", name)
+            try:
+                self.loadStage(name)
+            except Exception, msg:
+                self.warn("Failed to reload stage", name, ":", msg)
+
+    def _recordFiles(self, reloadFunc):
+        """ Internal method to call the reload function of a stage, and
+        return the set of files the loaded shaders depend on """
+        BetterShader.startRecording()
+        try:
+            reloadFunc()
+        finally:
+            sources = BetterShader.stopRecording()
+        return self._getFiles(sources)
+
+    def _getFiles(self, sources):
+        """ Internal method to return the set of files the given shader
+        files depend on """
+        files = set()
+        for source in sources:
+            dependencies = BetterShader._Preprocessor.getDependencies(source)
+            files.update(dependencies or [source])
+        return files
+
+    def _run(self):
+        """ Internal method executed by the background thread """
+        while self.running:
+            time.sleep(self.pollInterval)
+            try:
+                self.checkForChanges()
+            except Exception, msg:
+                self.warn("Error while checking for changes:", msg)
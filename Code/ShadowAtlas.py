@@ -1,6 +1,5 @@
 
-
-from panda3d.core import Vec2, LVecBase2i
+from panda3d.core import Vec2
 from DebugObject import DebugObject
 
 
@@ -9,13 +8,23 @@ class ShadowAtlas(DebugObject):
     """ This class manages the shadow atlas, used by LightManager.
     It supports reordering the atlas, for gaining more space,
     and also helps by fitting all shadow maps most efficiently
-    into the atlas. """
+    into the atlas.
+
+    Internally this is a guillotine packer working in tile space. The
+    free space is stored as a list of disjoint free rectangles, and each
+    reservation takes the best fitting free rectangle and splits the
+    remaining space into two new free rectangles. Released maps give their
+    rectangle back, and adjacent free rectangles get merged again. With
+    compact() the atlas can move a bounded amount of maps per call towards
+    the origin, so the free space gets consolidated over time. """
 
     def __init__(self):
         """ Constructs a new shadow atlas """
         DebugObject.__init__(self, "ShadowAtlas")
         self.size = 512
         self.freeTiles = 0
+        self.freeRects = []
+        self.reserved = {}
 
     def create(self):
         """ Creates this atlas, also setting up the atlas texture """
@@ -33,13 +42,17 @@ class ShadowAtlas(DebugObject):
             self.tileSize += 16
 
         self.tileCount = self.size / self.tileSize
+        self.freeTiles = self.tileCount ** 2
 
         self.debug(
             "Creating atlas with size", self.size, "and tile size", self.tileSize)
 
-        # Create binary tile representation
-        self.tiles = [
-            [None for x in range(self.tileCount)] for y in range(self.tileCount)]
+        # Initially the whole atlas is one free rectangle. Rectangles are
+        # stored as (x, y, w, h) in tile space
+        self.freeRects = [(0, 0, self.tileCount, self.tileCount)]
+
+        # Maps each uid to its reserved rectangle
+        self.reserved = {}
 
     def setSize(self, size):
         """ Sets the shadow atlas size in pixels """
@@ -60,66 +73,190 @@ class ShadowAtlas(DebugObject):
         and the dimensions width*height in the atlas and returns the
         top-left coordinates of the reserved space """
 
+        if tileIndex in self.reserved:
+            self.warn("Tile #" + str(tileIndex), "is already reserved!")
+            return self.getAtlasPos(tileIndex)
+
         # Convert to tile space
         tileW, tileH = width / self.tileSize, height / self.tileSize
 
-        # self.warn("Finding position for tile of size", tileW, "x", tileH)
-
-        maxIterations = self.tileCount - tileW + 1, self.tileCount - tileH + 1
-        tileFound = False
-        tilePos = LVecBase2i(-1)
-
-        # Iterate all tiles
-        for j in range(0, maxIterations[0]):
-            if not tileFound:
-                for i in range(0, maxIterations[1]):
-                    if not tileFound:
-
-                        # First, assume the space is free
-                        tileFree = True
-
-                        # Now, check if anything is blocking the space, and if so,
-                        # mark the tile as reserved
-                        for x in range(tileW):
-                            for y in range(tileH):
-                                if not tileFree:
-                                    break
-                                if self.tiles[j + y][i + x] is not None:
-                                    tileFree = False
-                                    break
-
-                        # When the tile is free, we have found our tile
-                        if tileFree:
-                            tileFound = True
-                            tilePos = LVecBase2i(i, j)
-                            break
-
-        if tileFound:
-            # self.debug("Tile #" + str(tileIndex) + " found:",
-                       # tilePos.x * self.tileSize, "/", tilePos.y * self.tileSize)
-            self._reserveTile(tilePos.x, tilePos.y, tileW, tileH, tileIndex)
-
-            return Vec2(
-                float(tilePos.x) / float(self.tileCount),
-                float(tilePos.y) / float(self.tileCount))
+        rectIndex = self._findFreeRect(tileW, tileH)
 
-        else:
+        if rectIndex < 0:
             self.error("No free tile found! Have to update whole atlas maybe?")
             return None
 
-    def _reserveTile(self,  offsetX, offsetY, width, height, value):
+        freeX, freeY = self.freeRects[rectIndex][0:2]
+        self._reserveTile(rectIndex, freeX, freeY, tileW, tileH, tileIndex)
+        return self.getAtlasPos(tileIndex)
+
+    def releaseTiles(self, tileIndex):
+        """ Releases the tiles which were reserved for the tile with the ID
+        tileIndex, so they can get used by other shadow maps again. Returns
+        wheter the tile was reserved at all """
+
+        if tileIndex not in self.reserved:
+            return False
+
+        x, y, w, h = self.reserved[tileIndex]
+        del self.reserved[tileIndex]
+
+        self.freeRects.append((x, y, w, h))
+        self.freeTiles += w * h
+        self._mergeFreeRects()
+        return True
+
+    def isReserved(self, tileIndex):
+        """ Returns wheter there is space reserved for the given ID """
+        return tileIndex in self.reserved
+
+    def getAtlasPos(self, tileIndex):
+        """ Returns the top-left coordinates of the space reserved for the
+        given ID, from 0 .. 1, or None if no space is reserved """
+        if tileIndex not in self.reserved:
+            return None
+
+        x, y = self.reserved[tileIndex][0:2]
+        return Vec2(
+            float(x) / float(self.tileCount),
+            float(y) / float(self.tileCount))
+
+    def getReservedSize(self, tileIndex):
+        """ Returns the size in pixels of the space reserved for the given
+        ID, or 0 if no space is reserved """
+        if tileIndex not in self.reserved:
+            return 0
+        return self.reserved[tileIndex][2] * self.tileSize
+
+    def compact(self, maxMoves=1):
+        """ Moves at most maxMoves reserved maps to a position closer to the
+        origin of the atlas, so that the free space gets consolidated. Returns
+        a list of the IDs which got moved. The shadow maps of moved IDs have
+        to get re-rendered, as their content is not copied. """
+
+        moved = []
+
+        # Process the maps which are furthest away from the origin first
+        candidates = sorted(self.reserved.items(),
+                            key=lambda item: (item[1][1] + item[1][3],
+                                              item[1][0] + item[1][2]),
+                            reverse=True)
+
+        for uid, oldRect in candidates:
+            if len(moved) >= maxMoves:
+                break
+
+            # Store the state, so we can revert when there is no better
+            # position for this map
+            oldFreeRects = list(self.freeRects)
+            oldFreeTiles = self.freeTiles
+
+            self.releaseTiles(uid)
+            rectIndex = self._findFreeRect(
+                oldRect[2], oldRect[3], preferOrigin=True)
+            freeX, freeY = self.freeRects[rectIndex][0:2]
+
+            if (freeY, freeX) < (oldRect[1], oldRect[0]):
+                self._reserveTile(rectIndex, freeX, freeY,
+                                  oldRect[2], oldRect[3], uid)
+                moved.append(uid)
+            else:
+                self.freeRects = oldFreeRects
+                self.freeTiles = oldFreeTiles
+                self.reserved[uid] = oldRect
+
+        return moved
+
+    def _findFreeRect(self, tileW, tileH, preferOrigin=False):
+        """ Finds the free rectangle which fits a tile of the size
+        tileW*tileH best (smallest remaining short side). Ties are resolved
+        by preferring rectangles closer to the origin. When preferOrigin is
+        set, the rectangle closest to the origin is returned instead. Returns
+        the index of the rectangle, or -1 if no rectangle is big enough """
+
+        bestIndex = -1
+        bestScore = None
+
+        for index, (x, y, w, h) in enumerate(self.freeRects):
+            if w < tileW or h < tileH:
+                continue
+
+            if preferOrigin:
+                score = (y, x)
+            else:
+                score = (min(w - tileW, h - tileH), y, x)
+            if bestScore is None or score < bestScore:
+                bestScore = score
+                bestIndex = index
+
+        return bestIndex
+
+    def _reserveTile(self, rectIndex, offsetX, offsetY, width, height, value):
         """ Reserves the space of the size width*height at the position
-        offsetX, offsetY in the atlas, setting their assigned index to value """
-        for x in range(0, width):
-            for y in range(0, height):
-                self.tiles[y + offsetY][x + offsetX] = value
+        offsetX, offsetY in the free rectangle with the index rectIndex,
+        setting their assigned index to value. The remaining space of the
+        free rectangle is split into two new free rectangles, along the
+        shorter leftover axis """
+
+        x, y, w, h = self.freeRects.pop(rectIndex)
+        assert(offsetX == x and offsetY == y)
 
+        leftoverW = w - width
+        leftoverH = h - height
+
+        if leftoverW < leftoverH:
+            # Split horizontally, the right part only spans the tile height
+            right = (x + width, y, leftoverW, height)
+            top = (x, y + height, w, leftoverH)
+        else:
+            # Split vertically, the top part only spans the tile width
+            right = (x + width, y, leftoverW, h)
+            top = (x, y + height, width, leftoverH)
+
+        for rect in [right, top]:
+            if rect[2] > 0 and rect[3] > 0:
+                self.freeRects.append(rect)
+
+        self.reserved[value] = (x, y, width, height)
         self.freeTiles -= width * height
 
+    def _mergeFreeRects(self):
+        """ Merges free rectangles which share a full edge, until no more
+        rectangles can be merged """
+
+        merged = True
+        while merged:
+            merged = False
+            for i, (ax, ay, aw, ah) in enumerate(self.freeRects):
+                for j in xrange(i + 1, len(self.freeRects)):
+                    bx, by, bw, bh = self.freeRects[j]
+                    combined = None
+
+                    if ax == bx and aw == bw:
+                        if ay + ah == by:
+                            combined = (ax, ay, aw, ah + bh)
+                        elif by + bh == ay:
+                            combined = (ax, by, aw, ah + bh)
+
+                    elif ay == by and ah == bh:
+                        if ax + aw == bx:
+                            combined = (ax, ay, aw + bw, ah)
+                        elif bx + bw == ax:
+                            combined = (bx, ay, aw + bw, ah)
+
+                    if combined is not None:
+                        del self.freeRects[j]
+                        self.freeRects[i] = combined
+                        merged = True
+                        break
+
+                if merged:
+                    break
+
     def getFreeTileCount(self):
         """ Returns how much tiles are currently free in the atlas """
         return self.freeTiles
 
     def getTotalTileCount(self):
         """ Returns how much tiles this atlas can store """
-        return self.tileCount ** 2
\ No newline at end of file
+        return self.tileCount ** 2
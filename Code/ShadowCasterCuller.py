@@ -0,0 +1,228 @@
+
+from panda3d.core import BoundingSphere, BoundingHexahedron, PTAInt
+from panda3d.core import PStatCollector
+
+from DebugObject import DebugObject
+
+# NumPy is optional, without it the casters are culled one by one
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+pstats_CullCasters = PStatCollector("App:LightManager:CullShadowCasters")
+
+
+class ShadowCasterCuller(DebugObject):
+
+    """ This class is used by the LightManager to find the shadow casters
+    each shadow update has to render. All updates of a frame are rendered in
+    one pass, and the geometry shader emits each triangle once per update.
+    Without culling, every node gets submitted and emitted for each update,
+    so a point light renders the whole scene six times.
+
+    The culler collects the GeomNodes of the scene and caches their world
+    space bounding spheres in NumPy arrays, so all nodes can be tested
+    against the lens bounds of all updates at once. Each node gets a bitmask
+    of the update slots it is visible in, passed as shadowCasterMask, which
+    the geometry shader checks before emitting. Nodes which are visible in
+    no update are hidden from the shadow cameras, so they are not submitted
+    at all.
+
+    The bounds are only computed when collecting the casters, and each frame
+    for the nodes below the roots registered with addDynamicRoot. Call
+    collectCasters again after adding or removing static geometry. Nodes
+    which were not collected yet are rendered to all updates.
+
+    Camera masks can only show a node to more cameras, so the culled nodes
+    are hidden directly. When a dynamic root is a GeomNode itself, the
+    masks LightManager.setShadowCasterDynamic set on it get restored when
+    the node becomes visible again. """
+
+    def __init__(self, scene, hideMask, dynamicMask=None):
+        """ Creates a new culler for the given scene. hideMask is the camera
+        mask of the shadow cameras, culled nodes get hidden for it.
+        dynamicMask is the part of it the dynamic roots are shown through,
+        when caching the static shadows """
+        DebugObject.__init__(self, "ShadowCasterCuller")
+        self.scene = scene
+        self.hideMask = hideMask
+        self.dynamicMask = dynamicMask
+        self.nodes = []
+        self.masks = []
+        self.lastMasks = []
+        self.dynamicRoots = []
+        self.dynamicIndices = []
+        self.needsCollect = True
+
+        if numpy is None:
+            self.debug("NumPy not found, using unvectorized caster culling")
+
+    def addDynamicRoot(self, nodePath):
+        """ Registers a node whose children move, their bounds get updated
+        each frame """
+        if nodePath not in self.dynamicRoots:
+            self.dynamicRoots.append(nodePath)
+            self.dynamicIndices = self._findDynamicIndices()
+            self._invalidateMasks(nodePath)
+
+    def removeDynamicRoot(self, nodePath):
+        """ Stops updating the bounds below the given node each frame """
+        if nodePath in self.dynamicRoots:
+            self._invalidateMasks(nodePath)
+            self.dynamicRoots.remove(nodePath)
+            self.dynamicIndices = self._findDynamicIndices()
+
+    def _invalidateMasks(self, nodePath):
+        """ Internal method to apply the visibility of the nodes below the
+        given node again in the next cull, as the LightManager changes
+        their camera masks """
+        for index, node in enumerate(self.nodes):
+            if nodePath == node or nodePath.isAncestorOf(node):
+                self.lastMasks[index] = -2
+
+    def collectCasters(self):
+        """ Collects the GeomNodes of the scene, and caches their bounds """
+        self.reset()
+
+        self.nodes = list(self.scene.findAllMatches("**/+GeomNode"))
+        self.masks = []
+        self.lastMasks = [-1] * len(self.nodes)
+        if numpy is not None:
+            self.lastMasks = numpy.array(self.lastMasks, dtype=numpy.int64)
+
+        for node in self.nodes:
+            mask = PTAInt.emptyArray(1)
+            mask[0] = -1
+            node.setShaderInput("shadowCasterMask", mask)
+            self.masks.append(mask)
+
+        if numpy is not None:
+            self.centers = numpy.zeros((len(self.nodes), 4),
+                                       dtype=numpy.float32)
+            self.centers[:, 3] = 1.0
+            self.radii = numpy.zeros(len(self.nodes), dtype=numpy.float32)
+            for index in xrange(len(self.nodes)):
+                self._updateBounds(index)
+
+        self.dynamicIndices = self._findDynamicIndices()
+        self.needsCollect = False
+        self.debug("Collected", len(self.nodes), "shadow casters")
+
+    def reset(self):
+        """ Removes the masks of all collected nodes, so they are rendered
+        to all updates again """
+        for node, lastMask in zip(self.nodes, self.lastMasks):
+            node.clearShaderInput("shadowCasterMask")
+            if lastMask == 0:
+                self._showNode(node)
+        self.nodes = []
+        self.masks = []
+        self.lastMasks = []
+        self.dynamicIndices = []
+        self.needsCollect = True
+
+    def _findDynamicIndices(self):
+        """ Internal method to find the indices of the collected nodes below
+        the dynamic roots """
+        return [index for index, node in enumerate(self.nodes)
+                if any(root == node or root.isAncestorOf(node)
+                       for root in self.dynamicRoots)]
+
+    def _updateBounds(self, index):
+        """ Internal method to store the world space bounds of a node """
+        node = self.nodes[index]
+        bounds = node.getBounds()
+
+        if bounds.isEmpty():
+            self.radii[index] = -numpy.inf
+            return
+
+        bounds.xform(node.getMat(self.scene))
+        if isinstance(bounds, BoundingSphere):
+            center = bounds.getCenter()
+            self.centers[index, 0:3] = (center.x, center.y, center.z)
+            self.radii[index] = bounds.getRadius()
+        else:
+            self.radii[index] = numpy.inf
+
+    def cull(self, sources):
+        """ Culls the casters against the lens bounds of the given shadow
+        sources, the index of a source in the list is its bit in the masks.
+        Updates the masks of the nodes, and hides the nodes which are not
+        visible in any source """
+        if self.needsCollect:
+            self.collectCasters()
+
+        pstats_CullCasters.start()
+
+        if numpy is None:
+            masks = self._cullUnvectorized(sources)
+            changedIndices = [index for index, mask in enumerate(masks)
+                              if mask != self.lastMasks[index]]
+        else:
+            masks = self._cullVectorized(sources)
+            changedIndices = numpy.nonzero(masks != self.lastMasks)[0]
+
+        # Only the nodes whose visibility changed have to be touched
+        for index in changedIndices:
+            mask = int(masks[index])
+            node = self.nodes[index]
+            self.masks[index][0] = mask
+            if mask == 0:
+                node.hide(self.hideMask)
+            else:
+                self._showNode(node)
+            self.lastMasks[index] = mask
+
+        pstats_CullCasters.stop()
+
+    def _showNode(self, node):
+        """ Internal method to show a culled node to the shadow cameras
+        again. Restores the masks of the node if it is a dynamic root """
+        node.show(self.hideMask)
+        if self.dynamicMask is not None and node in self.dynamicRoots:
+            node.hide(self.hideMask & ~self.dynamicMask)
+            node.showThrough(self.dynamicMask)
+
+    def _cullVectorized(self, sources):
+        """ Internal method to compute the masks of all nodes at once """
+        for index in self.dynamicIndices:
+            self._updateBounds(index)
+
+        masks = numpy.zeros(len(self.nodes), dtype=numpy.int64)
+
+        for bit, source in enumerate(sources):
+            bounds = source.getBounds()
+
+            if not isinstance(bounds, BoundingHexahedron):
+                masks |= 1 << bit
+                continue
+
+            # Panda's frustum planes point outwards, a sphere is outside if
+            # it is further in front of any plane than its radius
+            planes = numpy.array(
+                [tuple(bounds.getPlane(i))
+                 for i in xrange(bounds.getNumPlanes())],
+                dtype=numpy.float32)
+            distances = self.centers.dot(planes.T)
+            visible = (distances <= self.radii[:, None]).all(axis=1)
+            masks[visible] |= 1 << bit
+
+        return masks
+
+    def _cullUnvectorized(self, sources):
+        """ Internal fallback method which checks each node separately """
+        sourceBounds = [source.getBounds() for source in sources]
+        masks = []
+
+        for node in self.nodes:
+            bounds = node.getBounds()
+            bounds.xform(node.getMat(self.scene))
+            mask = 0
+            for bit, lensBounds in enumerate(sourceBounds):
+                if lensBounds.contains(bounds):
+                    mask |= 1 << bit
+            masks.append(mask)
+
+        return masks
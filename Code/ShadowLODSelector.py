@@ -0,0 +1,63 @@
+
+import math
+
+from DebugObject import DebugObject
+
+
+class ShadowLODSelector(DebugObject):
+
+    """ This class is used by the LightManager to choose the shadow map
+    resolution of each light, based on how much of the screen the light
+    covers. The resolution set with Light.setShadowMapResolution is the
+    highest tier, each further tier halves the resolution, down to the tile
+    size of the atlas. Lights covering at least fullCoverage of the screen
+    use the highest tier, and each halving of the coverage selects the next
+    tier.
+
+    To prevent lights near a tier boundary from switching back and forth,
+    which would re-render their shadow maps each frame, the tier only
+    changes when the coverage is more than the hysteresis (in tiers) outside
+    of the range of the current tier. """
+
+    def __init__(self, numTiers=4, fullCoverage=0.5, hysteresis=0.25):
+        """ Creates a new selector """
+        DebugObject.__init__(self, "ShadowLODSelector")
+        self.numTiers = numTiers
+        self.fullCoverage = fullCoverage
+        self.hysteresis = hysteresis
+        self.tiers = {}
+
+    def getTier(self, light):
+        """ Returns the current tier of a light, 0 is the highest
+        resolution """
+        return self.tiers.get(light, 0)
+
+    def removeLight(self, light):
+        """ Forgets the tier of a light """
+        self.tiers.pop(light, None)
+
+    def computeTier(self, coverage, currentTier):
+        """ Computes the tier for the given screen coverage, starting from
+        the current tier of the light """
+        # Continuous tier, increases by one each time the coverage halves
+        tier = max(0.0, math.log(self.fullCoverage / max(coverage, 1e-6), 2))
+
+        if currentTier - self.hysteresis <= tier < \
+                currentTier + 1 + self.hysteresis:
+            return currentTier
+
+        return min(int(tier), self.numTiers - 1)
+
+    def updateTier(self, light, coverage):
+        """ Updates the tier of a light. Returns True if the tier changed """
+        currentTier = self.getTier(light)
+        tier = self.computeTier(coverage, currentTier)
+        self.tiers[light] = tier
+        return tier != currentTier
+
+    def getResolution(self, light, tileSize):
+        """ Returns the shadow map resolution of the current tier of a
+        light, a multiple of tileSize """
+        resolution = (light.shadowResolution >> self.getTier(light)) // \
+            tileSize * tileSize
+        return max(tileSize, resolution)
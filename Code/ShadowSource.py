@@ -31,7 +31,8 @@ class ShadowSource(DebugObject, ShaderStructElement):
             "atlasPos": "vec2",
             "mvp": "mat4",
             "nearPlane": "float",
-            "farPlane": "float"
+            "farPlane": "float",
+            "isParaboloid": "int"
         }
 
     @classmethod
@@ -49,6 +50,7 @@ class ShadowSource(DebugObject, ShaderStructElement):
         ShaderStructElement.__init__(self)
 
         self.valid = False
+        self.staticCacheValid = False
         self.camera = Camera("ShadowSource-" + str(self.index))
         self.cameraNode = NodePath(self.camera)
         self.cameraNode.reparentTo(Globals.render)
@@ -60,7 +62,9 @@ class ShadowSource(DebugObject, ShaderStructElement):
         self.sourceIndex = -1
         self.nearPlane = 0.0
         self.farPlane = 1000.0
+        self.isParaboloid = 0
         self.converterYUR = None
+        self.filmSize = 0.0
         self.transforMat = TransformState.makeMat(
             Mat4.convertMat(Globals.base.win.getGsg().getInternalCoordinateSystem(),
                             CSZupRight))
@@ -69,8 +73,14 @@ class ShadowSource(DebugObject, ShaderStructElement):
     def setFilmSize(self, size_x, size_y):
         """ Sets the film size of the source """
         self.lens.setFilmSize(size_x, size_y)
+        self.filmSize = size_x
         self.rebuildMatrixCache()
 
+    def getFilmSize(self):
+        """ Returns the horizontal film size of the source, as passed to
+        setFilmSize """
+        return self.filmSize
+
     def getSourceIndex(self):
         """ Returns the assigned source index. The source index is the index
         of the ShadowSource in the ShadowSources array of the assigned
@@ -100,6 +110,9 @@ class ShadowSource(DebugObject, ShaderStructElement):
         """ Assigns this source a position in the shadow atlas. This is called
         by the shadow atlas. Coordinates are float from 0 .. 1 """
         self.atlasPos = Vec2(x, y)
+
+        # The cached static casters are stored at the same position
+        self.staticCacheValid = False
         self.doesHaveAtlasPos = True
 
     def update(self):
@@ -144,6 +157,18 @@ class ShadowSource(DebugObject, ShaderStructElement):
         self.camera.setLens(self.lens)
         self.nearPlane = near
         self.farPlane = far
+        self.isParaboloid = 0
+        self.rebuildMatrixCache()
+
+    def setupParaboloidLens(self, near=0.1, far=100.0):
+        """ Setups a paraboloid projection covering the hemisphere in front
+        of the source, used for dual paraboloid shadow maps. The projection
+        can't be expressed as matrix, so the mvp only transforms to the view
+        space, and the shaders apply the projection with transformParabol.
+        The lens covers almost the whole hemisphere and is only used for
+        culling """
+        self.setupPerspectiveLens(near, far, (179, 179))
+        self.isParaboloid = 1
         self.rebuildMatrixCache()
 
     def setupOrtographicLens(self, near=0.1, far=100.0, filmSize=(512, 512)):
@@ -154,14 +179,20 @@ class ShadowSource(DebugObject, ShaderStructElement):
         self.lens = OrthographicLens()
         self.lens.setNearFar(near, far)
         self.lens.setFilmSize(*filmSize)
+        self.filmSize = filmSize[0]
         self.camera.setLens(self.lens)
         self.nearPlane = near
         self.farPlane = far
+        self.isParaboloid = 0
         self.rebuildMatrixCache()
 
     def rebuildMatrixCache(self):
         """ Computes values frequently used to compute the mvp """
-        self.converterYUR = Mat4.convertMat(CSYupRight, self.lens.getCoordinateSystem()) * self.lens.getProjectionMat()
+        self.converterYUR = Mat4.convertMat(CSYupRight, self.lens.getCoordinateSystem())
+
+        # The paraboloid projection is applied in the shaders
+        if not self.isParaboloid:
+            self.converterYUR = self.converterYUR * self.lens.getProjectionMat()
 
     def setPos(self, pos):
         """ Sets the position in world space """
@@ -171,16 +202,56 @@ class ShadowSource(DebugObject, ShaderStructElement):
         """ Sets the rotation in world space """
         self.cameraNode.setHpr(hpr)
 
+    def setQuat(self, quat):
+        """ Sets the rotation in world space as quaternion """
+        self.cameraNode.setQuat(quat)
+
+    def attach(self):
+        """ Attaches the camera of the source to the scene again, after it
+        got detached """
+        if not self.cameraNode.hasParent():
+            self.cameraNode.reparentTo(Globals.render)
+
+    def detach(self):
+        """ Detaches the camera of the source from the scene, called by the
+        LightManager when the light got removed """
+        self.cameraNode.detachNode()
+
     def lookAt(self, pos):
         """ Looks at a point (in world space) """
         self.cameraNode.lookAt(pos.x, pos.y, pos.z)
 
+    def getBounds(self):
+        """ Returns the bounds of the lens in world space """
+        bounds = self.lens.makeBounds()
+        bounds.xform(self.cameraNode.getMat(Globals.render))
+        return bounds
+
     def invalidate(self):
         """ Invalidates this shadow source, means telling the LightManager
         that the shadow map for this light should be rebuilt. Otherwise it
-        won't get refreshed """
+        won't get refreshed. This also invalidates the cached static
+        shadow casters """
+        self.valid = False
+        self.staticCacheValid = False
+
+    def invalidateDynamic(self):
+        """ Invalidates only the dynamic shadow casters of this source. When
+        static shadow casters are cached, only the dynamic casters get
+        rendered on top of the cache then. Otherwise this is the same as
+        invalidate """
         self.valid = False
 
+    def hasValidStaticCache(self):
+        """ Returns wheter the cached static shadow casters are still valid,
+        see LightManager """
+        return self.staticCacheValid
+
+    def setStaticCacheValid(self):
+        """ The LightManager calls this after the static shadow casters got
+        rendered to the cache """
+        self.staticCacheValid = True
+
     def setValid(self):
         """ The LightManager calls this after the shadow map got updated
         successfully """
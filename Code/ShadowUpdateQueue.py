@@ -0,0 +1,111 @@
+
+import heapq
+
+from DebugObject import DebugObject
+
+
+class ShadowUpdateQueue(DebugObject):
+
+    """ This class stores the ShadowSources which wait for a shadow map
+    update, used by the LightManager. It is backed by a heap and a
+    dictionary, so pushing, popping and membership tests don't have to
+    walk the whole queue.
+
+    Sources are ordered by their importance, which is computed by the
+    LightManager from the screen coverage of the light, and by how many
+    frames passed since the source got updated the last time. Because all
+    sources age with the same speed, the aging term can be folded into a
+    key which does not change over time:
+
+        importance + agingFactor * (frame - lastUpdate)
+
+    is ordered the same way as
+
+        importance - agingFactor * lastUpdate
+
+    so the heap never has to be rebuilt. """
+
+    def __init__(self, agingFactor=0.05):
+        """ Creates a new queue. agingFactor controls how much importance a
+        source gains for each frame it was not updated """
+        DebugObject.__init__(self, "ShadowUpdateQueue")
+        self.agingFactor = agingFactor
+        self.heap = []
+        self.entries = {}
+        self.importance = {}
+        self.lastUpdate = {}
+        self.counter = 0
+
+    def push(self, source, importance=None):
+        """ Queues a source. When no importance is passed, the last importance
+        of that source is used. If the source is already queued, it is only
+        moved to the front if the new importance is higher """
+
+        if importance is None:
+            importance = self.importance.get(source, 0.0)
+        self.importance[source] = importance
+
+        key = self.agingFactor * self.lastUpdate.get(source, 0) - importance
+
+        if source in self.entries:
+            entry = self.entries[source]
+            if entry[0] <= key:
+                return
+            # Invalidate the old entry, it gets skipped when popping
+            entry[2] = None
+
+        # The counter keeps sources with equal keys in FIFO order
+        entry = [key, self.counter, source]
+        self.counter += 1
+        self.entries[source] = entry
+        heapq.heappush(self.heap, entry)
+
+    def peek(self):
+        """ Returns the most important source without removing it, or None
+        if the queue is empty """
+        self._dropInvalidEntries()
+        if len(self.heap) < 1:
+            return None
+        return self.heap[0][2]
+
+    def pop(self):
+        """ Removes and returns the most important source, or None if the
+        queue is empty """
+        self._dropInvalidEntries()
+        if len(self.heap) < 1:
+            return None
+        source = heapq.heappop(self.heap)[2]
+        del self.entries[source]
+        return source
+
+    def remove(self, source):
+        """ Removes a source from the queue, if it is queued """
+        if source in self.entries:
+            self.entries[source][2] = None
+            del self.entries[source]
+
+    def forget(self, source):
+        """ Removes a source from the queue and also drops the stored
+        importance and update time """
+        self.remove(source)
+        self.importance.pop(source, None)
+        self.lastUpdate.pop(source, None)
+
+    def markUpdated(self, source, frame):
+        """ Tells the queue that the source got updated in the given frame,
+        this is used to compute the aging of the source """
+        self.lastUpdate[source] = frame
+
+    def _dropInvalidEntries(self):
+        """ Internal method to remove removed entries from the top of
+        the heap """
+        while len(self.heap) > 0 and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+
+    def __contains__(self, source):
+        """ Returns wheter the source is queued """
+        return source in self.entries
+
+    def __len__(self):
+        """ Returns the amount of queued sources """
+        return len(self.entries)
@@ -12,6 +12,50 @@ class SystemAnalyzer():
     """ Small tool to analyze the system and also check if the users panda
     build is out of date """
 
+    # Limits guaranteed by OpenGL 4.0, used when the gsg does not report
+    # the actual limits
+    MinFragmentUniformComponents = 1024
+    MinBufferTextureSize = 65536
+
+    @classmethod
+    def getGpuLimits(self, gsg):
+        """ Returns the maximum amount of uniform components of a fragment
+        shader and the maximum size of a buffer texture in texels. Panda3D
+        does not expose all of these limits in every version, missing ones are
+        replaced by the minimum OpenGL 4.0 guarantees """
+        uniformComponents = self.MinFragmentUniformComponents
+        bufferTextureSize = self.MinBufferTextureSize
+
+        if hasattr(gsg, "getMaxFragmentUniformComponents"):
+            uniformComponents = gsg.getMaxFragmentUniformComponents()
+        if hasattr(gsg, "getMaxBufferTextureSize"):
+            bufferTextureSize = gsg.getMaxBufferTextureSize()
+
+        return uniformComponents, bufferTextureSize
+
+    @classmethod
+    def checkLightLimits(self, gsg, uniformComponents, bufferTexels):
+        """ Checks if the light arrays fit into the gpu limits.
+        uniformComponents is the amount of uniform components the arrays use,
+        bufferTexels the size of the biggest buffer texture. Returns a list of
+        problems, which is empty if everything fits """
+        maxComponents, maxBufferTexels = self.getGpuLimits(gsg)
+        problems = []
+
+        if uniformComponents > maxComponents:
+            problems.append(
+                "The light arrays use " + str(uniformComponents) +
+                " uniform components, but the gpu supports only " +
+                str(maxComponents))
+
+        if bufferTexels > maxBufferTexels:
+            problems.append(
+                "The light arrays use buffer textures with " +
+                str(bufferTexels) + " texels, but the gpu supports only " +
+                str(maxBufferTexels))
+
+        return problems
+
     @classmethod
     def analyze(self):
         """ Analyzes the user system. This should help debugging when the user
@@ -0,0 +1,285 @@
+
+import math
+
+from DebugObject import DebugObject
+
+# NumPy is required for the tiled culling, but the pipeline itself does not
+# depend on this class, so don't fail on import
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TiledLightCuller(DebugObject):
+
+    """ This is a CPU reference implementation of the tiled light culling
+    done by Shader/PrecomputeLights.fragment and
+    Shader/Includes/LightCulling.include. It computes the min/max depth of
+    each patch of the depth buffer, builds the patch frustum and checks each
+    light against it, for all patches and lights at once with NumPy.
+
+    The results are the same light-per-tile lists the shader writes, so
+    this can be used to verify the shader, and to tune the patch size and
+    bound check settings without a window.
+
+    Conventions, to match the shader inputs:
+        - The depth buffer is an array of the shape (height, width) with
+          window space depth values from 0 .. 1, where row 0 is the bottom
+          row of the screen, like texelFetch sees it
+        - Matrices are 4x4 arrays applied to column vectors, like in GLSL.
+          Use fromPandaMatrix to convert a Panda3D matrix
+        - Tiles are indexed [tileY, tileX], again with row 0 at the bottom
+
+    Some details of the shader are reproduced on purpose, so the results
+    match: The min/max depth loop uses the patch width for both axes, and
+    the accurate bound check passes the NDC depth of the light to
+    getLinearZFromZ. """
+
+    # Name of each list, in the order the shader processes them, and the row
+    # in the 8x8 storage block where each list starts
+    LightLists = [
+        ("PointLight", 1),
+        ("PointLightShadow", 3),
+        ("DirectionalLight", 5),
+        ("DirectionalLightShadow", 6),
+    ]
+
+    # Lists which are culled. Directional lights are visible in every tile
+    CulledLists = ["PointLight", "PointLightShadow"]
+
+    def __init__(self, patchSizeX=32, patchSizeY=32, minMaxDepthAccuracy=1,
+                 anyBoundCheck=True, accurateBoundCheck=True,
+                 near=0.1, far=50000.0):
+        """ Creates a new culler. The parameters match the settings in
+        the [Lighting] section of pipeline.ini, and the camera near and far
+        plane """
+        DebugObject.__init__(self, "TiledLightCuller")
+
+        if numpy is None:
+            self.error("NumPy is required for the tiled light culling!")
+
+        self.patchSizeX = patchSizeX
+        self.patchSizeY = patchSizeY
+        self.minMaxDepthAccuracy = minMaxDepthAccuracy
+        self.anyBoundCheck = anyBoundCheck
+        self.accurateBoundCheck = accurateBoundCheck
+        self.near = float(near)
+        self.far = float(far)
+        self.viewMat = None
+        self.projMat = None
+        self.mvpMat = None
+
+    @classmethod
+    def fromSettings(cls, settings, near, far):
+        """ Creates a new culler which uses the same configuration as the
+        pipeline, settings should be a PipelineSettingsManager """
+        return cls(
+            patchSizeX=settings.computePatchSizeX,
+            patchSizeY=settings.computePatchSizeY,
+            minMaxDepthAccuracy=settings.minMaxDepthAccuracy,
+            anyBoundCheck=settings.anyLightBoundCheck,
+            accurateBoundCheck=settings.accurateLightBoundCheck,
+            near=near, far=far)
+
+    @staticmethod
+    def fromPandaMatrix(mat):
+        """ Converts a Panda3D LMatrix4 to a NumPy array applied to column
+        vectors. Panda3D matrices are applied to row vectors, so they have
+        to get transposed """
+        return numpy.array(
+            [[mat.getCell(col, row) for col in xrange(4)]
+             for row in xrange(4)], dtype=numpy.float64)
+
+    def setMatrices(self, viewMat, projMat):
+        """ Sets the view and projection matrix of the camera, equivalent to
+        VIEW_MAT and PROJ_MAT in the shader """
+        self.viewMat = numpy.asarray(viewMat, dtype=numpy.float64)
+        self.projMat = numpy.asarray(projMat, dtype=numpy.float64)
+        self.mvpMat = self.projMat.dot(self.viewMat)
+
+    def getTileCount(self, width, height):
+        """ Returns the amount of tiles (x, y) for the given screen size,
+        computed the same way as RenderingPipeline.precomputeSize """
+        return (int(math.ceil(float(width) / self.patchSizeX)),
+                int(math.ceil(float(height) / self.patchSizeY)))
+
+    def getLinearZFromZ(self, z):
+        """ Converts window space depth to linear depth, like the function
+        in PositionReconstruction.include """
+        zN = z * 2.0 - 1.0
+        return (2.0 * self.near * self.far) / \
+            ((self.near + self.far) - zN * (self.far - self.near))
+
+    def computeMinMaxDepth(self, depth):
+        """ Computes the linear minimum and maximum depth of each tile, using
+        the same sample pattern as the shader. Returns two arrays of the
+        shape (tilesY, tilesX) """
+        depth = numpy.asarray(depth)
+        height, width = depth.shape
+        tilesX, tilesY = self.getTileCount(width, height)
+
+        # Sample offsets within a patch, the shader uses a checkerboard
+        # pattern and the patch width for both axes
+        offsetsX, offsetsY = [], []
+        for x in xrange(0, self.patchSizeX, self.minMaxDepthAccuracy * 2):
+            for y in xrange(0, self.patchSizeX, self.minMaxDepthAccuracy):
+                offsetsX.append(x + y % 2)
+                offsetsY.append(y)
+
+        coordsX = numpy.arange(tilesX)[:, None] * self.patchSizeX + offsetsX
+        coordsY = numpy.arange(tilesY)[:, None] * self.patchSizeY + offsetsY
+        coordsX = numpy.minimum(coordsX, width - 1)
+        coordsY = numpy.minimum(coordsY, height - 1)
+
+        # Shape: (tilesY, tilesX, samples)
+        samples = depth[coordsY[:, None, :], coordsX[None, :, :]]
+
+        return (self.getLinearZFromZ(samples.min(axis=2)),
+                self.getLinearZFromZ(samples.max(axis=2)))
+
+    def cull(self, depth, lightPositions, lightRadii, lightLists):
+        """ Assigns the lights to the tiles of the depth buffer.
+
+        lightPositions and lightRadii store the world space position and
+        radius for each light index, like the lights array of the shader.
+        lightLists maps the list names from LightLists to the light indices
+        in that list, like arrayPointLight and so on.
+
+        Returns a dictionary which maps each list name to a tuple of the
+        light indices and a boolean array of the shape
+        (tilesY, tilesX, numLightsInList), which stores wheter the light
+        was assigned to the tile """
+
+        if self.viewMat is None:
+            self.error("Call setMatrices before culling!")
+            return None
+
+        depth = numpy.asarray(depth)
+        height, width = depth.shape
+        tilesX, tilesY = self.getTileCount(width, height)
+        minDepth, maxDepth = self.computeMinMaxDepth(depth)
+
+        positions = numpy.asarray(lightPositions, dtype=numpy.float64)
+        radii = numpy.asarray(lightRadii, dtype=numpy.float64)
+
+        result = {}
+        for listName, baseRow in self.LightLists:
+            indices = numpy.asarray(
+                lightLists.get(listName, []), dtype=numpy.int32)
+
+            if listName in self.CulledLists and len(indices) > 0:
+                visible = self._cullPointLights(
+                    positions[indices], radii[indices], tilesX, tilesY,
+                    minDepth, maxDepth)
+            else:
+                visible = numpy.ones(
+                    (tilesY, tilesX, len(indices)), dtype=bool)
+
+            result[listName] = (indices, visible)
+
+        return result
+
+    def _cullPointLights(self, positions, radii, tilesX, tilesY,
+                         minDepth, maxDepth):
+        """ Internal method to check the given point lights against all tile
+        frustums, see isPointLightInFrustum in LightCulling.include """
+
+        numLights = len(radii)
+
+        if not self.anyBoundCheck:
+            return numpy.ones((tilesY, tilesX, numLights), dtype=bool)
+
+        homogenous = numpy.ones((numLights, 4))
+        homogenous[:, 0:3] = positions
+        viewPos = homogenous.dot(self.viewMat.T)
+
+        # Build the tile frustum planes. The left and right planes only
+        # depend on the tile column, the top and bottom planes only on the
+        # tile row, so the test can be split
+        scaleX, scaleY = tilesX * 0.5, tilesY * 0.5
+        biasX = scaleX - numpy.arange(tilesX)
+        biasY = scaleY - numpy.arange(tilesY)
+
+        horizontal = self._checkPlanes(
+            self.projMat[0, 0] * scaleX, biasX, viewPos[:, 0], viewPos, radii)
+        vertical = self._checkPlanes(
+            self.projMat[1, 1] * scaleY, biasY, viewPos[:, 1], viewPos, radii)
+
+        visible = vertical[:, None, :] & horizontal[None, :, :]
+
+        if self.accurateBoundCheck:
+            clipPos = homogenous.dot(self.mvpMat.T)
+            projZ = clipPos[:, 2] / clipPos[:, 3]
+            linearProjZ = self.getLinearZFromZ(projZ) * 2.0 - 1.0
+            extent = math.sqrt(2.0) * radii
+
+            visible &= (linearProjZ - extent)[None, None, :] < \
+                maxDepth[:, :, None]
+            visible &= (linearProjZ + extent)[None, None, :] > \
+                minDepth[:, :, None]
+
+        return visible
+
+    def _checkPlanes(self, scale, bias, viewCoord, viewPos, radii):
+        """ Internal method to check the lights against the pair of planes
+        of each tile along one axis. Returns an array of the shape
+        (numTiles, numLights) """
+
+        # The planes are normalize(offset -+ (-scale, bias)), with
+        # offset = (0, 0, -1). The shader uses vec4 planes with w = 0, so
+        # the position w does not contribute
+        result = None
+        for sign in [1.0, -1.0]:
+            planeA = sign * scale
+            planeZ = -1.0 - sign * bias
+            length = numpy.sqrt(planeA * planeA + planeZ * planeZ)
+
+            dist = (planeA * viewCoord[None, :] +
+                    planeZ[:, None] * viewPos[None, :, 2]) / length[:, None]
+            inside = -radii[None, :] <= dist
+
+            result = inside if result is None else result & inside
+
+        return result
+
+    def getTileLists(self, result, tileX, tileY):
+        """ Returns a dictionary which maps each list name to the list of
+        light indices assigned to the given tile """
+        lists = {}
+        for listName, (indices, visible) in result.items():
+            lists[listName] = list(indices[visible[tileY, tileX]])
+        return lists
+
+    def buildStorage(self, result):
+        """ Builds the per tile storage texture the shader writes, as int32
+        array of the shape (tilesY * 8, tilesX * 8). Each tile has a 8x8
+        block, the first row stores the counts, the other rows the light
+        indices. Writes which would leave the block of a tile are dropped,
+        on the GPU they would end up in the neighbour tile """
+
+        visible = result[self.LightLists[0][0]][1]
+        tilesY, tilesX = visible.shape[0:2]
+        storage = numpy.zeros((tilesY * 8, tilesX * 8), dtype=numpy.int32)
+
+        for column, (listName, baseRow) in enumerate(self.LightLists):
+            indices, visible = result[listName]
+            tileY, tileX, lightIndex = numpy.nonzero(visible)
+            counts = visible.sum(axis=2)
+
+            # Position of each light in the list of its tile. nonzero returns
+            # the entries grouped by tile, so the slot is the distance to the
+            # first entry of the tile
+            tileId = tileY * tilesX + tileX
+            firstEntry = numpy.cumsum(counts.ravel()) - counts.ravel()
+            slot = numpy.arange(len(tileId)) - firstEntry[tileId]
+            row = baseRow + slot // 8
+            inBlock = row < 8
+
+            storage[tileY[inBlock] * 8 + row[inBlock],
+                    tileX[inBlock] * 8 + slot[inBlock] % 8] = \
+                indices[lightIndex[inBlock]]
+
+            storage[0::8, column::8] = counts
+
+        return storage
@@ -0,0 +1,234 @@
+
+from Code.DebugObject import DebugObject
+from WaterManager import OceanOptions, WaterManager
+
+# NumPy is required for the CPUOcean, but not for the rest of the pipeline
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CPUOcean(DebugObject):
+
+    """ This class simulates the ocean of the WaterManager on the cpu with
+    numpy.fft, so the wave height can be queried without a gpu, e.g. on a
+    dedicated server, or for buoyancy and networking.
+
+    The simulation mirrors the compute shaders of the WaterManager: The
+    initial spectrum is generated like InitialHeight.compute from the same
+    gaussian random texture, animated like Update.compute, transformed like
+    the GPUFFT passes, and combined to the displacement and normal fields
+    like Combine.compute. With the same OceanOptions, the fields match the
+    textures of the WaterManager up to the precision of the 16 bit float
+    textures.
+
+    The fields are arrays of the shape (size, size, 3), indexed with
+    [y, x] like the rows of the textures. The displacement field stores the
+    displacement in the rgb channels of the displacement texture, the normal
+    field the gradient and the folding stored in the normal texture.
+
+    Times are passed in seconds like the frame time, and get scaled by
+    OceanOptions.timeScale like in WaterManager.update. Positions are passed
+    in world space, where one patch of the ocean covers patchWorldSize
+    units. The fields repeat after each patch. """
+
+    GravityAcceleration = 981.0
+
+    def __init__(self, options=None, patchWorldSize=1.0):
+        """ Creates a new simulation. When no options are given, the options
+        of the WaterManager are used """
+        DebugObject.__init__(self, "CPUOcean")
+
+        if numpy is None:
+            self.error("NumPy is required for the CPUOcean!")
+
+        if options is None:
+            options = OceanOptions.createDefault()
+
+        self.options = options
+        self.size = options.size
+        self.patchWorldSize = patchWorldSize
+        self.lastTime = None
+        self.heightTime = None
+        self.heightField = None
+        self.displacementField = None
+        self.normalField = None
+
+        self._computeInitialSpectrum()
+
+    def _computeInitialSpectrum(self):
+        """ Internal method to compute the initial spectrum and the angular
+        frequencies, see InitialHeight.compute """
+        options = self.options
+        size = self.size
+
+        # Use the same random numbers as the gpu, including the 16 bit
+        # quantization of the texture
+        texels = WaterManager.generateGaussianTexels(size, options.randomSeed)
+        gaussian = texels[:, :, 2] + 1j * texels[:, :, 1]
+        gaussian = gaussian / 65535.0 * 10.0 - (5.0 + 5.0j)
+
+        coords = (numpy.arange(size) - size / 2.0) * \
+            (2.0 * numpy.pi / options.patchLength)
+        kx = coords[None, :]
+        ky = coords[:, None]
+        kSquared = kx * kx + ky * ky
+        kCos = kx * options.windDir.x + ky * options.windDir.y
+
+        # Phillips spectrum, with the center frequency set to 0
+        largestWave = options.windSpeed ** 2 / self.GravityAcceleration
+        smallestWave = largestWave / 1000.0
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            phillips = options.waveAmplitude * \
+                numpy.exp(-1.0 / (largestWave ** 2 * kSquared)) / \
+                (kSquared ** 3) * kCos * kCos
+        phillips[kCos < 0.0] *= options.windDependency
+        phillips *= numpy.exp(-kSquared * smallestWave ** 2)
+        phillips[kSquared == 0.0] = 0.0
+
+        self.initialHeight = numpy.sqrt(phillips) * gaussian * \
+            numpy.sqrt(0.5)
+        self.omega = numpy.sqrt(
+            self.GravityAcceleration * numpy.sqrt(kSquared))
+
+        # Update.compute fetches the initial height at -k, which is
+        # out of range for the first row and column and reads as 0
+        padded = numpy.zeros((size + 1, size + 1), dtype=numpy.complex128)
+        padded[:size, :size] = self.initialHeight
+        mirrored = size - numpy.arange(size)
+        self.initialHeightMirrored = padded[mirrored[:, None], mirrored]
+
+        # Normalized wave directions of the choppy displacement
+        indices = numpy.arange(size) - size * 0.5
+        dirX = numpy.tile(indices, (size, 1))
+        dirY = dirX.T.copy()
+        length = numpy.sqrt(dirX * dirX + dirY * dirY)
+        length[length < 1e-6] = numpy.inf
+        self.waveDirX = dirX / length
+        self.waveDirY = dirY / length
+
+        # The gpu fft outputs every second texel negated, see
+        # VerticalFFT.compute
+        self.checkerboard = numpy.where(
+            (numpy.arange(size)[:, None] + numpy.arange(size)) % 2 == 1,
+            -1.0, 1.0)
+
+    def _computeSpectrum(self, time):
+        """ Internal method to compute the height spectrum at the given time,
+        see Update.compute """
+        phase = self.omega * (1.0 + time * self.options.timeScale)
+        sinPhase, cosPhase = numpy.sin(phase), numpy.cos(phase)
+        h0 = self.initialHeight
+        h0Mirrored = self.initialHeightMirrored
+
+        sumH = h0 + h0Mirrored
+        diffH = h0 - h0Mirrored
+        return (sumH.real * cosPhase - sumH.imag * sinPhase) + 1j * \
+            (diffH.real * sinPhase + diffH.imag * cosPhase)
+
+    def _transform(self, spectra):
+        """ Internal method to transform the spectra like the GPUFFT, the
+        last two axes are transformed """
+        result = numpy.fft.fft2(spectra).real
+        result *= self.checkerboard
+        result /= self.options.normalizationFactor
+        result += 0.5
+        return result
+
+    def update(self, time):
+        """ Computes the displacement and normal fields at the given time.
+        This transforms all 3 displacement components, see sampleHeight to
+        query only the height """
+        if time == self.lastTime:
+            return
+
+        heightSpectrum = self._computeSpectrum(time)
+        spectra = numpy.array([
+            -1j * self.waveDirX * heightSpectrum,
+            -1j * self.waveDirY * heightSpectrum,
+            heightSpectrum])
+        fieldX, fieldY, fieldZ = self._transform(spectra)
+
+        choppyScale = self.options.choppyScale
+        displacement = numpy.empty((self.size, self.size, 3))
+        displacement[:, :, 0] = fieldX * choppyScale
+        displacement[:, :, 1] = fieldY * choppyScale
+        displacement[:, :, 2] = fieldZ
+
+        # Neighbour differences like Combine.compute, wrapping at the border
+        diffX = numpy.roll(displacement, -1, axis=1) - \
+            numpy.roll(displacement, 1, axis=1)
+        diffY = numpy.roll(displacement, -1, axis=0) - \
+            numpy.roll(displacement, 1, axis=0)
+
+        dx = diffX[:, :, 0:2] * (choppyScale * 4.0)
+        dy = diffY[:, :, 0:2] * (choppyScale * 4.0)
+        jacobian = (1.0 + dx[:, :, 0]) * (1.0 + dy[:, :, 1]) - \
+            dx[:, :, 1] * dy[:, :, 0]
+
+        normal = numpy.empty((self.size, self.size, 3))
+        normal[:, :, 0] = -diffX[:, :, 2]
+        normal[:, :, 1] = -diffY[:, :, 2]
+        normal[:, :, 2] = numpy.maximum(0.0, 1.0 - jacobian)
+
+        self.lastTime = time
+        self.displacementField = displacement
+        self.normalField = normal
+        self.heightTime = time
+        self.heightField = fieldZ
+
+    def getDisplacementField(self, time):
+        """ Returns the displacement field at the given time """
+        self.update(time)
+        return self.displacementField
+
+    def getNormalField(self, time):
+        """ Returns the normal field at the given time """
+        self.update(time)
+        return self.normalField
+
+    def getHeightField(self, time):
+        """ Returns the height, the blue channel of the displacement field,
+        at the given time. Only the height gets transformed when the other
+        fields are not needed """
+        if time != self.heightTime:
+            self.heightField = self._transform(self._computeSpectrum(time))
+            self.heightTime = time
+        return self.heightField
+
+    def sampleHeight(self, xs, ys, time):
+        """ Returns the height at the given world space positions, with
+        bilinear filtering like a texture lookup. xs and ys can be numbers
+        or arrays of the same shape """
+        return self._sampleBilinear(self.getHeightField(time), xs, ys)
+
+    def sampleDisplacement(self, xs, ys, time):
+        """ Returns the displacement at the given world space positions, as
+        array with the 3 components in the last axis """
+        return self._sampleBilinear(self.getDisplacementField(time), xs, ys)
+
+    def _sampleBilinear(self, field, xs, ys):
+        """ Internal method to sample a field with bilinear filtering and
+        wrapping, with the texel centers at half texels like on the gpu """
+        scale = self.size / float(self.patchWorldSize)
+        u = numpy.asarray(xs, dtype=numpy.float64) * scale - 0.5
+        v = numpy.asarray(ys, dtype=numpy.float64) * scale - 0.5
+
+        x0 = numpy.floor(u)
+        y0 = numpy.floor(v)
+        fx = u - x0
+        fy = v - y0
+        x0 = x0.astype(numpy.int64) % self.size
+        y0 = y0.astype(numpy.int64) % self.size
+        x1 = (x0 + 1) % self.size
+        y1 = (y0 + 1) % self.size
+
+        # Add an axis for the components of multi channel fields
+        if field.ndim == 3:
+            fx = fx[..., None]
+            fy = fy[..., None]
+
+        top = field[y0, x0] * (1.0 - fx) + field[y0, x1] * fx
+        bottom = field[y1, x0] * (1.0 - fx) + field[y1, x1] * fx
+        return top * (1.0 - fy) + bottom * fy
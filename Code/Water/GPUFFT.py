@@ -1,6 +1,7 @@
 
 from panda3d.core import PNMImage, Texture, LVecBase3d, NodePath
 from panda3d.core import ShaderAttrib, LVecBase2i, Vec2
+from direct.stdpy.file import open
 
 from Code.DebugObject import DebugObject
 from Code.BetterShader import BetterShader
@@ -8,13 +9,31 @@ from Code.Globals import Globals
 
 import math
 
+# NumPy is optional, without it the weights are computed one by one
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class GPUFFT(DebugObject):
 
     """ This is a collection of compute shaders to generate the inverse
-    fft efficiently on the gpu, with butterfly FFT and precomputed weights """
+    fft efficiently on the gpu, with butterfly FFT and precomputed weights.
+
+    Each texel of the source texture stores two complex values, in xy and
+    in zw, which are transformed at once. By default only the real part of
+    xy is stored in the result texture. In batched mode, the real and
+    imaginary part of xy and the real part of zw are stored in rgb, so one
+    instance transforms 3 real fields, see Update.compute for the packing.
+
+    The weights lookup texture only depends on the size. It is shared by
+    all instances, and with NumPy cached in the PipelineTemp/ mount. """
+
+    # Weights lookup textures of all instances, per size
+    _WeightsLookupTextures = {}
 
-    def __init__(self, N, sourceTex, normalizationFactor):
+    def __init__(self, N, sourceTex, normalizationFactor, batched=False):
         """ Creates a new fft instance. The source texture has to specified
         from the begining, as the shaderAttributes are pregenerated for
         performance reasons """
@@ -23,6 +42,7 @@ class GPUFFT(DebugObject):
         self.size = N
         self.log2Size = int(math.log(N, 2))
         self.normalizationFactor = normalizationFactor
+        self.batched = batched
 
         # Create a ping and a pong texture, because we can't write to the
         # same texture while reading to it (that would lead to unexpected
@@ -45,20 +65,14 @@ class GPUFFT(DebugObject):
         # Pregenerate weights & indices for the shaders
         self._computeWeighting()
 
-        # Pre generate the shaders, we have 2 passes: Horizontal and Vertical
-        # which both execute log2(N) times with varying radii
-        self.horizontalFFTShader = BetterShader.loadCompute(
-            "Shader/Water/HorizontalFFT.compute")
+        # We have 2 passes: Horizontal and Vertical which both execute
+        # log2(N) times with varying radii
         self.horizontalFFT = NodePath("HorizontalFFT")
-        self.horizontalFFT.setShader(self.horizontalFFTShader)
         self.horizontalFFT.setShaderInput(
             "precomputedWeights", self.weightsLookupTex)
         self.horizontalFFT.setShaderInput("N", LVecBase2i(self.size))
 
-        self.verticalFFTShader = BetterShader.loadCompute(
-            "Shader/Water/VerticalFFT.compute")
         self.verticalFFT = NodePath("VerticalFFT")
-        self.verticalFFT.setShader(self.verticalFFTShader)
         self.verticalFFT.setShaderInput(
             "precomputedWeights", self.weightsLookupTex)
         self.verticalFFT.setShaderInput("N", LVecBase2i(self.size))
@@ -70,10 +84,28 @@ class GPUFFT(DebugObject):
         self.resultTexture.setMinfilter(Texture.FTLinear)
         self.resultTexture.setMagfilter(Texture.FTLinear)
 
+        self.reloadShader()
+
+    def reloadShader(self):
+        """ Loads the fft shaders, and prepares the shader attributes again,
+        as they store the shader """
+        self.horizontalFFTShader = BetterShader.loadCompute(
+            "Shader/Water/HorizontalFFT.compute")
+        self.horizontalFFT.setShader(self.horizontalFFTShader)
+
+        self.verticalFFTShader = BetterShader.loadCompute(
+            "Shader/Water/VerticalFFT.compute")
+        self.verticalFFT.setShader(self.verticalFFTShader)
+
         # Prepare the shader attributes, so we don't have to regenerate them
         # every frame -> That is VERY slow (3ms per fft instance)
         self._prepareAttributes()
 
+    def getShaderSources(self):
+        """ Returns the shader files loaded by reloadShader """
+        return ["Shader/Water/HorizontalFFT.compute",
+                "Shader/Water/VerticalFFT.compute"]
+
     def getResultTexture(self):
         """ Returns the result texture, only contains valid data after execute
         was called at least once """
@@ -145,8 +177,108 @@ class GPUFFT(DebugObject):
                 temp = temp >> 1
             indices[j] = val
 
+    @staticmethod
+    def computeLookup(size):
+        """ Computes the indices and weights of the butterfly passes with
+        NumPy, equivalent to _generateIndices and _generateWeights. Returns
+        the indices A and B and the complex weights, as arrays of the shape
+        (log2(size), size) """
+        log2Size = int(math.log(size, 2))
+        texels = numpy.arange(size)
+        steps = (1 << numpy.arange(log2Size))[:, None]
+
+        goLeft = (texels // steps) % 2 == 1
+        indicesA = numpy.where(goLeft, texels - steps, texels)
+        indicesB = numpy.where(goLeft, texels, texels + steps)
+
+        # Reverse the bits of the first pass, see _reverseRow
+        for indices in [indicesA[0], indicesB[0]]:
+            remaining = indices.copy()
+            indices[:] = 0
+            for i in xrange(log2Size):
+                indices[:] = (indices << 1) | (remaining & 1)
+                remaining >>= 1
+
+        # Each pass consists of blocks of 2 * steps texels, the first half
+        # stores weight K, the second half the negated weight K
+        offsets = texels % (2 * steps)
+        K = offsets % steps
+        numIter = (size // 2) // steps
+        angles = 2.0 * math.pi * K * numIter / float(size)
+        weights = numpy.cos(angles) - 1j * numpy.sin(angles)
+        weights[offsets >= steps] *= -1
+        return indicesA, indicesB, weights
+
+    @classmethod
+    def computeLookupTexels(self, size):
+        """ Computes the ram image of the weights lookup texture, as
+        float32 array in BGRA order. The rows are stored reversed, so the
+        passes fetch them with butterflyIndex = log2(size) - pass - 1 """
+        indicesA, indicesB, weights = self.computeLookup(size)
+        texels = numpy.empty(indicesA.shape + (4,), dtype=numpy.float32)
+        texels[:, :, 0] = weights.real * 0.5 + 0.5
+        texels[:, :, 1] = indicesB / float(size)
+        texels[:, :, 2] = indicesA / float(size)
+        texels[:, :, 3] = weights.imag * 0.5 + 0.5
+        return texels[::-1].copy()
+
     def _computeWeighting(self):
-        """ Precomputes the weights & indices, and stores them in a texture """
+        """ Precomputes the weights & indices, and stores them in a texture.
+        The texture is shared with the other instances of the same size """
+        if self.size in self._WeightsLookupTextures:
+            self.weightsLookupTex = self._WeightsLookupTextures[self.size]
+            return
+
+        if numpy is None:
+            self._computeWeightingUnvectorized()
+        else:
+            texels = self._loadCachedLookup()
+            if texels is None:
+                self.debug("Pre-Generating weights & indices ..")
+                texels = self.computeLookupTexels(self.size)
+                self._writeCachedLookup(texels)
+
+            self.weightsLookupTex = Texture("Weights Lookup")
+            self.weightsLookupTex.setup2dTexture(
+                self.size, self.log2Size, Texture.TFloat, Texture.FRgba32)
+            self.weightsLookupTex.setRamImage(texels.tostring())
+
+        self.weightsLookupTex.setMinfilter(Texture.FTNearest)
+        self.weightsLookupTex.setMagfilter(Texture.FTNearest)
+        self.weightsLookupTex.setWrapU(Texture.WMClamp)
+        self.weightsLookupTex.setWrapV(Texture.WMClamp)
+        self._WeightsLookupTextures[self.size] = self.weightsLookupTex
+
+    def _getCachePath(self):
+        """ Internal method to get the path of the cached lookup """
+        return "PipelineTemp/FFTWeights-" + str(self.size) + ".bin"
+
+    def _loadCachedLookup(self):
+        """ Internal method to load the lookup texels from the disk cache.
+        Returns None if they are not cached """
+        try:
+            with open(self._getCachePath(), "rb") as handle:
+                content = handle.read()
+        except IOError:
+            return None
+
+        if len(content) != self.size * self.log2Size * 16:
+            self.warn("Ignoring invalid cached fft weights")
+            return None
+
+        return numpy.fromstring(content, dtype=numpy.float32)
+
+    def _writeCachedLookup(self, texels):
+        """ Internal method to store the lookup texels in the disk cache """
+        try:
+            with open(self._getCachePath(), "wb") as handle:
+                handle.write(texels.tostring())
+        except Exception, msg:
+            self.warn("Could not cache the fft weights:", msg)
+
+    def _computeWeightingUnvectorized(self):
+        """ Internal fallback method which computes the weights & indices
+        one by one, and stores them in a texture """
         indicesA = [[0 for i in xrange(self.size)]
                     for k in xrange(self.log2Size)]
         indicesB = [[0 for i in xrange(self.size)]
@@ -183,10 +315,6 @@ class GPUFFT(DebugObject):
         self.weightsLookupTex = Texture("Weights Lookup")
         self.weightsLookupTex.load(self.weightsLookup)
         self.weightsLookupTex.setFormat(Texture.FRgba16)
-        self.weightsLookupTex.setMinfilter(Texture.FTNearest)
-        self.weightsLookupTex.setMagfilter(Texture.FTNearest)
-        self.weightsLookupTex.setWrapU(Texture.WMClamp)
-        self.weightsLookupTex.setWrapV(Texture.WMClamp)
 
     def _prepareAttributes(self):
         """ Prepares all shaderAttributes, so that we have a list of
@@ -228,6 +356,7 @@ class GPUFFT(DebugObject):
             self.verticalFFT.setShaderInput("dest", dest)
             self.verticalFFT.setShaderInput(
                 "isLastPass", isLastPass)
+            self.verticalFFT.setShaderInput("isBatched", self.batched)
             self.verticalFFT.setShaderInput(
                 "normalizationFactor", self.normalizationFactor)
             self.verticalFFT.setShaderInput(
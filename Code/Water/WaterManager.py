@@ -13,6 +13,12 @@ from random import seed as setRandomSeed
 
 from math import sqrt, log, cos, pi
 
+# NumPy is optional, without it the random texture is generated per texel
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class OceanOptions:
 
@@ -29,18 +35,33 @@ class OceanOptions:
     timeScale = 0.8
     normalizationFactor = 150.0
 
+    # Seed of the gaussian random texture, the same seed always produces
+    # the same ocean
+    randomSeed = 523
+
+    @classmethod
+    def createDefault(cls):
+        """ Returns the options used by the WaterManager, so other
+        simulations like the CPUOcean produce the same ocean """
+        options = cls()
+        options.size = 512
+        options.windDir = Vec2(cls.windDir)
+        options.windDir.normalize()
+        options.waveAmplitude = cls.waveAmplitude * 1e-7
+        return options
+
 
 class WaterManager(DebugObject):
 
     """ Simple wrapper arround WaterDisplacement which combines 3 displacement
     maps into one, and also generates a normal map """
 
-    def __init__(self):
+    def __init__(self, pipeline=None):
+        """ Creates the water manager. When a pipeline is given, the water
+        shaders get reloaded when their files change, see
+        RenderingPipeline.addShaderStage """
         DebugObject.__init__(self, "WaterManager")
-        self.options = OceanOptions()
-        self.options.size = 512
-        self.options.windDir.normalize()
-        self.options.waveAmplitude *= 1e-7
+        self.options = OceanOptions.createDefault()
 
         self.displacementTex = Texture("Displacement")
         self.displacementTex.setup2dTexture(
@@ -52,27 +73,12 @@ class WaterManager(DebugObject):
             self.options.size, self.options.size,
             Texture.TFloat, Texture.FRgba16)
 
-        self.combineShader = BetterShader.loadCompute(
-            "Shader/Water/Combine.compute")
-
         self.ptaTime = PTAFloat.emptyArray(1)
 
         # Create a gaussian random texture, as shaders aren't well suited
         # for that
-        setRandomSeed(523)
-        self.randomStorage = PNMImage(self.options.size, self.options.size, 4)
-        self.randomStorage.setMaxval((2 ** 16) - 1)
-
-        for x in xrange(self.options.size):
-            for y in xrange(self.options.size):
-                rand1 = self._getGaussianRandom() / 10.0 + 0.5
-                rand2 = self._getGaussianRandom() / 10.0 + 0.5
-                self.randomStorage.setXel(x, y, LVecBase3d(rand1, rand2, 0))
-                self.randomStorage.setAlpha(x, y, 1.0)
-
         self.randomStorageTex = Texture("RandomStorage")
-        self.randomStorageTex.load(self.randomStorage)
-        self.randomStorageTex.setFormat(Texture.FRgba16)
+        self._generateRandomStorage()
         self.randomStorageTex.setMinfilter(Texture.FTNearest)
         self.randomStorageTex.setMagfilter(Texture.FTNearest)
 
@@ -84,11 +90,8 @@ class WaterManager(DebugObject):
         self.texInitialHeight.setMinfilter(Texture.FTNearest)
         self.texInitialHeight.setMagfilter(Texture.FTNearest)
 
-        # Create the shader which populates the initial height texture
-        self.shaderInitialHeight = BetterShader.loadCompute(
-            "Shader/Water/InitialHeight.compute")
+        # Create the node which populates the initial height texture
         self.nodeInitialHeight = NodePath("initialHeight")
-        self.nodeInitialHeight.setShader(self.shaderInitialHeight)
         self.nodeInitialHeight.setShaderInput("dest", self.texInitialHeight)
         self.nodeInitialHeight.setShaderInput(
             "N", LVecBase2i(self.options.size))
@@ -104,49 +107,31 @@ class WaterManager(DebugObject):
         self.nodeInitialHeight.setShaderInput(
             "randomTex", self.randomStorageTex)
 
-        self.attrInitialHeight = self.nodeInitialHeight.getAttrib(ShaderAttrib)
-
-        self.heightTextures = []
-        for i in xrange(3):
-
-            tex = Texture("Height")
-            tex.setup2dTexture(self.options.size, self.options.size,
-                               Texture.TFloat, Texture.FRgba16)
-            tex.setMinfilter(Texture.FTNearest)
-            tex.setMagfilter(Texture.FTNearest)
-            tex.setWrapU(Texture.WMClamp)
-            tex.setWrapV(Texture.WMClamp)
-            self.heightTextures.append(tex)
+        # The x and y displacement and the height spectrum are packed into
+        # one texture, see Update.compute
+        self.heightTexture = Texture("Height")
+        self.heightTexture.setup2dTexture(
+            self.options.size, self.options.size,
+            Texture.TFloat, Texture.FRgba16)
+        self.heightTexture.setMinfilter(Texture.FTNearest)
+        self.heightTexture.setMagfilter(Texture.FTNearest)
+        self.heightTexture.setWrapU(Texture.WMClamp)
+        self.heightTexture.setWrapV(Texture.WMClamp)
 
-        # Also create the shader which updates the spectrum
-        self.shaderUpdate = BetterShader.loadCompute(
-            "Shader/Water/Update.compute")
+        # Also create the node which updates the spectrum
         self.nodeUpdate = NodePath("update")
-        self.nodeUpdate.setShader(self.shaderUpdate)
-        self.nodeUpdate.setShaderInput("outH0x", self.heightTextures[0])
-        self.nodeUpdate.setShaderInput("outH0y", self.heightTextures[1])
-        self.nodeUpdate.setShaderInput("outH0z", self.heightTextures[2])
+        self.nodeUpdate.setShaderInput("outH0", self.heightTexture)
         self.nodeUpdate.setShaderInput("initialHeight", self.texInitialHeight)
         self.nodeUpdate.setShaderInput("N", LVecBase2i(self.options.size))
         self.nodeUpdate.setShaderInput("time", self.ptaTime)
-        self.attrUpdate = self.nodeUpdate.getAttrib(ShaderAttrib)
 
-        # Create 3 FFTs
-        self.fftX = GPUFFT(self.options.size, self.heightTextures[0],
-                           self.options.normalizationFactor)
-        self.fftY = GPUFFT(self.options.size, self.heightTextures[1],
-                           self.options.normalizationFactor)
-        self.fftZ = GPUFFT(self.options.size, self.heightTextures[2],
-                           self.options.normalizationFactor)
+        # Create one batched FFT for all 3 components
+        self.fft = GPUFFT(self.options.size, self.heightTexture,
+                          self.options.normalizationFactor, batched=True)
 
         self.combineNode = NodePath("Combine")
-        self.combineNode.setShader(self.combineShader)
         self.combineNode.setShaderInput(
-            "displacementX", self.fftX.getResultTexture())
-        self.combineNode.setShaderInput(
-            "displacementY", self.fftY.getResultTexture())
-        self.combineNode.setShaderInput(
-            "displacementZ", self.fftZ.getResultTexture())
+            "displacement", self.fft.getResultTexture())
         self.combineNode.setShaderInput("normalDest", self.normalTex)
         self.combineNode.setShaderInput(
             "displacementDest", self.displacementTex)
@@ -156,9 +141,113 @@ class WaterManager(DebugObject):
             "choppyScale", self.options.choppyScale)
         self.combineNode.setShaderInput(
             "gridLength", self.options.patchLength)
-        # Store only the shader attrib as this is way faster
+
+        self.isSetup = False
+        self._loadShaders()
+
+        if pipeline is not None:
+            pipeline.addShaderStage(
+                "Water", self.reloadShader, self.getShaderSources())
+
+    def _loadShaders(self):
+        """ Internal method to load the compute shaders and store the shader
+        attribs of the nodes """
+        self.shaderInitialHeight = BetterShader.loadCompute(
+            "Shader/Water/InitialHeight.compute")
+        self.nodeInitialHeight.setShader(self.shaderInitialHeight)
+
+        self.shaderUpdate = BetterShader.loadCompute(
+            "Shader/Water/Update.compute")
+        self.nodeUpdate.setShader(self.shaderUpdate)
+
+        self.combineShader = BetterShader.loadCompute(
+            "Shader/Water/Combine.compute")
+        self.combineNode.setShader(self.combineShader)
+
+        # Store only the shader attribs as this is way faster
+        self.attrInitialHeight = self.nodeInitialHeight.getAttrib(ShaderAttrib)
+        self.attrUpdate = self.nodeUpdate.getAttrib(ShaderAttrib)
         self.attrCombine = self.combineNode.getAttrib(ShaderAttrib)
 
+    def getShaderSources(self):
+        """ Returns the shader files loaded by reloadShader """
+        return ["Shader/Water/InitialHeight.compute",
+                "Shader/Water/Update.compute",
+                "Shader/Water/Combine.compute"] + self.fft.getShaderSources()
+
+    def reloadShader(self):
+        """ Reloads all water shaders, including the ones of the ffts. They
+        are reloaded automatically when the files change if the manager was
+        created with the pipeline """
+        self._loadShaders()
+        self.fft.reloadShader()
+
+        # The initial height depends on the shader, so compute it again
+        if self.isSetup:
+            self.setup()
+
+    @staticmethod
+    def generateGaussianTexels(size, seed, out=None):
+        """ Generates the texels of the gaussian random texture with NumPy,
+        as array of the shape (size, size, 4) with 16 bit components in the
+        BGRA order of the texture ram image. Red and green store two
+        gaussian random numbers mapped with x / 10 + 0.5, blue is 0 and
+        alpha 1. The result only depends on the seed. When out is given, the
+        texels are written to it instead of a new array """
+        if out is None:
+            out = numpy.empty((size, size, 4), dtype=numpy.uint16)
+
+        random = numpy.random.RandomState(seed)
+        gaussian = random.standard_normal((2, size, size))
+        gaussian /= 10.0
+        gaussian += 0.5
+        numpy.clip(gaussian, 0.0, 1.0, out=gaussian)
+        gaussian *= 65535.0
+
+        out[:, :, 0] = 0
+        numpy.rint(gaussian[1], out=out[:, :, 1], casting="unsafe")
+        numpy.rint(gaussian[0], out=out[:, :, 2], casting="unsafe")
+        out[:, :, 3] = 65535
+        return out
+
+    def _generateRandomStorage(self):
+        """ Internal method to fill the gaussian random texture. With NumPy,
+        the texels are written directly into the ram image of the texture,
+        otherwise they are generated one by one """
+        size = self.options.size
+
+        if numpy is None:
+            self.debug("NumPy not found, generating random texture per texel")
+            setRandomSeed(self.options.randomSeed)
+            randomStorage = PNMImage(size, size, 4)
+            randomStorage.setMaxval((2 ** 16) - 1)
+
+            for x in xrange(size):
+                for y in xrange(size):
+                    rand1 = self._getGaussianRandom() / 10.0 + 0.5
+                    rand2 = self._getGaussianRandom() / 10.0 + 0.5
+                    randomStorage.setXel(x, y, LVecBase3d(rand1, rand2, 0))
+                    randomStorage.setAlpha(x, y, 1.0)
+
+            self.randomStorageTex.load(randomStorage)
+            self.randomStorageTex.setFormat(Texture.FRgba16)
+            return
+
+        self.randomStorageTex.setup2dTexture(
+            size, size, Texture.TUnsignedShort, Texture.FRgba16)
+
+        try:
+            ramImage = numpy.asarray(
+                memoryview(self.randomStorageTex.modifyRamImage()))
+        except TypeError:
+            # Older Panda3D builds don't expose the buffer interface
+            self.randomStorageTex.setRamImage(self.generateGaussianTexels(
+                size, self.options.randomSeed).tostring())
+        else:
+            self.generateGaussianTexels(
+                size, self.options.randomSeed,
+                ramImage.view(numpy.uint16).reshape(size, size, 4))
+
     def _getGaussianRandom(self):
         """ Returns a gaussian random number """
         u1 = generateRandom()
@@ -169,6 +258,7 @@ class WaterManager(DebugObject):
 
     def setup(self):
         """ Setups the manager """
+        self.isSetup = True
 
         Globals.base.graphicsEngine.dispatch_compute(
             (self.options.size / 16,
@@ -196,11 +286,9 @@ class WaterManager(DebugObject):
              self.options.size / 16, 1), self.attrUpdate,
             Globals.base.win.get_gsg())
 
-        self.fftX.execute()
-        self.fftY.execute()
-        self.fftZ.execute()
+        self.fft.execute()
 
-        # Execute the shader which combines the 3 displacement maps into
+        # Execute the shader which combines the 3 displacement components into
         # 1 displacement texture and 1 normal texture. We could use dFdx in
         # the fragment shader, however that gives no accurate results as
         # dFdx returns the same value for a 2x2 pixel block
@@ -14,16 +14,37 @@ layout(triangle_strip, max_vertices=SHADOW_GEOMETRY_MAX_VERTICES) out;
 uniform int numUpdates;
 uniform ShadowSource updateSources[SHADOW_MAX_UPDATES_PER_FRAME];
 
+// Bitmasks of the updates to render. The active mask selects the updates of
+// the current pass, the caster mask the updates this node is visible in
+uniform int activeUpdateMask;
+uniform int shadowCasterMask;
+
 in vec2 vtxTexcoord[3];
 out vec2 texcoord;
 
 void main() {
+  int updateMask = activeUpdateMask & shadowCasterMask;
   for (int pass = 0; pass < numUpdates; pass ++) {
+    if ((updateMask & (1 << pass)) == 0) continue;
     ShadowSource currentSource = updateSources[pass];
+    bool paraboloid = currentSource.isParaboloid != 0;
+
+    // Paraboloid maps only cover the hemisphere in front of the source
+    if (paraboloid) {
+      bool behind = true;
+      for(int i=0; i<gl_in.length; i++) {
+        behind = behind && (currentSource.mvp * gl_in[i].gl_Position).y < 0.0;
+      }
+      if (behind) continue;
+    }
+
     gl_ViewportIndex = pass + 1;
     for(int i=0; i<gl_in.length; i++)
     {
       gl_Position = currentSource.mvp * gl_in[i].gl_Position;
+      if (paraboloid) {
+        gl_Position = transformParabol(gl_Position, currentSource.nearPlane, currentSource.farPlane);
+      }
       texcoord = vtxTexcoord[i];
       EmitVertex();
     }
@@ -0,0 +1,85 @@
+
+"""
+
+Benchmark for the light culling of the LightManager
+
+Compares culling each light with BoundingVolume.contains (like the old
+LightManager.updateLights did) against the vectorized LightCuller.
+Requires NumPy.
+
+"""
+
+import sys
+import time
+import random
+
+sys.path.insert(0, "../../")
+
+from panda3d.core import PerspectiveLens, BoundingSphere, Point3, Mat4
+
+from Code.LightCuller import LightCuller, numpy
+
+
+class BenchmarkLight:
+
+    """ Minimal light, only providing the bounds """
+
+    def __init__(self, pos, radius):
+        self.bounds = BoundingSphere(pos, radius)
+
+    def getBounds(self):
+        return self.bounds
+
+
+def measure(func, repeats=10):
+    """ Returns the average time of func in milliseconds """
+    start = time.clock()
+    for i in xrange(repeats):
+        func()
+    return (time.clock() - start) / repeats * 1000.0
+
+
+if __name__ == "__main__":
+
+    if numpy is None:
+        print "NumPy is required for this benchmark!"
+        sys.exit(0)
+
+    random.seed(42)
+
+    # Camera at the origin, looking along +Y
+    lens = PerspectiveLens()
+    lens.setFov(90)
+    lens.setNearFar(0.1, 1000.0)
+    cullBounds = lens.makeBounds()
+    cullBounds.xform(Mat4.identMat())
+
+    print "Lights".rjust(10), "Loop (ms)".rjust(12), "Vectorized (ms)".rjust(18), "Visible".rjust(10)
+
+    for numLights in [100, 1000, 10000, 50000, 100000]:
+        lights = []
+        culler = LightCuller()
+
+        for i in xrange(numLights):
+            pos = Point3(random.uniform(-500, 500), random.uniform(-500, 500),
+                         random.uniform(-500, 500))
+            light = BenchmarkLight(pos, random.uniform(1, 30))
+            lights.append(light)
+            culler.setLight(i, light, "PointLight")
+
+        def cullLoop():
+            return [i for i, light in enumerate(lights)
+                    if cullBounds.contains(light.getBounds())]
+
+        def cullVectorized():
+            return culler.cull(cullBounds)["PointLight"]
+
+        # Both methods should find the same lights, except for lights which
+        # touch a plane within float precision
+        mismatches = set(cullLoop()) ^ set(cullVectorized())
+        if len(mismatches) > 0:
+            print "Warning: Results differ for", len(mismatches), "lights"
+
+        print str(numLights).rjust(10), ("%.3f" % measure(cullLoop)).rjust(12), \
+            ("%.3f" % measure(cullVectorized)).rjust(18), \
+            str(len(cullVectorized())).rjust(10)
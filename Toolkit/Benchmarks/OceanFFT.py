@@ -0,0 +1,261 @@
+
+"""
+
+Benchmark for the CPU ocean simulation
+
+Compares the CPUOcean against a port of the compute shaders of the
+WaterManager (InitialHeight, Update, the batched butterfly passes of the
+GPUFFT with its weights lookup texture, and Combine). Computed at full
+precision, the displacement and normal fields have to match up to the
+float precision of the lookup, otherwise the script exits with code 1.
+The vectorized lookup of the GPUFFT is checked against its unvectorized
+generation too.
+Then the difference to the port storing the intermediate results with the
+precision of the 16 bit float textures of the gpu path is printed.
+Afterwards the update of the fields and the height queries are measured.
+Requires NumPy.
+
+Usage:
+    python OceanFFT.py [size] [numSamples]
+
+"""
+
+import sys
+import time
+
+sys.path.insert(0, "../../")
+
+from Code.Water.WaterManager import OceanOptions, WaterManager
+from Code.Water.GPUFFT import GPUFFT
+from Code.Water.CPUOcean import CPUOcean, numpy
+
+
+def toHalf(values):
+    """ Rounds to the precision of a 16 bit float texture """
+    if numpy.iscomplexobj(values):
+        return toHalf(values.real) + 1j * toHalf(values.imag)
+    return values.astype(numpy.float16).astype(numpy.float64)
+
+
+def keepPrecision(values):
+    """ Replaces toHalf to compute at full precision """
+    return values
+
+
+class ButterflyLookup(GPUFFT):
+
+    """ GPUFFT which only generates the indices and weights, without
+    creating the textures and shaders """
+
+    def __init__(self, size):
+        self.size = size
+        self.log2Size = int(numpy.log2(size))
+
+
+def verifyLookup(size):
+    """ Compares GPUFFT.computeLookup against the unvectorized generation
+    of the indices and weights. Returns the number of errors """
+    fft = ButterflyLookup(size)
+    indicesA = [[0] * size for i in xrange(fft.log2Size)]
+    indicesB = [[0] * size for i in xrange(fft.log2Size)]
+    weights = [[None] * size for i in xrange(fft.log2Size)]
+    fft._generateIndices(indicesA, indicesB)
+    fft._reverseRow(indicesA[0])
+    fft._reverseRow(indicesB[0])
+    fft._generateWeights(weights)
+    weights = [[w.x + 1j * w.y for w in row] for row in weights]
+
+    resultA, resultB, resultWeights = GPUFFT.computeLookup(size)
+    if (resultA != indicesA).any() or (resultB != indicesB).any() or \
+            not numpy.allclose(resultWeights, weights, atol=1e-6):
+        print "Vectorized fft lookup differs!"
+        return 1
+    return 0
+
+
+def makeButterflyLookup(size):
+    """ Reads the indices and weights from the texels of the weights
+    lookup texture, like the fft shaders. Returns the indices A and B and
+    the complex weights, indexed with [pass, texel] """
+    texels = GPUFFT.computeLookupTexels(size).astype(numpy.float64)
+
+    # The passes fetch their row with butterflyIndex = log2Size - pass - 1
+    texels = texels[::-1]
+    indicesA = (texels[:, :, 2] * size + 0.5).astype(numpy.int64)
+    indicesB = (texels[:, :, 1] * size + 0.5).astype(numpy.int64)
+    weights = (texels[:, :, 0] * 2.0 - 1.0) + \
+        1j * (texels[:, :, 3] * 2.0 - 1.0)
+    return indicesA, indicesB, weights
+
+
+def simulateGPU(options, frameTime, halfPrecision=True):
+    """ Port of the compute shaders, returns the displacement and normal
+    fields at the given frame time """
+    toHalf = globals()["toHalf"] if halfPrecision else keepPrecision
+    size = options.size
+    gravity = 981.0
+    y, x = numpy.mgrid[0:size, 0:size]
+
+    # InitialHeight.compute
+    texels = WaterManager.generateGaussianTexels(size, options.randomSeed)
+    randomR = texels[:, :, 2] / 65535.0 * 10.0 - 5.0
+    randomG = texels[:, :, 1] / 65535.0 * 10.0 - 5.0
+    kx = (-size / 2.0 + x) * (2.0 * numpy.pi / options.patchLength)
+    ky = (-size / 2.0 + y) * (2.0 * numpy.pi / options.patchLength)
+
+    l = options.windSpeed ** 2 / gravity
+    w = l / 1000.0
+    kSqr = kx * kx + ky * ky
+    kCos = kx * options.windDir.x + ky * options.windDir.y
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        phillips = options.waveAmplitude * numpy.exp(-1.0 / (l * l * kSqr)) \
+            / (kSqr * kSqr * kSqr) * (kCos * kCos)
+    phillips = numpy.where(kCos < 0.0, phillips * options.windDependency,
+                           phillips) * numpy.exp(-kSqr * w * w)
+    phil = numpy.where(kSqr == 0.0, 0.0, numpy.sqrt(phillips))
+
+    h0 = toHalf(phil * randomR * 0.7071068 + 1j * phil * randomG * 0.7071068)
+    omega = toHalf(numpy.sqrt(gravity * numpy.sqrt(kSqr)))
+
+    # Update.compute, fetches outside of the texture return 0
+    padded = numpy.zeros((size + 1, size + 1), dtype=numpy.complex128)
+    padded[:size, :size] = h0
+    h0mk = padded[size - y, size - x]
+
+    phase = omega * (1 + frameTime * options.timeScale)
+    sinV, cosV = numpy.sin(phase), numpy.cos(phase)
+    ht = ((h0.real + h0mk.real) * cosV - (h0.imag + h0mk.imag) * sinV) + 1j * \
+        ((h0.real - h0mk.real) * sinV + (h0.imag - h0mk.imag) * cosV)
+
+    dirX = x - size * 0.5
+    dirY = y - size * 0.5
+    sqrK = dirX * dirX + dirY * dirY
+    rsqrK = numpy.where(sqrK > 1e-12, 1.0 / numpy.sqrt(numpy.maximum(
+        sqrK, 1e-12)), 0.0)
+    dirX, dirY = dirX * rsqrK, dirY * rsqrK
+    dtX = ht.imag * dirX - 1j * ht.real * dirX
+    dtY = ht.imag * dirY - 1j * ht.real * dirY
+
+    # Pack the hermitian parts of Dx and Dy as Dx + i * Dy
+    mirrorX, mirrorY = (size - x) % size, (size - y) % size
+    hermitianX = (dtX + numpy.conj(dtX[mirrorY, mirrorX])) * 0.5
+    hermitianY = (dtY + numpy.conj(dtY[mirrorY, mirrorX])) * 0.5
+    sources = [toHalf(hermitianX + 1j * hermitianY), toHalf(ht)]
+
+    # HorizontalFFT.compute and VerticalFFT.compute, transforming xy and zw
+    indicesA, indicesB, weights = makeButterflyLookup(size)
+    transformed = []
+    for data in sources:
+        for row in xrange(len(weights)):
+            data = data[:, indicesA[row]] + \
+                weights[row][None, :] * data[:, indicesB[row]]
+        for row in xrange(len(weights)):
+            data = data[indicesA[row], :] + \
+                weights[row][:, None] * data[indicesB[row], :]
+        transformed.append(numpy.where((x + y) % 2 == 1, -data, data))
+
+    results = [transformed[0].real, transformed[0].imag, transformed[1].real]
+    results = [toHalf(result / options.normalizationFactor + 0.5)
+               for result in results]
+
+    # Combine.compute
+    def getDisplacement(offsetX, offsetY):
+        coordX = (x + offsetX) % size
+        coordY = (y + offsetY) % size
+        return numpy.dstack([
+            results[0][coordY, coordX] * options.choppyScale,
+            results[1][coordY, coordX] * options.choppyScale,
+            results[2][coordY, coordX]])
+
+    combined = getDisplacement(0, 0)
+    left, right = getDisplacement(-1, 0), getDisplacement(1, 0)
+    back, front = getDisplacement(0, -1), getDisplacement(0, 1)
+
+    dx = (right[:, :, 0:2] - left[:, :, 0:2]) * options.choppyScale * 4.0
+    dy = (front[:, :, 0:2] - back[:, :, 0:2]) * options.choppyScale * 4.0
+    jacobian = (1.0 + dx[:, :, 0]) * (1.0 + dy[:, :, 1]) - \
+        dx[:, :, 1] * dy[:, :, 0]
+    normal = numpy.dstack([
+        -(right[:, :, 2] - left[:, :, 2]),
+        -(front[:, :, 2] - back[:, :, 2]),
+        numpy.maximum(0.0, 1.0 - jacobian)])
+
+    return toHalf(combined), toHalf(normal)
+
+
+def measure(func, repeats=10):
+    """ Returns the average time of func in milliseconds """
+    start = time.clock()
+    for i in xrange(repeats):
+        func()
+    return (time.clock() - start) / repeats * 1000.0
+
+
+def verify(options):
+    """ Compares the CPUOcean against the port of the shaders, returns the
+    number of errors """
+    errors = 0
+    ocean = CPUOcean(options)
+
+    for frameTime in [0.0, 1.5, 40.0]:
+        for halfPrecision in [False, True]:
+            displacement, normal = simulateGPU(
+                options, frameTime, halfPrecision)
+
+            for name, expected, result in [
+                    ("Displacement", displacement,
+                     ocean.getDisplacementField(frameTime)),
+                    ("Normal", normal, ocean.getNormalField(frameTime))]:
+                difference = numpy.abs(expected - result).max()
+
+                if halfPrecision:
+                    print "  Max difference with 16 bit textures", \
+                        name.lower(), "at", frameTime, ": %.5f" % difference
+                elif difference > numpy.abs(expected).max() * 1e-3:
+                    print name, "differs by", difference, "at", frameTime
+                    errors += 1
+
+        # Sampling at the texel centers returns the texels
+        heights = ocean.sampleHeight(
+            (numpy.arange(options.size) + 0.5) / options.size, 0.5 /
+            options.size, frameTime)
+        if not numpy.allclose(heights, ocean.getHeightField(frameTime)[0]):
+            print "Sampled heights differ at", frameTime
+            errors += 1
+
+    return errors
+
+
+if __name__ == "__main__":
+
+    if numpy is None:
+        print "NumPy is required for this benchmark!"
+        sys.exit(0)
+
+    options = OceanOptions.createDefault()
+    numSamples = 10000
+
+    if len(sys.argv) > 1:
+        options.size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        numSamples = int(sys.argv[2])
+
+    print "Verifying the CPU ocean .."
+    if verifyLookup(options.size) + verify(options) > 0:
+        print "CPU ocean results differ from the gpu path!"
+        sys.exit(1)
+
+    ocean = CPUOcean(options, patchWorldSize=100.0)
+    xs = numpy.random.uniform(-500, 500, numSamples)
+    ys = numpy.random.uniform(-500, 500, numSamples)
+    frameTimes = iter(numpy.arange(1000) * 0.016)
+
+    print "Size:", options.size, "x", options.size
+    print "Update all fields (ms):".ljust(30), "%.2f" % measure(
+        lambda: ocean.update(next(frameTimes)))
+    print "Update height (ms):".ljust(30), "%.2f" % measure(
+        lambda: ocean.getHeightField(next(frameTimes)))
+    print ("Sample %d heights (ms):" % numSamples).ljust(30), "%.2f" % \
+        measure(lambda: ocean.sampleHeight(xs, ys, 1.0), repeats=100)
+    print "Shader port (ms):".ljust(30), "%.2f" % measure(
+        lambda: simulateGPU(options, next(frameTimes)), repeats=1)
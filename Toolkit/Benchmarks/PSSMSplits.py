@@ -0,0 +1,196 @@
+
+"""
+
+Benchmark for the PSSM split computation
+
+Compares the per split computation of DirectionalLight (ported to plain
+Python, without the Panda3D calls) against the PSSMCascadeSolver, which
+computes all splits at once. Before measuring, the results are compared,
+and the texel snapping is verified: Snapped splits have to map the world
+origin to a texel corner, and small camera movements must not move the
+splits. Exits with a non-zero exit code on errors. Requires NumPy.
+
+Usage:
+    python PSSMSplits.py [numSplits]
+
+"""
+
+import sys
+import time
+import math
+import random
+
+sys.path.insert(0, "../../")
+
+from Code.PSSMCascadeSolver import PSSMCascadeSolver, numpy
+
+
+RESOLUTION = 2048
+
+
+def makeInverseProjection(fov, aspect, near, far):
+    """ Returns the inverse of a Panda3D perspective projection matrix (Z-up,
+    looking along +Y), applied to row vectors """
+    f = 1.0 / math.tan(math.radians(fov) / 2.0)
+    proj = numpy.array([
+        [f / aspect, 0, 0, 0],
+        [0, 0, (far + near) / (far - near), 1],
+        [0, f, 0, 0],
+        [0, 0, -2.0 * far * near / (far - near), 0]])
+    return numpy.linalg.inv(proj)
+
+
+def makeCameraMatrix(pos, heading):
+    """ Returns the transform of a camera at pos, rotated around Z """
+    c, s = math.cos(heading), math.sin(heading)
+    mat = numpy.identity(4)
+    mat[0, 0:2] = (c, s)
+    mat[1, 0:2] = (-s, c)
+    mat[3, 0:3] = pos
+    return mat
+
+
+def makeBasis(direction):
+    """ Returns the light basis (right, forward, up) for a light direction """
+    forward = -direction / numpy.linalg.norm(direction)
+    right = numpy.cross(forward, (0, 0, 1))
+    right /= numpy.linalg.norm(right)
+    return numpy.array([right, forward, numpy.cross(right, forward)])
+
+
+def solvePerSplit(points, direction, numSplits, splitPow, relativeSplitSize):
+    """ Port of the split loop of DirectionalLight._updateShadowSources
+    without snapping. Returns a list of (position, filmSize) """
+    nearPoint, farPoint, trNearPoint, trFarPoint = [list(p) for p in points]
+    mixVector = lambda p1, p2, a: [b * a + c * (1.0 - a)
+                                   for b, c in zip(p2, p1)]
+    splitFunc = lambda x: math.pow(
+        float(x + 0.5) / (numSplits + 0.5), splitPow)
+
+    result = []
+    for i in xrange(numSplits):
+        splitParamStart = splitFunc(i) * relativeSplitSize
+        splitParamEnd = splitFunc(i + 1) * relativeSplitSize
+
+        midPos = mixVector(nearPoint, farPoint,
+                           (splitParamStart + splitParamEnd) / 2.0)
+        topPlanePos = mixVector(trNearPoint, trFarPoint, splitParamEnd)
+
+        filmSize = math.sqrt(sum((a - b) ** 2 for a, b in
+                                 zip(topPlanePos, midPos))) * 1.41
+        destPos = [m + d * 300.0 for m, d in zip(midPos, direction)]
+        result.append((destPos, filmSize))
+    return result
+
+
+def solveVectorized(solver, camMat, projMatInv, direction, basis, snap,
+                    splitPow=2.0, relativeSplitSize=0.2):
+    """ Computes the splits like DirectionalLight does with the solver """
+    points = solver.computeFrustumPoints(camMat, projMatInv)
+    centers, positions, filmSizes = solver.solve(
+        points, (0, 0, 0), direction, splitPow, relativeSplitSize)
+    filmSizes = solver.stabilizeFilmSizes(filmSizes)
+    if snap:
+        positions = solver.snapToTexels(
+            positions, filmSizes, basis, RESOLUTION)
+    matrices = solver.computeViewProjections(positions, filmSizes, basis)
+    return points, positions, filmSizes, matrices
+
+
+def measure(func, repeats=200):
+    """ Returns the average time of func in milliseconds """
+    start = time.clock()
+    for i in xrange(repeats):
+        func()
+    return (time.clock() - start) / repeats * 1000.0
+
+
+def verify(numSplits):
+    """ Checks the solver against the per split computation, and the
+    snapping. Returns the number of errors """
+    errors = 0
+    projMatInv = makeInverseProjection(60.0, 16.0 / 9.0, 0.1, 5000.0)
+    direction = numpy.array([0.3, 0.4, 0.8])
+    direction /= numpy.linalg.norm(direction)
+    basis = makeBasis(direction)
+
+    for i in xrange(20):
+        camMat = makeCameraMatrix(
+            [random.uniform(-500, 500) for j in xrange(3)],
+            random.uniform(0, 2 * math.pi))
+
+        solver = PSSMCascadeSolver(numSplits)
+        points, positions, filmSizes, matrices = solveVectorized(
+            solver, camMat, projMatInv, direction, basis, False)
+
+        for (expectedPos, expectedFilm), pos, film in zip(
+                solvePerSplit(points, direction, numSplits, 2.0, 0.2),
+                positions, filmSizes):
+            if not numpy.allclose(expectedPos, pos) or \
+                    not numpy.allclose(expectedFilm, film):
+                errors += 1
+
+        # The shadow camera has to look at the center of the split
+        centers = positions - direction * solver.SourceDistance
+        homogenous = numpy.ones((numSplits, 4))
+        homogenous[:, 0:3] = centers
+        clip = numpy.einsum("sij,sj->si", matrices, homogenous)
+        if not numpy.allclose(clip[:, 0:2], 0.0):
+            errors += 1
+
+        # With snapping, the origin has to be on a texel corner
+        points, positions, filmSizes, matrices = solveVectorized(
+            solver, camMat, projMatInv, direction, basis, True)
+        origin = matrices[:, 0:2, 3] * 0.5 * RESOLUTION
+        if not numpy.allclose(origin, numpy.round(origin), atol=1e-3):
+            errors += 1
+
+        # Moving less than half a texel must not move any split, even when
+        # repeated, but the movements have to add up
+        texel = filmSizes.min() / RESOLUTION
+        solver.reset()
+        for step in xrange(5):
+            positions = solveVectorized(
+                solver, camMat, projMatInv, direction, basis, False)[1]
+            moved = solver.findMovedSplits(positions, filmSizes, RESOLUTION)
+            if moved[0] != (step in [0, 4]):
+                errors += 1
+            camMat[3, 0] += texel * 0.15
+
+    return errors
+
+
+if __name__ == "__main__":
+
+    if numpy is None:
+        print "NumPy is required for this benchmark!"
+        sys.exit(0)
+
+    random.seed(42)
+
+    numSplits = 4
+    if len(sys.argv) == 2:
+        numSplits = int(sys.argv[1])
+
+    print "Verifying the cascade solver .."
+    if verify(numSplits) > 0:
+        print "Cascade solver results are wrong!"
+        sys.exit(1)
+
+    projMatInv = makeInverseProjection(60.0, 16.0 / 9.0, 0.1, 5000.0)
+    camMat = makeCameraMatrix((10, 20, 5), 0.3)
+    direction = numpy.array([0.3, 0.4, 0.8])
+    direction /= numpy.linalg.norm(direction)
+    basis = makeBasis(direction)
+    solver = PSSMCascadeSolver(numSplits)
+    points = solver.computeFrustumPoints(camMat, projMatInv)
+
+    print "Splits:", numSplits
+    print "Per split (ms):".ljust(25), "%.4f" % measure(
+        lambda: solvePerSplit(points, direction, numSplits, 2.0, 0.2))
+    print "Solver (ms):".ljust(25), "%.4f" % measure(
+        lambda: solveVectorized(solver, camMat, projMatInv, direction,
+                                basis, False))
+    print "Solver + snapping (ms):".ljust(25), "%.4f" % measure(
+        lambda: solveVectorized(solver, camMat, projMatInv, direction,
+                                basis, True))
@@ -0,0 +1,259 @@
+
+"""
+
+Benchmark for the tiled light culling
+
+Runs the NumPy implementation of Shader/PrecomputeLights.fragment
+(Code/TiledLightCuller.py) on synthetic depth buffers and light sets, for
+different patch sizes and bound check settings. Before measuring, the
+results are compared with a direct line-by-line port of the shader, and the
+script exits with a non-zero exit code when they differ, so it can be used
+to catch regressions. Also measures the clustered light assignment
+(Code/ClusteredLightCuller.py). Requires NumPy.
+
+Usage:
+    python TiledLightCulling.py [width height numLights]
+
+"""
+
+import sys
+import time
+import math
+import random
+
+sys.path.insert(0, "../../")
+
+from Code.TiledLightCuller import TiledLightCuller, numpy
+from Code.ClusteredLightCuller import ClusteredLightCuller
+
+
+NEAR = 0.1
+FAR = 50000.0
+
+
+def makeProjectionMatrix(fov, aspect):
+    """ Returns an OpenGL perspective projection matrix """
+    f = 1.0 / math.tan(math.radians(fov) / 2.0)
+    return numpy.array([
+        [f / aspect, 0, 0, 0],
+        [0, f, 0, 0],
+        [0, 0, (FAR + NEAR) / (NEAR - FAR), 2.0 * FAR * NEAR / (NEAR - FAR)],
+        [0, 0, -1, 0]])
+
+
+def makeDepthBuffer(width, height, numBoxes=40):
+    """ Creates a synthetic depth buffer with a sky background and some
+    screen aligned boxes at random distances """
+    linear = numpy.full((height, width), FAR * 0.99)
+
+    for i in xrange(numBoxes):
+        x, y = random.randint(0, width - 1), random.randint(0, height - 1)
+        w, h = random.randint(8, width / 3), random.randint(8, height / 3)
+        linear[y:y + h, x:x + w] = numpy.minimum(
+            linear[y:y + h, x:x + w], random.uniform(2.0, 300.0))
+
+    # Convert linear depth to window space depth
+    zN = ((NEAR + FAR) - 2.0 * NEAR * FAR / linear) / (FAR - NEAR)
+    return zN * 0.5 + 0.5
+
+
+def makeLights(numLights):
+    """ Creates random lights in front of the camera, which looks along -Z.
+    Half of the lights cast shadows """
+    positions = numpy.zeros((numLights, 3))
+    positions[:, 0] = [random.uniform(-150, 150) for i in xrange(numLights)]
+    positions[:, 1] = [random.uniform(-100, 100) for i in xrange(numLights)]
+    positions[:, 2] = [random.uniform(-320, 5) for i in xrange(numLights)]
+    radii = numpy.array([random.uniform(1, 25) for i in xrange(numLights)])
+
+    lightLists = {
+        "PointLight": range(0, numLights, 2),
+        "PointLightShadow": range(1, numLights, 2),
+        "DirectionalLight": [],
+        "DirectionalLightShadow": []
+    }
+    return positions, radii, lightLists
+
+
+def cullShaderPort(culler, depth, positions, radii, lightLists):
+    """ Port of PrecomputeLights.fragment and isPointLightInFrustum which
+    processes one tile and one light at a time, without NumPy tricks. Returns
+    a dictionary which maps (tileX, tileY, listName) to the light indices """
+
+    height, width = depth.shape
+    tilesX, tilesY = culler.getTileCount(width, height)
+    projMat, viewMat, mvpMat = culler.projMat, culler.viewMat, culler.mvpMat
+    result = {}
+
+    for tileY in xrange(tilesY):
+        for tileX in xrange(tilesX):
+
+            minDepth, maxDepth = 1.0, 0.0
+            screenX = tileX * culler.patchSizeX
+            screenY = tileY * culler.patchSizeY
+
+            for x in xrange(0, culler.patchSizeX,
+                            culler.minMaxDepthAccuracy * 2):
+                for y in xrange(0, culler.patchSizeX,
+                                culler.minMaxDepthAccuracy):
+                    sampleX = min(screenX + x + y % 2, width - 1)
+                    sampleY = min(screenY + y, height - 1)
+                    stored = depth[sampleY, sampleX]
+                    minDepth = min(minDepth, stored)
+                    maxDepth = max(maxDepth, stored)
+
+            near = culler.getLinearZFromZ(minDepth)
+            far = culler.getLinearZFromZ(maxDepth)
+
+            scaleX, scaleY = tilesX * 0.5, tilesY * 0.5
+            biasX, biasY = scaleX - tileX, scaleY - tileY
+            rl = numpy.array([-projMat[0, 0] * scaleX, 0, biasX, 0])
+            tl = numpy.array([0, -projMat[1, 1] * scaleY, biasY, 0])
+            offset = numpy.array([0, 0, -1.0, 0])
+            planes = [offset - rl, offset + rl, offset - tl, offset + tl]
+            planes = [p / numpy.linalg.norm(p) for p in planes]
+
+            for listName, indices in lightLists.items():
+                visible = []
+
+                for index in indices:
+                    if listName.startswith("Directional") or \
+                            not culler.anyBoundCheck:
+                        visible.append(index)
+                        continue
+
+                    pos = numpy.append(positions[index], 1.0)
+                    radius = radii[index]
+                    viewPos = viewMat.dot(pos)
+
+                    if not all(-radius <= p.dot(viewPos) for p in planes):
+                        continue
+
+                    if culler.accurateBoundCheck:
+                        clip = mvpMat.dot(pos)
+                        linearZ = culler.getLinearZFromZ(
+                            clip[2] / clip[3]) * 2.0 - 1.0
+                        if not (linearZ - math.sqrt(2.0) * radius < far and
+                                linearZ + math.sqrt(2.0) * radius > near):
+                            continue
+
+                    visible.append(index)
+
+                result[(tileX, tileY, listName)] = visible
+
+    return result
+
+
+def measure(func, repeats=5):
+    """ Returns the average time of func in milliseconds """
+    start = time.clock()
+    for i in xrange(repeats):
+        func()
+    return (time.clock() - start) / repeats * 1000.0
+
+
+def makeCuller(patchSize, accuracy, accurate, aspect):
+    """ Creates a culler with the given settings and a default camera """
+    culler = TiledLightCuller(
+        patchSizeX=patchSize, patchSizeY=patchSize,
+        minMaxDepthAccuracy=accuracy, accurateBoundCheck=accurate,
+        near=NEAR, far=FAR)
+    culler.setMatrices(numpy.identity(4), makeProjectionMatrix(60.0, aspect))
+    return culler
+
+
+def verify(configurations):
+    """ Compares the NumPy implementation with the shader port on a small
+    scene, for all configurations. Returns the number of mismatches """
+    width, height = 320, 200
+    depth = makeDepthBuffer(width, height, 10)
+    positions, radii, lightLists = makeLights(48)
+    mismatches = 0
+
+    for patchSize, accuracy, accurate in configurations:
+        culler = makeCuller(patchSize, accuracy, accurate,
+                            float(width) / height)
+        result = culler.cull(depth, positions, radii, lightLists)
+        expected = cullShaderPort(culler, depth, positions, radii, lightLists)
+
+        for (tileX, tileY, listName), indices in expected.items():
+            actual = culler.getTileLists(result, tileX, tileY)[listName]
+            if list(actual) != indices:
+                mismatches += 1
+
+        if mismatches > 0:
+            print "Mismatch for patch size", patchSize, "accuracy", \
+                accuracy, "accurate check", accurate
+
+    return mismatches
+
+
+if __name__ == "__main__":
+
+    if numpy is None:
+        print "NumPy is required for this benchmark!"
+        sys.exit(0)
+
+    random.seed(42)
+
+    width, height, numLights = 1600, 960, 256
+    if len(sys.argv) == 4:
+        width, height, numLights = [int(v) for v in sys.argv[1:4]]
+
+    configurations = [(patchSize, accuracy, accurate)
+                      for patchSize in [16, 32, 64]
+                      for accuracy in [1, 2]
+                      for accurate in [False, True]]
+
+    print "Verifying against the shader port .."
+    if verify(configurations) > 0:
+        print "Results differ from the shader port!"
+        sys.exit(1)
+
+    depth = makeDepthBuffer(width, height)
+    positions, radii, lightLists = makeLights(numLights)
+
+    print "Resolution", width, "x", height, "with", numLights, "lights"
+    print "Patch".rjust(6), "Accuracy".rjust(9), "Accurate".rjust(9), \
+        "Tiles".rjust(7), "Time (ms)".rjust(10), "Lights/Tile".rjust(12)
+
+    for patchSize, accuracy, accurate in configurations:
+        culler = makeCuller(patchSize, accuracy, accurate,
+                            float(width) / height)
+        cull = lambda: culler.cull(depth, positions, radii, lightLists)
+
+        result = cull()
+        visible = result["PointLight"][1].sum(axis=2) + \
+            result["PointLightShadow"][1].sum(axis=2)
+
+        print str(patchSize).rjust(6), str(accuracy).rjust(9), \
+            str(accurate).rjust(9), str(visible.size).rjust(7), \
+            ("%.3f" % measure(cull)).rjust(10), \
+            ("%.2f" % visible.mean()).rjust(12)
+
+    print
+    print "Clustered light assignment"
+    print "Patch".rjust(6), "Slices".rjust(9), "Clusters".rjust(9), \
+        "Time (ms)".rjust(10), "Lights/Cluster".rjust(15)
+
+    for patchSize in [16, 32, 64]:
+        for numSlices in [8, 16, 32]:
+            culler = ClusteredLightCuller(
+                patchSizeX=patchSize, patchSizeY=patchSize,
+                numSlices=numSlices, near=NEAR, far=FAR)
+            culler.setMatrices(numpy.identity(4), makeProjectionMatrix(
+                60.0, float(width) / height))
+
+            def build():
+                result = culler.cull(
+                    width, height, positions, radii, lightLists)
+                return result, culler.buildStorage(result)
+
+            result = build()[0]
+            visible = result["PointLight"][1].sum(axis=2) + \
+                result["PointLightShadow"][1].sum(axis=2)
+
+            print str(patchSize).rjust(6), str(numSlices).rjust(9), \
+                str(visible.size).rjust(9), \
+                ("%.3f" % measure(build)).rjust(10), \
+                ("%.2f" % visible.mean()).rjust(15)
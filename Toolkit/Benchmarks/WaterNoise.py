@@ -0,0 +1,118 @@
+
+"""
+
+Benchmark for the generation of the gaussian random texture of the
+WaterManager
+
+Compares the per texel generation with PNMImage (like the old
+WaterManager.__init__ did) against the vectorized generation with NumPy,
+which is part of the startup time of the pipeline when the water is
+enabled. Before measuring, the vectorized generation is verified: The same
+seed has to produce the same texels, and the texels have to follow the
+expected distribution. Exits with a non-zero exit code on errors. Requires
+NumPy.
+
+Usage:
+    python WaterNoise.py [size]
+
+"""
+
+import sys
+import time
+
+sys.path.insert(0, "../../")
+
+from random import seed as setRandomSeed
+from random import random as generateRandom
+from math import sqrt, log, cos, pi
+
+from panda3d.core import PNMImage, LVecBase3d
+
+from Code.Water.WaterManager import WaterManager, numpy
+
+
+def getGaussianRandom():
+    """ Copy of WaterManager._getGaussianRandom """
+    u1 = max(1e-6, generateRandom())
+    u2 = generateRandom()
+    return sqrt(-2 * log(u1)) * cos(2 * pi * u2)
+
+
+def generatePerTexel(size, seed):
+    """ Port of the old texel loop of WaterManager.__init__ """
+    setRandomSeed(seed)
+    image = PNMImage(size, size, 4)
+    image.setMaxval((2 ** 16) - 1)
+    for x in xrange(size):
+        for y in xrange(size):
+            rand1 = getGaussianRandom() / 10.0 + 0.5
+            rand2 = getGaussianRandom() / 10.0 + 0.5
+            image.setXel(x, y, LVecBase3d(rand1, rand2, 0))
+            image.setAlpha(x, y, 1.0)
+    return image
+
+
+def measure(func, repeats=3):
+    """ Returns the average time of func in milliseconds """
+    start = time.clock()
+    for i in xrange(repeats):
+        func()
+    return (time.clock() - start) / repeats * 1000.0
+
+
+def verify(size):
+    """ Checks the vectorized generation, returns the number of errors """
+    errors = 0
+    texels = WaterManager.generateGaussianTexels(size, 523)
+
+    if not (texels == WaterManager.generateGaussianTexels(size, 523)).all():
+        print "Same seed produced different texels!"
+        errors += 1
+
+    if (texels == WaterManager.generateGaussianTexels(size, 524)).all():
+        print "Different seeds produced the same texels!"
+        errors += 1
+
+    if texels[:, :, 0].any() or (texels[:, :, 3] != 65535).any():
+        print "Blue has to be 0 and alpha 1!"
+        errors += 1
+
+    # The shader maps the texels back with x * 10 - 5. The tolerance is a
+    # few times the standard error for size * size samples
+    tolerance = 5.0 / size + 0.01
+    for channel in [1, 2]:
+        gaussian = texels[:, :, channel] / 65535.0 * 10.0 - 5.0
+        if abs(gaussian.mean()) > tolerance or \
+                abs(gaussian.std() - 1.0) > tolerance:
+            print "Channel", channel, "is not gaussian distributed!"
+            errors += 1
+
+    # Writing into an existing buffer, like the texture ram image
+    out = numpy.zeros((size, size, 4), dtype=numpy.uint16)
+    WaterManager.generateGaussianTexels(size, 523, out)
+    if not (out == texels).all():
+        print "Writing to the given buffer produced different texels!"
+        errors += 1
+
+    return errors
+
+
+if __name__ == "__main__":
+
+    if numpy is None:
+        print "NumPy is required for this benchmark!"
+        sys.exit(0)
+
+    size = 512
+    if len(sys.argv) == 2:
+        size = int(sys.argv[1])
+
+    print "Verifying the vectorized generation .."
+    if verify(size) > 0:
+        sys.exit(1)
+
+    print "Size:", size, "x", size
+    print "Per texel (ms):".ljust(20), "%.1f" % measure(
+        lambda: generatePerTexel(size, 523), repeats=1)
+    print "Vectorized (ms):".ljust(20), "%.1f" % measure(
+        lambda: WaterManager.generateGaussianTexels(size, 523))
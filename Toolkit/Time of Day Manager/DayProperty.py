@@ -64,10 +64,6 @@ class DayProperty:
         self.values = [self.defaultValue for i in xrange(8)]
         self.curve = NurbsCurve()
         self.curve.setOrder(3)
-        self.pta = self.propType.getPTAType().emptyArray(1)
-
-    def getPTA(self):
-        return self.pta       
 
     def setValue(self, index, val):
         self.values[index] = round(val, 5)
@@ -92,3 +88,13 @@ class DayProperty:
         self.curve.getPoint(pos * 8.0 + 2.5, tmp)
         return tmp.y
 
+    def bake(self, numSamples):
+        """ Evaluates the curve at numSamples evenly spaced times of the
+        day, starting at 00:00, and returns the values as list """
+        tmp = Vec3(0)
+        samples = []
+        for i in xrange(numSamples):
+            self.curve.getPoint(i * 8.0 / numSamples + 2.5, tmp)
+            samples.append(tmp.y)
+        return samples
+
@@ -3,7 +3,8 @@ from os.path import isdir, isfile, join
 
 rootDir = "../../"
 configDir = rootDir + "Config/"
-configFile = join(configDir, "time_of_day.ini")
+configFile = join(configDir, "time_of_day.bin")
+legacyConfigFile = join(configDir, "time_of_day.ini")
 
 
 if not isdir(rootDir):
@@ -31,13 +32,17 @@ if __name__ == "__main__":
     timeOfDay = TimeOfDay()
 
     if not isfile(configFile):
-        print "Creating default config file"
+        if isfile(legacyConfigFile):
+            print "Converting", legacyConfigFile
+            timeOfDay.load(legacyConfigFile)
+        else:
+            print "Creating default config file"
         timeOfDay.save(configFile)    
 
     timeOfDay.load(configFile)
 
     manager = TimeOfDayWindow(timeOfDay)
-    manager.setSavePath(join(configDir, "time_of_day.ini"))
+    manager.setSavePath(configFile)
     manager.setAutoClassPath(join(rootDir, "Code/AutoGenerated/"))
     manager.setShaderIncludePath(join(rootDir, "Shader/Includes/"))
     manager.show()